@@ -0,0 +1,88 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from logging import debug
+
+from cape_email_plugin.answer_queue import answer_queue
+from cape_email_plugin.email_body import normalize_question
+from cape_email_plugin.email_settings import EMAIL_BATCH_WINDOW, EMAIL_BATCH_MAX_SIZE
+
+
+class AnswerBatcher:
+    """
+    Coalesces responder calls for the same user token.
+
+    The first question for a token opens a window of window milliseconds, every question for that token arriving
+    before it closes (or until max_size are collected) is answered together. Questions that are identical once
+    normalized are only answered once per batch and the results are fanned back out to each waiting caller, distinct
+    questions are answered in parallel on the answer pool.
+    """
+
+    def __init__(self, answer_function, window: float = EMAIL_BATCH_WINDOW, max_size: int = EMAIL_BATCH_MAX_SIZE):
+        self.answer_function = answer_function
+        self.window = window
+        self.max_size = max_size
+        self._pending = {}
+        self._timers = {}
+        self.batches = 0
+        self.questions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    async def answer(self, request):
+        loop = asyncio.get_event_loop()
+        token = request['args']['token']
+        future = loop.create_future()
+        batch = self._pending.setdefault(token, [])
+        batch.append((request, future))
+        if len(batch) >= self.max_size:
+            self._flush(token)
+        elif len(batch) == 1:
+            self._timers[token] = loop.call_later(self.window / 1000, self._flush, token)
+        return await future
+
+    def _flush(self, token: str):
+        timer = self._timers.pop(token, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(token, None)
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: list):
+        """Answer each distinct question of the batch once, the distinct ones in parallel on the answer pool."""
+        self.batches += 1
+        self.questions += len(batch)
+        waiting = {}
+        for request, future in batch:
+            key = (normalize_question(request['args']['question']), request['args'].get('numberofitems'),
+                   request['args'].get('offset'))
+            waiting.setdefault(key, (request, []))[1].append(future)
+        results = await asyncio.gather(*(answer_queue.run_blocking(self.answer_function, request)
+                                         for request, _ in waiting.values()), return_exceptions=True)
+        debug("Answered %d questions with %d responder calls" % (len(batch), len(waiting)))
+        for (_, futures), result in zip(waiting.values(), results):
+            for future in futures:
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def stats(self) -> dict:
+        return {'batches': self.batches, 'questions': self.questions, 'pendingTokens': len(self._pending)}
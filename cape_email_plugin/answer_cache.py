@@ -0,0 +1,63 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from itertools import count
+
+from cape_email_plugin.cache import TTLCache
+from cape_email_plugin.email_body import normalize_question
+from cape_email_plugin.email_settings import EMAIL_ANSWER_CACHE_SIZE, EMAIL_ANSWER_CACHE_TTL
+
+
+class AnswerCache:
+    """
+    Responder results keyed on the user token and the normalized question.
+
+    Every token has a generation number that is part of the key, invalidating a user gives it a new one so their old
+    entries can never be returned again and simply age out of the LRU. Generations are kept in a bounded cache too,
+    a token whose generation was evicted is given a new one rather than starting over, numbers are never reused so
+    an entry keyed on a forgotten generation is never looked up again.
+    """
+
+    def __init__(self, maxsize: int = EMAIL_ANSWER_CACHE_SIZE, ttl: float = EMAIL_ANSWER_CACHE_TTL):
+        self._cache = TTLCache(maxsize, ttl)
+        self._generations = TTLCache(maxsize, 2 * ttl)
+        self._next_generation = count(1)
+
+    def key(self, token: str, question: str, number_of_items: str, offset: str = '0') -> tuple:
+        """Take the key before calling the responder so an invalidation during the call is not overwritten."""
+        generation = self._generations.get(token)
+        if generation is None:
+            generation = self._new_generation(token)
+        return token, generation, normalize_question(question), number_of_items, offset
+
+    def get(self, key: tuple):
+        return self._cache.get(key)
+
+    def set(self, key: tuple, answers: list):
+        self._cache.set(key, answers)
+
+    def invalidate_user(self, token: str):
+        """Call whenever the saved replies or documents of the user change."""
+        self._new_generation(token)
+
+    def _new_generation(self, token: str) -> int:
+        generation = next(self._next_generation)
+        self._generations.set(token, generation)
+        return generation
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+
+answer_cache = AnswerCache()
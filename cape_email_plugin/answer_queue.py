@@ -0,0 +1,114 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from logging import debug, warning
+
+from cape_email_plugin.email_settings import EMAIL_ANSWER_WORKERS, EMAIL_ANSWER_QUEUE_SIZE
+
+_LATENCY_WINDOW = 1024
+
+
+def _percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+class AnswerQueue:
+    """
+    Bounded job queue for the answer/suggest/reply steps of the email handlers.
+
+    Jobs are coroutine functions, submit() only waits when the queue is full. Blocking calls made by the jobs
+    (the responder) go through run_blocking() so they execute on a thread pool of the same size as the queue
+    workers instead of on the event loop.
+    """
+
+    def __init__(self, workers: int = EMAIL_ANSWER_WORKERS, maxsize: int = EMAIL_ANSWER_QUEUE_SIZE):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._queue = None
+        self._tasks = []
+        self.processed = 0
+        self.failed = 0
+        self._wait_times = deque(maxlen=_LATENCY_WINDOW)
+        self._run_times = deque(maxlen=_LATENCY_WINDOW)
+
+    async def run_blocking(self, function, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, function, *args)
+
+    async def submit(self, job, *args):
+        if self._queue is None:
+            raise RuntimeError("Answer queue has not been started")
+        await self._queue.put((time.perf_counter(), job, args))
+
+    async def _work(self):
+        while True:
+            enqueued, job, args = await self._queue.get()
+            started = time.perf_counter()
+            try:
+                await job(*args)
+                self.processed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                warning("Answer job %s failed: %s" % (job.__name__, e))
+            finally:
+                finished = time.perf_counter()
+                self._wait_times.append(started - enqueued)
+                self._run_times.append(finished - started)
+                debug("Answer job %s waited %.3fs, ran %.3fs" % (job.__name__, started - enqueued, finished - started))
+                self._queue.task_done()
+
+    def start(self, loop=None):
+        loop = loop or asyncio.get_event_loop()
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._tasks = [loop.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 30):
+        """Give queued and running jobs up to timeout seconds to finish, then cancel the workers."""
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                warning("Dropping %d queued answer jobs on shutdown" % self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        wait_times, run_times = list(self._wait_times), list(self._run_times)
+        return {
+            'depth': self._queue.qsize() if self._queue is not None else 0,
+            'maxsize': self.maxsize,
+            'workers': self.workers,
+            'processed': self.processed,
+            'failed': self.failed,
+            'waitP50': _percentile(wait_times, 0.5),
+            'waitP95': _percentile(wait_times, 0.95),
+            'runP50': _percentile(run_times, 0.5),
+            'runP95': _percentile(run_times, 0.95),
+        }
+
+
+answer_queue = AnswerQueue()
@@ -0,0 +1,151 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from logging import warning
+
+from cape_email_plugin.email_settings import EMAIL_CPU_WORKERS, EMAIL_CPU_TIMEOUT, EMAIL_CPU_INLINE_CHARS
+
+
+def _size(value) -> int:
+    """Characters of text in a call argument, the measure deciding whether a call is worth a round trip."""
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_size(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_size(item) for item in value)
+    return 0
+
+
+def _noop():
+    pass
+
+
+class CpuPool:
+    """
+    Worker processes for the CPU bound steps of the email handlers (body extraction and rendering), so that one
+    pathological email does not freeze the event loop of the worker.
+
+    Calls whose text arguments total less than inline_chars characters run on the event loop, the round trip to
+    another process would cost more than the call itself. Each worker process is a single process executor running
+    one call at a time, calls wait for a free one. Offloaded calls taking more than timeout seconds return the
+    fallback instead and only the process still busy with that call is replaced, the calls running in the other
+    processes are not affected.
+    """
+
+    def __init__(self, workers: int = EMAIL_CPU_WORKERS, timeout: float = EMAIL_CPU_TIMEOUT,
+                 inline_chars: int = EMAIL_CPU_INLINE_CHARS):
+        self.workers = workers
+        self.timeout = timeout
+        self.inline_chars = inline_chars
+        self._executors = set()
+        self._idle = deque()
+        self._waiters = deque()
+        self.inline = 0
+        self.offloaded = 0
+        self.timeouts = 0
+        self.failed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        executor = ProcessPoolExecutor(max_workers=1)
+        self._executors.add(executor)
+        return executor
+
+    async def _acquire(self) -> ProcessPoolExecutor:
+        """An executor no other call is using, waiting for one when every worker is busy."""
+        if self._idle:
+            return self._idle.pop()
+        if len(self._executors) < self.workers:
+            return self._new_executor()
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():  # handed over just as the call was cancelled
+                self._release(waiter.result())
+            raise
+
+    def _release(self, executor: ProcessPoolExecutor):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(executor)
+                return
+        self._idle.append(executor)
+
+    def _replace(self, executor: ProcessPoolExecutor):
+        """Kill the process of executor, a timed out call cannot be cancelled otherwise, and start another one."""
+        self._executors.discard(executor)
+        for process in list((getattr(executor, '_processes', None) or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False)
+        self._release(self._new_executor())
+
+    def start(self):
+        """Fork the worker processes now, while the server process is still small."""
+        while len(self._executors) < self.workers:
+            executor = self._new_executor()
+            executor.submit(_noop)
+            self._idle.append(executor)
+
+    def stop(self):
+        for executor in self._executors:
+            executor.shutdown(wait=False)
+        self._executors = set()
+        self._idle.clear()
+
+    async def run(self, fallback, function, *args):
+        """
+        Result of function(*args), computed in a worker process when the arguments are large.
+        Returns fallback(*args) when the process does not answer within the timeout or dies.
+        """
+        if not self.enabled or _size(args) < self.inline_chars:
+            self.inline += 1
+            return function(*args)
+        self.offloaded += 1
+        executor = await self._acquire()
+        try:
+            future = asyncio.get_event_loop().run_in_executor(executor, function, *args)
+            result = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            warning("%s took more than %ss, using the fallback" % (function.__name__, self.timeout))
+            self._replace(executor)
+        except BrokenProcessPool:
+            self.failed += 1
+            warning("Worker process died during %s, using the fallback" % function.__name__)
+            self._replace(executor)
+        except BaseException:
+            self._release(executor)
+            raise
+        else:
+            self._release(executor)
+            return result
+        return fallback(*args)
+
+    def stats(self) -> dict:
+        return {'workers': self.workers, 'inline': self.inline, 'offloaded': self.offloaded,
+                'timeouts': self.timeouts, 'failed': self.failed}
+
+
+cpu_pool = CpuPool()
@@ -0,0 +1,103 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Local parts of the addresses replies are routed with.
+
+Legacy addresses are <event id>+<action>, routing them needs the EmailEvent to find the user. Signed addresses are
+<version>.<event id>.<user id>.<signature>+<action>, with both ids base32 encoded and an HMAC of the version, action
+and ids, so a reply is authenticated and routed without reading the event. The action stays the last character so
+the Mailgun routes matching +c@ and +e@ route both formats. Only lower case letters, digits, dots and a plus sign are
+used since mail servers do not reliably preserve the case of local parts. When the user id does not fit in the 64
+characters allowed in a local part it is left out (<version>.<event id>.<signature>+<action>): the address is still
+authenticated, the event is read to find the user.
+"""
+
+import base64
+import binascii
+import hashlib
+import hmac
+from collections import namedtuple
+from typing import Optional
+
+from cape_email_plugin.email_settings import EMAIL_SIGNED_ADDRESSES, EMAIL_ADDRESS_KEY, MAILGUN_API_KEY
+
+VERSION = '1'
+ACTIONS = {'c', 'd', 'e'}
+_SIGNATURE_BYTES = 8
+_MAX_LOCAL_PART = 64
+
+ReplyAddress = namedtuple('ReplyAddress', ['event_id', 'user_id', 'action', 'signed'])
+
+
+def _key() -> bytes:
+    """The configured key, or one derived from the Mailgun API key so that signing works without extra setup."""
+    if EMAIL_ADDRESS_KEY:
+        return EMAIL_ADDRESS_KEY.encode()
+    return hmac.new(MAILGUN_API_KEY.encode(), b'cape email reply addresses', hashlib.sha256).digest()
+
+
+def _encode(data: bytes) -> str:
+    return base64.b32encode(data).decode().rstrip('=').lower()
+
+
+def _decode(text: str) -> bytes:
+    return base64.b32decode(text.upper() + '=' * (-len(text) % 8))
+
+
+def _signature(key: bytes, action: str, event_id: str, user_id: Optional[str]) -> str:
+    message = '\n'.join((VERSION, action, event_id, user_id or '')).encode()
+    return _encode(hmac.new(key, message, hashlib.sha256).digest()[:_SIGNATURE_BYTES])
+
+
+def reply_local_part(event_id: str, user_id: str, action: str, signed: bool = EMAIL_SIGNED_ADDRESSES,
+                     key: bytes = None) -> str:
+    if signed:
+        try:
+            event = _encode(bytes.fromhex(event_id))
+        except ValueError:  # event ids are uuid4 hex digests, anything else keeps the legacy format
+            event = None
+        if event is not None:
+            key = key or _key()
+            local_part = f'{VERSION}.{event}.{_encode(user_id.encode())}.{_signature(key, action, event_id, user_id)}' \
+                         f'+{action}'
+            if len(local_part) > _MAX_LOCAL_PART:
+                local_part = f'{VERSION}.{event}.{_signature(key, action, event_id, None)}+{action}'
+            return local_part
+    return f'{event_id}+{action}'
+
+
+def parse_local_part(local_part: str, key: bytes = None) -> Optional[ReplyAddress]:
+    """
+    The reply address in local_part, with user_id None for legacy addresses and signed ones without it.
+    Returns None for token addresses and raises ValueError for malformed or forged reply addresses.
+    """
+    base, plus, action = local_part.lower().rpartition('+')
+    if not plus:
+        return None
+    if action not in ACTIONS or not base:
+        raise ValueError(f'Unknown reply address {local_part}')
+    if '.' not in base:
+        return ReplyAddress(base, None, action, False)
+    parts = base.split('.')
+    if parts[0] != VERSION or len(parts) not in (3, 4):
+        raise ValueError(f'Unknown reply address {local_part}')
+    event, user, signature = parts[1], parts[2] if len(parts) == 4 else None, parts[-1]
+    try:
+        event_id, user_id = _decode(event).hex(), None if user is None else _decode(user).decode()
+    except (binascii.Error, UnicodeDecodeError) as e:
+        raise ValueError(f'Malformed reply address {local_part}') from e
+    if not hmac.compare_digest(signature, _signature(key or _key(), action, event_id, user_id)):
+        raise ValueError(f'Invalid signature in reply address {local_part}')
+    return ReplyAddress(event_id, user_id, action, True)
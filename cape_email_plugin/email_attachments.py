@@ -0,0 +1,180 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Turns text attachments of emails sent by an account owner into Cape documents.
+
+Attachments come either as multipart files (Mailgun forward routes) or as storage URLs (Mailgun store routes),
+storage URLs are only read from messages fetched from Mailgun and only fetched from Mailgun's hosts. Each one is
+copied to a temporary file in fixed size blocks, then decoded incrementally and uploaded through the webservices
+document API in parts of at most EMAIL_ATTACHMENT_PART_CHARS characters. Memory use is bounded by the block and part
+sizes whatever the size of the attachment, which is itself capped.
+"""
+
+import codecs
+import json
+import os
+import tempfile
+from logging import warning
+from typing import Iterator, List
+
+import requests
+
+from cape_email_plugin.email_backend import upload_document
+from cape_email_plugin.email_sender import sender
+from cape_email_plugin.email_settings import EMAIL_ATTACHMENT_MAX_COUNT, EMAIL_ATTACHMENT_MAX_BYTES, \
+    EMAIL_ATTACHMENT_PART_CHARS, EMAIL_ATTACHMENT_DIR
+from cape_email_plugin.email_store import STORED_MESSAGE, trusted_url
+
+_BLOCK_SIZE = 64 * 1024
+_TEXT_TYPES = {'text/plain', 'text/markdown', 'text/x-markdown', 'text/csv'}
+_TEXT_EXTENSIONS = {'.txt', '.md', '.markdown', '.csv'}
+
+UPLOADED = 'uploaded'
+UNSUPPORTED = 'unsupported type'
+TOO_LARGE = 'too large'
+TOO_MANY = 'too many attachments'
+FAILED = 'failed'
+
+
+class AttachmentTooLarge(Exception):
+    pass
+
+
+def _content_type(content_type: str):
+    """The media type and charset of a Content-Type value."""
+    media_type, _, parameters = (content_type or '').partition(';')
+    charset = 'utf-8'
+    for parameter in parameters.split(';'):
+        name, _, value = parameter.partition('=')
+        if name.strip().lower() == 'charset' and value.strip():
+            charset = value.strip().strip('"')
+    return media_type.strip().lower(), charset
+
+
+def is_text(name: str, content_type: str) -> bool:
+    media_type, _ = _content_type(content_type)
+    return media_type in _TEXT_TYPES or (media_type in ('', 'application/octet-stream') and
+                                         os.path.splitext(name or '')[1].lower() in _TEXT_EXTENSIONS)
+
+
+def attachments(request) -> List[dict]:
+    """
+    Descriptions of the attachments of a webhook, with either the uploaded file or the storage url. The attachments
+    field is only read from a message fetched from Mailgun's storage, in a forwarded message it is the sender's.
+    """
+    found = []
+    files = getattr(request, 'files', None) or {}
+    for field in sorted(files):
+        if field.startswith('attachment'):
+            for file in files.getlist(field) if hasattr(files, 'getlist') else files[field]:
+                found.append({'name': file.name, 'content-type': file.type, 'size': len(file.body), 'file': file})
+    stored = request['args'].get('attachments') if request.get(STORED_MESSAGE) else None
+    if stored:
+        try:
+            for attachment in json.loads(stored) if isinstance(stored, str) else stored:
+                found.append({'name': attachment.get('name'), 'content-type': attachment.get('content-type'),
+                              'size': attachment.get('size'), 'url': attachment['url']})
+        except (TypeError, ValueError, KeyError) as e:
+            warning("Ignoring unreadable attachments field: %s" % e)
+    return found
+
+
+def _copy_to(attachment: dict, destination, max_bytes: int):
+    """Write the attachment to destination block by block, giving up as soon as it exceeds max_bytes."""
+    written = 0
+    if 'file' in attachment:
+        body = memoryview(attachment['file'].body)
+        blocks = (body[start:start + _BLOCK_SIZE] for start in range(0, len(body), _BLOCK_SIZE))
+    else:
+        response = sender.session.get(attachment['url'], stream=True, timeout=sender.timeout)
+        response.raise_for_status()
+        blocks = response.iter_content(_BLOCK_SIZE)
+    for block in blocks:
+        written += len(block)
+        if written > max_bytes:
+            raise AttachmentTooLarge()
+        destination.write(block)
+    destination.seek(0)
+
+
+def text_parts(source, charset: str, part_chars: int) -> Iterator[str]:
+    """Decode a binary file incrementally, yielding pieces of at most part_chars characters cut at line ends."""
+    try:
+        decoder = codecs.getincrementaldecoder(charset)('replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    pending = ''
+    while True:
+        block = source.read(_BLOCK_SIZE)
+        pending += decoder.decode(block, final=not block)
+        while len(pending) >= part_chars:
+            cut = pending.rfind('\n', 0, part_chars) + 1 or part_chars
+            yield pending[:cut]
+            pending = pending[cut:]
+        if not block:
+            break
+    if pending.strip():
+        yield pending
+
+
+def _upload(request, title: str, text: str, document_id: str) -> str:
+    args = request['args']
+    request['args'] = {'title': title, 'text': text, 'documentId': document_id, 'origin': 'email',
+                       'replace': 'true'}
+    try:
+        return json.loads(upload_document(request).body)['result']['documentId']
+    finally:
+        request['args'] = args
+
+
+def ingest_attachments(request, document_prefix: str, max_count: int = EMAIL_ATTACHMENT_MAX_COUNT,
+                       max_bytes: int = EMAIL_ATTACHMENT_MAX_BYTES,
+                       part_chars: int = EMAIL_ATTACHMENT_PART_CHARS) -> List[dict]:
+    """
+    Upload the text attachments of the request as documents of request['user'], blocking.
+    Returns what happened to each attachment, documents ids are derived from document_prefix so a redelivered
+    email replaces the documents it created instead of adding new ones.
+    """
+    results = []
+    for index, attachment in enumerate(attachments(request)):
+        result = {'name': attachment['name'], 'documentIds': []}
+        results.append(result)
+        if index >= max_count:
+            result['status'] = TOO_MANY
+        elif not is_text(attachment['name'], attachment['content-type']):
+            result['status'] = UNSUPPORTED
+        elif attachment['size'] is not None and int(attachment['size']) > max_bytes:
+            result['status'] = TOO_LARGE
+        elif 'url' in attachment and not trusted_url(attachment['url']):
+            warning("Refusing to fetch attachment %s from %s" % (attachment['name'], attachment['url']))
+            result['status'] = FAILED
+        else:
+            _, charset = _content_type(attachment['content-type'])
+            try:
+                with tempfile.TemporaryFile(dir=EMAIL_ATTACHMENT_DIR) as spooled:
+                    _copy_to(attachment, spooled, max_bytes)
+                    for number, text in enumerate(text_parts(spooled, charset, part_chars), 1):
+                        title = attachment['name'] or f'Email attachment {index + 1}'
+                        if number > 1:
+                            title = f'{title} (part {number})'
+                        result['documentIds'].append(
+                            _upload(request, title, text, f'{document_prefix}-{index + 1}-{number}'))
+                result['status'] = UPLOADED
+            except AttachmentTooLarge:
+                result['status'] = TOO_LARGE
+            except (requests.RequestException, OSError, KeyError, ValueError) as e:
+                warning("Could not ingest attachment %s: %s" % (attachment['name'], e))
+                result['status'] = FAILED
+    return results
@@ -0,0 +1,75 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+The functions the handlers call into for answers, saved replies and document uploads.
+
+Each one is named by a 'module:function' setting and imported the first time it is called rather than with the
+plugin, the webservices defaults load the responder and its models, which a process that only verifies, routes and
+enqueues webhooks never needs. Another implementation taking the same request dict and returning a response with a
+JSON body can be configured instead, for example one calling a responder running elsewhere.
+"""
+
+import importlib
+import threading
+import time
+
+from cape_email_plugin.email_settings import EMAIL_ANSWER_BACKEND, EMAIL_SAVED_REPLY_BACKEND, \
+    EMAIL_DOCUMENT_BACKEND
+
+
+class LazyFunction:
+    """Function imported from path ('module:function') on its first call, or by load()."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._function = None
+        self._lock = threading.Lock()
+        self.load_seconds = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._function is not None
+
+    def load(self):
+        with self._lock:  # answers are computed on threads, only one of them imports
+            if self._function is None:
+                start = time.perf_counter()
+                module, _, name = self.path.partition(':')
+                function = getattr(importlib.import_module(module), name)
+                self.load_seconds = round(time.perf_counter() - start, 3)
+                self._function = function
+        return self._function
+
+    def __call__(self, *args, **kwargs):
+        return (self._function or self.load())(*args, **kwargs)
+
+    def stats(self) -> dict:
+        return {'path': self.path, 'loaded': self.loaded, 'loadSeconds': self.load_seconds}
+
+
+responder_answer = LazyFunction(EMAIL_ANSWER_BACKEND)
+create_saved_reply = LazyFunction(EMAIL_SAVED_REPLY_BACKEND)
+upload_document = LazyFunction(EMAIL_DOCUMENT_BACKEND)
+_BACKENDS = {'answer': responder_answer, 'savedReply': create_saved_reply, 'document': upload_document}
+
+
+def preload():
+    """Import every backend now, so the first email does not wait for it."""
+    for backend in _BACKENDS.values():
+        backend.load()
+
+
+def stats() -> dict:
+    return {name: backend.stats() for name, backend in _BACKENDS.items()}
@@ -0,0 +1,108 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+from typing import Iterable, List
+
+import quotequail
+
+from cape_email_plugin.email_settings import EMAIL_BODY_LANGUAGES
+
+_LANGUAGE_GREETINGS = {
+    'en': {"hi", "dear", "hey", "hello", "morning", "afternoon", "evening"},
+    'es': {"hola"},
+    'fr': {"bonjour"},
+}
+_LANGUAGE_BYES = {  # yours truly, sent from my iphone, talk soon, see you soon...
+    'en': {"thank", "bye", "regards", "cheers", "sincerely", "best", "bgif", "soon", "cordially", "yours", "sent",
+           "--", "goodbye"},
+    'it': {"ciao"},
+}
+
+# Characters dropped from a word before looking it up: anything but ASCII letters, digits and whitespace
+_DROPPED = r'[^0-9A-Za-z\s]'
+_SPACE = r'[^\S\n]+'
+
+
+def _word_pattern(word: str) -> str:
+    """A whitespace delimited chunk that reads as word once punctuation is dropped, ignoring ASCII case."""
+    letters = [re.escape(c) if not c.isalpha() else f'[{c.lower()}{c.upper()}]'
+               for c in re.sub(_DROPPED, '', word)]
+    return f'{_DROPPED}*' + f'{_DROPPED}*'.join(letters) + f'{_DROPPED}*'
+
+
+def _line_pattern(words: set, first_words: int):
+    """
+    Matches the start of every line where one of the first first_words words is in words.
+    Chunks made only of punctuation do not count as words, mirroring the former per line re.sub + split.
+    """
+    empty = f'{_DROPPED}+{_SPACE}'
+    other = rf'{_DROPPED}*[0-9A-Za-z]\S*{_SPACE}(?:{empty})*'
+    lookup = '|'.join(sorted((_word_pattern(word) for word in words if re.sub(_DROPPED, '', word)), key=len,
+                             reverse=True))
+    if not lookup:
+        return re.compile(r'(?!)')
+    return re.compile(rf'^(?:{empty})*(?:{other}){{0,{first_words - 1}}}(?:{lookup})(?=\s|$)', re.MULTILINE)
+
+
+class BodyExtractor:
+    """
+    Extracts the question from an email: quoted replies are removed with quotequail, then a leading greeting and
+    everything from the first sign-off are dropped. Greeting and sign-off lines are found with one precompiled
+    pattern per language set, scanned once over the whole message instead of line by line.
+    """
+
+    def __init__(self, languages: Iterable[str] = None, first_words: int = 3):
+        languages = list(languages or set(_LANGUAGE_GREETINGS) | set(_LANGUAGE_BYES))
+        self.greetings = set().union(*(_LANGUAGE_GREETINGS.get(language, set()) for language in languages))
+        self.byes = set().union(*(_LANGUAGE_BYES.get(language, set()) for language in languages))
+        self._greeting = _line_pattern(self.greetings, first_words)
+        self._bye = _line_pattern(self.byes, first_words)
+
+    def extract(self, text: str) -> str:
+        unwrapped_text = quotequail.unwrap(text)
+        # Remove quotes
+        if unwrapped_text is None:
+            stripped_text = text
+        elif 'text_top' in unwrapped_text:
+            stripped_text = unwrapped_text['text_top']
+        elif 'text_bottom' in unwrapped_text:
+            stripped_text = unwrapped_text['text_bottom']
+        lines = [line for line in (line.strip() for line in stripped_text.replace('\r\n', '\n').split('\n')) if line]
+        if len(lines) > 1 and self._greeting.match(lines[0]):
+            lines.pop(0)
+        if len(lines) > 2:
+            body = "\n".join(lines)
+            # Sign-offs are looked for from the second line up to the one before last
+            match = self._bye.search(body, len(lines[0]) + 1, len(body) - len(lines[-1]) - 1)
+            if match is not None:
+                return body[:match.start() - 1]
+            return body
+        return "\n".join(lines)
+
+    def extract_many(self, texts: Iterable[str]) -> List[str]:
+        return [self.extract(text) for text in texts]
+
+
+body_extractor = BodyExtractor(EMAIL_BODY_LANGUAGES)
+
+
+def extract_body(text: str) -> str:
+    """body_extractor.extract as a module level function, cheap to send to another process."""
+    return body_extractor.extract(text)
+
+
+def normalize_question(text: str) -> str:
+    """Lower cased question with runs of whitespace collapsed, used to spot repeated questions."""
+    return ' '.join(text.lower().split())
@@ -0,0 +1,146 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from logging import warning
+from typing import List
+
+from cape_email_plugin.email_settings import MAILGUN_SPOOL_PATH, EMAIL_DIGEST_INTERVAL
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS digest_items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient TEXT NOT NULL,
+    event_id TEXT NOT NULL,
+    reply_address TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    text TEXT NOT NULL,
+    html TEXT NOT NULL,
+    created REAL NOT NULL,
+    claimed_until REAL NOT NULL DEFAULT 0
+);
+"""
+# Items taken by a process that stopped before spooling them are taken again after this many seconds
+_CLAIM_LEASE = 300
+# Digests are sent from this address, replies to it are answered with ERROR_DIGEST_REPLY
+DIGEST_LOCAL_PART = 'digest'
+ERROR_DIGEST_REPLY = 'This digest groups several questions, please reply using the link under the question you are ' \
+                     'answering so your answer reaches the right person.'
+
+
+class DigestQueue:
+    """
+    Pending suggestion emails waiting to be grouped into one digest per recipient.
+
+    Items live in the spool's SQLite file so they survive restarts. Every interval seconds the pending items are
+    claimed in one transaction and handed, grouped by recipient, to the send function given to start() together with
+    remove(), which send calls with the ids of the items once they are spooled. Items not removed, because sending
+    failed or the server stopped meanwhile, are claimed again once their lease expires.
+    """
+
+    def __init__(self, path: str = MAILGUN_SPOOL_PATH, interval: float = EMAIL_DIGEST_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._connection = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._task = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(_SCHEMA)
+            columns = {column['name'] for column in connection.execute('PRAGMA table_info(digest_items)')}
+            if 'claimed_until' not in columns:  # files created before leases
+                connection.execute('ALTER TABLE digest_items ADD COLUMN claimed_until REAL NOT NULL DEFAULT 0')
+            self._connection = connection
+        return self._connection
+
+    def _insert(self, recipient: str, event_id: str, reply_address: str, subject: str, text: str, html: str):
+        with self._lock:
+            self.connection.execute(
+                'INSERT INTO digest_items (recipient, event_id, reply_address, subject, text, html, created) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', (recipient, event_id, reply_address, subject, text, html, time.time()))
+
+    async def add(self, recipient: str, event_id: str, reply_address: str, subject: str, text: str, html: str):
+        """Queue a suggestion email for the next digest of recipient."""
+        await asyncio.get_event_loop().run_in_executor(self._executor, self._insert, recipient, event_id,
+                                                       reply_address, subject, text, html)
+
+    def take(self) -> OrderedDict:
+        """Claim and return every pending item not claimed by another process, grouped by recipient in arrival order."""
+        now = time.time()
+        with self._lock:
+            connection = self.connection
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                rows = connection.execute('SELECT * FROM digest_items WHERE claimed_until <= ? ORDER BY id',
+                                          (now,)).fetchall()
+                if rows:
+                    connection.execute('UPDATE digest_items SET claimed_until = ? WHERE claimed_until <= ? AND id <= ?',
+                                       (now + _CLAIM_LEASE, now, rows[-1]['id']))
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        digests = OrderedDict()
+        for row in rows:
+            digests.setdefault(row['recipient'], []).append(dict(row))
+        return digests
+
+    def _delete(self, ids: List[int]):
+        with self._lock:
+            self.connection.executemany('DELETE FROM digest_items WHERE id = ?', [(item_id,) for item_id in ids])
+
+    async def remove(self, ids: List[int]):
+        """Delete items that have been spooled."""
+        await asyncio.get_event_loop().run_in_executor(self._executor, self._delete, ids)
+
+    async def _run(self, send):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                digests = await loop.run_in_executor(self._executor, self.take)
+                if digests:
+                    await send(digests, self.remove)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                warning("Failed to send email digests: %s" % e)
+
+    def start(self, send, loop=None):
+        if self.enabled:
+            self._task = (loop or asyncio.get_event_loop()).create_task(self._run(send))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+digest_queue = DigestQueue()
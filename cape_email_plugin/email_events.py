@@ -15,35 +15,50 @@
 import re
 import json
 from datetime import datetime
-import html
 import hashlib
 import hmac
-import quotequail
 from functools import wraps
+from inspect import isawaitable
 
-from webservices.app.app_settings import URL_BASE, UI_URL
+from webservices.app.app_settings import URL_BASE
 from cape_email_plugin.email_settings import email_event_endpoints
-from logging import debug, warning
-from cape_email_plugin.email_settings import MAILGUN_API_KEY, MAILGUN_DOMAIN, DEFAULT_EMAIL
-
-import requests
+from logging import debug, info, warning
+from cape_email_plugin.email_settings import MAILGUN_API_KEY, MAILGUN_DOMAIN, DEFAULT_EMAIL, EMAIL_ASYNC_ANSWERS, \
+    EMAIL_DIGEST_BATCH_SIZE, EMAIL_ATTACHMENTS, EMAIL_PRELOAD_BACKEND, EMAIL_MONITORING_KEY
+from cape_email_plugin.answer_queue import answer_queue
+from cape_email_plugin.cpu_pool import cpu_pool
+from cape_email_plugin.answer_batcher import AnswerBatcher
+from cape_email_plugin.answer_cache import answer_cache
+from cape_email_plugin.email_body import extract_body, normalize_question
+from cape_email_plugin.email_idempotency import idempotency_store
+from cape_email_plugin.email_package import compact_package
+from cape_email_plugin.email_templates import render_quote, render_answer, render_suggestions, render_digest, \
+    render_plain
+from cape_email_plugin.email_digest import digest_queue, DIGEST_LOCAL_PART, ERROR_DIGEST_REPLY
+from cape_email_plugin.email_addresses import reply_local_part, parse_local_part
+from cape_email_plugin.email_limits import cap_fields, bounded_question
+from cape_email_plugin.email_filters import mail_filter, sender_address, sender_authenticated, DROP, \
+    ERROR_EMAIL_RATE_LIMITED
+from cape_email_plugin.email_attachments import ingest_attachments
+from cape_email_plugin.email_lookups import get_user, refresh_user, get_event, save_event, user_cache, event_cache, \
+    LazyEvent, event_writer
+from cape_email_plugin.email_metrics import RequestTrace, job_trace, stage, render_metrics
+from cape_email_plugin.email_sender import sender
+from cape_email_plugin.email_store import fetch_message
+from cape_email_plugin.email_spool import spool
+from cape_email_plugin import email_backend
+from cape_email_plugin.email_backend import responder_answer, create_saved_reply
+
+from sanic.response import text
 from webservices.app.app_middleware import respond_with_json
 from api_helpers.exceptions import UserException
 from api_helpers.input import required_parameter
 from api_helpers.text_responses import *
 from userdb.email_event import EmailEvent
 from userdb.user import User
-from webservices.app.app_core import _answer as responder_answer
-from webservices.app.app_saved_reply_endpoints import _create_saved_reply as create_saved_reply
 
 _endpoint_route = lambda x: email_event_endpoints.route(URL_BASE + x, methods=['GET', 'POST'])
 
-_GREETINGS = {"hola", "hi", "dear", "hey", "hello", "morning", "afternoon", "evening","bonjour" }
-_BYES = {"thank", "bye", "regards", "cheers", "sincerely", "ciao", "best", "bgif", "soon", "cordially", "yours", "sent",
-         "--", "goodbye"}  # yours truly, sent from my iphone, talk soon, see you soon...
-
-NON_WORD_CHARS = re.compile('[^0-9a-zA-Z\s]')
-
 """
     When sending email the following cases can occur, if Bob has a question for Alice:
        - User has not configured forward email, no saved reply is created:
@@ -60,206 +75,438 @@ NON_WORD_CHARS = re.compile('[^0-9a-zA-Z\s]')
 """
 
 
-def mailgun(wrapped):
+@email_event_endpoints.listener('after_server_start')
+async def _start_workers(app, loop):
+    spool.start(loop)
+    cpu_pool.start()
+    answer_queue.start(loop)
+    digest_queue.start(_send_digests, loop)
+    event_writer.start(loop)
+    if EMAIL_PRELOAD_BACKEND:
+        await loop.run_in_executor(None, email_backend.preload)
+
+
+@email_event_endpoints.listener('before_server_stop')
+async def _stop_workers(app, loop):
+    await answer_queue.stop()
+    await digest_queue.stop()
+    await event_writer.stop()
+    await spool.stop()
+    cpu_pool.stop()
+
+
+@email_event_endpoints.listener('after_server_stop')
+async def _close_sender(app, loop):
+    sender.close()
+
+
+def respond_with_json_async(wrapped):
     """
-    Decorator for handling API calls that provide a metadata dictionary as input.
-    Calls the wrapped function with the parsed metadata provided by the API user.
+    Equivalent of respond_with_json for coroutine handlers.
+    The coroutine is awaited first, then its result (or exception) is handed over to respond_with_json
+    so that successes and errors are serialized exactly like the synchronous endpoints.
     """
 
     @wraps(wrapped)
-    def decorated(request, *args, **kwargs):
-        token = required_parameter(request, 'token')
-        timestamp = required_parameter(request, 'timestamp')
-        signature = required_parameter(request, 'signature')
-        hmac_digest = hmac.new(key=MAILGUN_API_KEY.encode(), msg=(timestamp + token).encode(),
-                               digestmod=hashlib.sha256).hexdigest()
-        if not hmac.compare_digest(signature, hmac_digest):
-            raise UserException(MAILGUN_INVALID_SIGNATURE)
+    async def decorated(request, *args, **kwargs):
+        try:
+            result = await wrapped(request, *args, **kwargs)
+        except Exception as e:
+            error = e
+
+            def outcome(*_args, **_kwargs):
+                raise error
+        else:
+            def outcome(*_args, **_kwargs):
+                return result
+        response = respond_with_json(wraps(wrapped)(outcome))(request)
+        if isawaitable(response):
+            response = await response
+        return response
+
+    return decorated
 
+
+def mailgun(wrapped):
+    """
+    Decorator for handling API calls that provide a metadata dictionary as input.
+    Calls the wrapped coroutine with the parsed metadata provided by the API user,
+    redelivered webhooks get the result of the first delivery.
+    Auto-replies and floods are dropped or deferred by mail_filter before any database access, oversized fields are
+    truncated by cap_fields as soon as the signature is verified.
+    """
+
+    async def route(request, *args, **kwargs):
         local_part = request['args']['recipient'].split('@')[0]
-        if local_part[-2] == '+':
-            email_event: EmailEvent = EmailEvent.get('unique_id', local_part[:-2])
-            if email_event is None:
-                raise UserException(INVALID_TOKEN % local_part[:-2])
-            user = User.get('user_id', email_event.user_id)
-        else:
-            user: User = User.get('token', local_part)
-            email_event = None
+        with stage('filter'):
+            action, reason = mail_filter.check(request['args'], local_part)
+        if action == DROP:
+            info("Dropped email from %s to %s: %s" % (request['args'].get('from'), local_part, reason))
+            return {"success": False, "emailHandled": False, "dropped": reason}
+        elif action is not None:
+            request['trace'].outcome = 'deferred'
+            raise UserException(ERROR_EMAIL_RATE_LIMITED)
+        if local_part == DIGEST_LOCAL_PART:  # the owner replied to a digest rather than to one of its questions
+            await mailgun_send(request['args']['to'], request['args']['from'], request['args']['subject'],
+                               ERROR_DIGEST_REPLY)
+            return {"success": False, "emailHandled": True}
+        with stage('lookup'):
+            try:
+                reply_address = parse_local_part(local_part)
+            except ValueError:
+                raise UserException(INVALID_TOKEN % local_part)
+            if reply_address is not None and reply_address.user_id is not None:
+                email_event = LazyEvent(reply_address.event_id, reply_address.user_id)  # read if the handler needs it
+                request['trace'].unique_id = email_event.unique_id
+                user = get_user('user_id', email_event.user_id)
+            elif reply_address is not None:
+                email_event: EmailEvent = get_event(reply_address.event_id)
+                if email_event is None:
+                    raise UserException(INVALID_TOKEN % reply_address.event_id)
+                request['trace'].unique_id = email_event.unique_id
+                user = get_user('user_id', email_event.user_id)
+            else:
+                user: User = get_user('token', local_part)
+                email_event = None
         if user is not None:
             request['user_from_token'] = user
             request['user'] = user
         else:
-            mailgun_send(request['args']['to'], request['args']['from'], request['args']['subject'],
-                         ERROR_EMAIL_TOKEN_NOT_FOUND % local_part)
+            await mailgun_send(request['args']['to'], request['args']['from'], request['args']['subject'],
+                               ERROR_EMAIL_TOKEN_NOT_FOUND % local_part)
             return {"success": False, "emailHandled": True}
 
         if email_event is None:
-            return wrapped(request, *args, **kwargs, user=user)
+            return await wrapped(request, *args, **kwargs, user=user)
         else:
-            return wrapped(request, *args, **kwargs, user=user, email_event=email_event)
+            return await wrapped(request, *args, **kwargs, user=user, email_event=email_event)
+
+    @wraps(wrapped)
+    async def decorated(request, *args, **kwargs):
+        with RequestTrace(wrapped.__name__) as trace:
+            request['trace'] = trace
+            with stage('verify'):
+                token = required_parameter(request, 'token')
+                timestamp = required_parameter(request, 'timestamp')
+                signature = required_parameter(request, 'signature')
+                hmac_digest = hmac.new(key=MAILGUN_API_KEY.encode(), msg=(timestamp + token).encode(),
+                                       digestmod=hashlib.sha256).hexdigest()
+                if not hmac.compare_digest(signature, hmac_digest):
+                    raise UserException(MAILGUN_INVALID_SIGNATURE)
+            cap_fields(request['args'])  # before anything copies or parses the payload
+            result = await idempotency_store.run(idempotency_store.keys(request, wrapped.__name__),
+                                                 lambda: route(request, *args, **kwargs))
+            if result.get('dropped'):
+                trace.outcome = 'dropped'
+            else:
+                trace.outcome = 'handled' if result.get('success') else 'rejected'
+            return result
 
     return decorated
 
 
-def mailgun_send(email_from, email_to, email_subject, email_text):
+async def mailgun_send(email_from, email_to, email_subject, email_html, event_id: str = None, email_text: str = None):
+    """Spool an email for delivery, the spool workers retry it until Mailgun accepts it."""
     if email_to.lower().endswith(MAILGUN_DOMAIN):
         warning("Refusing to send email to %s (%s domain)" % (email_to, MAILGUN_DOMAIN))
     else:
-        data = {'from': email_from, 'to': email_to, 'subject': email_subject, 'html': email_text}
-        requests.post(f'https://api.mailgun.net/v3/{MAILGUN_DOMAIN}/messages', data=data,
-                      auth=('api', f'{MAILGUN_API_KEY}'))
-
-
-def _mailgun_reply(email_from: str, email_to: str, email_original_subject: str, email_original_text: str,
-                   email_original_timestamp: datetime, email_reply_text: str):
-    email_text = email_reply_text
-    email_text += email_original_timestamp.strftime(
-        f"<br />On %a, %b %d, %Y at %H:%M %p {email_to} wrote:<br />")
-    email_text += "<br />".join(f"> {line}" for line in email_original_text.replace('\r\n', '\n').split('\n'))
-    mailgun_send(email_from, email_to, f'Re: {email_original_subject}', email_text)
-
-
-def _simple_heuristic(line: str, lookup_set: set = _GREETINGS, first_words: int = 3) -> bool:
-    line = re.sub(NON_WORD_CHARS, "", line)#remove punctuation
-    words = line.split()[:first_words]  # Are the first X words in the lookup_set
-    return bool(lookup_set.intersection(word.lower() for word in words))
-
-
-def _get_body(text: str):  # TODO build a classifier for this
-    unwrapped_text = quotequail.unwrap(text)
-    # Remove quotes
-    if unwrapped_text is None:
-        stripped_text = text
-    elif 'text_top' in unwrapped_text:
-        stripped_text = unwrapped_text['text_top']
-    elif 'text_bottom' in unwrapped_text:
-        stripped_text = unwrapped_text['text_bottom']
-    lines = [line.strip() for line in stripped_text.replace('\r\n', '\n').split('\n') if line.strip()]
-    if len(lines) > 1 and _simple_heuristic(lines[0]):
-        lines.pop(0)
-    for idx in range(1, len(lines) - 1):
-        if _simple_heuristic(lines[idx], _BYES):
-            lines = lines[:idx]
-            break
-    return "\n".join(lines)
-
-
-def _respond_with_answer(email_event: EmailEvent, answer: dict):
+        data = {'from': email_from, 'to': email_to, 'subject': email_subject, 'html': email_html,
+                'h:Auto-Submitted': 'auto-replied'}
+        if email_text is not None:
+            data['text'] = email_text
+        with stage('send'):
+            await spool.enqueue(data, event_id)
+
+
+async def mailgun_send_batch(email_from, recipient_variables: dict, email_subject, email_html, email_text=None):
+    """
+    Spool one message for many recipients using Mailgun batch sending, recipient_variables maps each address to
+    the values substituted for %recipient.name% in the subject and bodies.
+    """
+    recipient_variables = {email_to: variables for email_to, variables in recipient_variables.items()
+                           if not email_to.lower().endswith(MAILGUN_DOMAIN)}
+    if not recipient_variables:
+        return
+    data = {'from': email_from, 'to': list(recipient_variables), 'subject': email_subject, 'html': email_html,
+            'recipient-variables': json.dumps(recipient_variables), 'h:Auto-Submitted': 'auto-generated'}
+    if email_text is not None:
+        data['text'] = email_text
+    with stage('send'):
+        await spool.enqueue(data)
+
+
+# Sent instead of the rendered templates when rendering takes too long
+def _plain_answer(firstname: str, answer_text: str, *args):
+    return render_plain(answer_text)
+
+
+def _plain_suggestions(firstname: str, answers: list):
+    return render_plain('\n\n'.join(answer['answerText'] for answer in answers))
+
+
+def _plain_digest(items: list):
+    return render_plain('\n\n'.join(item['text'] for item in items))
+
+
+def _no_quote(*args):
+    return '', ''
+
+
+async def _render(fallback, function, *args):
+    """Render on the CPU pool, fallback(*args) is sent instead if that takes too long."""
+    with stage('render'):
+        return await cpu_pool.run(fallback, function, *args)
+
+
+async def _send_digests(digests: dict, remove):
+    """
+    Send the pending suggestions of every recipient as one digest, batching recipients in Mailgun calls. The items of
+    each batch are removed from the digest queue once the batch is spooled.
+    """
+    recipients = list(digests)
+    for start in range(0, len(recipients), EMAIL_DIGEST_BATCH_SIZE):
+        recipient_variables = {}
+        for recipient in recipients[start:start + EMAIL_DIGEST_BATCH_SIZE]:
+            digest_text, digest_html = await _render(_plain_digest, render_digest, digests[recipient])
+            recipient_variables[recipient] = {'text': digest_text, 'html': digest_html,
+                                              'count': len(digests[recipient])}
+        await mailgun_send_batch(f'Cape AI <{DIGEST_LOCAL_PART}@{MAILGUN_DOMAIN}>', recipient_variables,
+                                 'Cape AI: %recipient.count% questions waiting for an answer', '%recipient.html%',
+                                 '%recipient.text%')
+        await remove([item['id'] for recipient in recipients[start:start + EMAIL_DIGEST_BATCH_SIZE]
+                      for item in digests[recipient]])
+
+
+async def _mailgun_reply(email_from: str, email_to: str, email_original_subject: str, email_original_text: str,
+                         email_original_timestamp: datetime, email_reply: tuple, event_id: str = None):
+    """Send the (text, html) reply with the original email quoted below it."""
+    quote_text, quote_html = await _render(_no_quote, render_quote, email_original_text, email_original_timestamp,
+                                           email_to)
+    reply_text, reply_html = email_reply
+    await mailgun_send(email_from, email_to, f'Re: {email_original_subject}', reply_html + quote_html, event_id,
+                       reply_text + quote_text)
+
+
+def _reply_address(email_event: EmailEvent, action: str) -> str:
+    return f'{reply_local_part(email_event.unique_id, email_event.user_id, action)}@{MAILGUN_DOMAIN}'
+
+
+def _firstname(email_event: EmailEvent) -> str:
+    firstname = ' ' + email_event.question_email_package['from'].split()[0]
+    if '@' in firstname:
+        firstname = ''
+    return firstname
+
+
+def _raw_body(text: str) -> str:
+    return text.strip()
+
+
+async def _get_body(text: str):  # TODO build a classifier for this
+    with stage('extract'):
+        return await cpu_pool.run(_raw_body, extract_body, text)
+
+
+async def _respond_with_answer(email_event: EmailEvent, answer: dict):
     """
     In this case we just received an email to token@thecape.ai and found a saved reply to answer with.
     """
-    answer_text = answer["answerText"].replace("\n", "\r\n")
     email_original_text = email_event.question_email_package['body-plain']
-    email_from = f'Cape AI <{email_event.unique_id}+d@{MAILGUN_DOMAIN}>'
+    email_from = f"Cape AI <{_reply_address(email_event, 'd')}>"
     email_to = email_event.question_email_sender
     email_original_subject = email_event.question_email_package['subject']
-    firstname = ' ' + email_event.question_email_package['from'].split()[0]
-    if '@' in firstname:
-        firstname = ''
-    signature_text = '--<br />Sent by <a href="https://alpha.thecape.ai">Cape</a> AI<br /><br />'
-    email_to_correct = html.escape(f'"Cape AI" <{email_event.unique_id}+e@{MAILGUN_DOMAIN}>')
-    email_subject_correct = html.escape(email_original_subject)
-    email_body_correct = html.escape(email_original_text)
-    email_body_correct = email_body_correct.replace('\r\n', '%0D%0A')
-    signature_text += f'<small>If this answer does not answer your question, click <a href="mailto:{email_to_correct}?subject={email_subject_correct}&body={email_body_correct}">here</a>.</small>'
-    email_reply_text = f'Hello{firstname},<br /><br />{answer_text}<br /><br />{signature_text}<br /><br />'
-    _mailgun_reply(email_from, email_to, email_original_subject, email_original_text,
-                   email_event.question_email_timestamp, email_reply_text)
+    email_reply = await _render(_plain_answer, render_answer, _firstname(email_event), answer["answerText"],
+                                _reply_address(email_event, 'e'), email_original_subject, email_original_text)
+    await _mailgun_reply(email_from, email_to, email_original_subject, email_original_text,
+                         email_event.question_email_timestamp, email_reply, email_event.unique_id)
     email_event.final_email_saved_reply_id = answer['sourceId']
     email_event.final_email_sender = email_from
     email_event.final_email_timestamp = datetime.utcnow()
-    email_event.save()
 
 
-def _request_assistance(user: User, email_event: EmailEvent, answers: dict=None):
+async def _request_assistance(user: User, email_event: EmailEvent, answers: dict=None):
     """
     In this case we just received an email to token@thecape.ai and found several machine reading suggestions.
     """
-    firstname = ' ' + email_event.question_email_package['from'].split()[0]
-    if '@' in firstname:
-        firstname = ''
-
-    answer_text = f'Hello{firstname},<br /><br />==Cape AI Suggestions==<br /><br />'
-    if answers == None:
-        answer_text += ERROR_NO_SUGGESTIONS + "<br /><br />"
-    else:
-        for answer in answers:
-            if 'answerContext' in answer:
-                context = answer["answerContext"]
-                local_start_offset = answer['answerTextStartOffset'] - answer['answerContextStartOffset']
-                local_end_offset = answer['answerTextEndOffset'] - answer['answerContextStartOffset']
-                context = f'{context[:local_start_offset]}<b>{context[local_start_offset:local_end_offset]}</b>{context[local_end_offset:]}'
-            else:
-                context = answer['answerText']
-            if answer['sourceType'] == 'document':
-                answer_text += f'{context}<br /><br />According to document: ' \
-                               f'<a href="{UI_URL}/dashboard.html#/documents/{answer["sourceId"]}">{answer["sourceId"]}</a>' \
-                               f'<br /><br />'
-            elif answer['sourceType'] == 'saved_reply':
-                answer_text += f'{context}<br /><br />According to ' \
-                               f'<a href="{UI_URL}/dashboard.html#/saved-replies/{answer["sourceId"]}">saved reply</a>' \
-                               f'<br /><br />'
-    answer_text += f'==End Suggestions==<br /><br />'
-    answer_text += '--<br/>Sent by <a href="https://alpha.thecape.ai">Cape</a> AI<br /><br />'
-    email_from = f'Cape AI <{email_event.unique_id}+c@{MAILGUN_DOMAIN}>'  # the reply goes to 'c'
+    email_from = f"Cape AI <{_reply_address(email_event, 'c')}>"  # the reply goes to 'c'
     email_to = user.verified_email
     email_original_subject = email_event.question_email_package['subject']
     email_original_text = email_event.question_email_package['body-plain']
-    _mailgun_reply(email_from, email_to, email_original_subject, email_original_text,
-                   email_event.question_email_timestamp, answer_text)
+    email_reply = await _render(_plain_suggestions, render_suggestions, _firstname(email_event), answers)
+    if digest_queue.enabled:
+        quote_text, quote_html = await _render(_no_quote, render_quote, email_original_text,
+                                               email_event.question_email_timestamp, email_to)
+        await digest_queue.add(email_to, email_event.unique_id, _reply_address(email_event, 'c'),
+                               email_original_subject, email_reply[0] + quote_text, email_reply[1] + quote_html)
+    else:
+        await _mailgun_reply(email_from, email_to, email_original_subject, email_original_text,
+                             email_event.question_email_timestamp, email_reply, email_event.unique_id)
     email_event.suggested_email_results = answers
     email_event.suggested_email_sender = email_from
     email_event.suggested_email_timestamp = datetime.utcnow()
-    email_event.save()
 
 
-@_endpoint_route('/email/question')
-@respond_with_json
-@mailgun
-def email_question(request, user: User):
-    """In this case we received an email to token@thecape.ai"""
-    extracted_body = _get_body(request['args']['body-plain'])
-    email_event = EmailEvent(user_id=user.user_id, question_email_package=dict(request['args']),
+def _responder_items(request):
+    """Blocking responder call, returns the answer items or None if it failed."""
+    response = json.loads(responder_answer(request).body)
+    return response['result']['items'] if response['success'] else None
+
+
+answer_batcher = AnswerBatcher(_responder_items)
+
+
+async def _get_answers(request):
+    """
+    Answer from the cache or run the responder on the answer pool, coalescing bursts of questions per token when
+    batching is enabled.
+    """
+    with stage('answer'):
+        cache_key = answer_cache.key(request['args']['token'], request['args']['question'],
+                                     request['args']['numberofitems'], request['args'].get('offset', '0'))
+        answers = answer_cache.get(cache_key)
+        if answers is not None:
+            return answers
+        if answer_batcher.enabled:
+            answers = await answer_batcher.answer(request)
+        else:
+            answers = await answer_queue.run_blocking(_responder_items, request)
+        if answers is not None:
+            answer_cache.set(cache_key, answers)
+        return answers
+
+
+async def _ingest_attachments(request, user: User, email_event: EmailEvent) -> list:
+    """
+    Upload the text attachments of an email the account owner sent to their own token as documents. The owner is
+    recognised by their verified email, and only if Mailgun's SPF or DKIM check passed.
+    """
+    args = request['args']
+    if not EMAIL_ATTACHMENTS or sender_address(args) != (user.verified_email or '').lower():
+        return []
+    if not sender_authenticated(args):
+        warning("Ignoring attachments of %s: SPF and DKIM checks did not pass" % email_event.unique_id)
+        return []
+    message_id = args.get('Message-Id') or email_event.unique_id
+    document_prefix = 'email-' + hashlib.sha1(message_id.encode()).hexdigest()[:16]
+    with stage('attachments'):
+        results = await answer_queue.run_blocking(ingest_attachments, request, document_prefix)
+    if any(result['documentIds'] for result in results):
+        answer_cache.invalidate_user(user.token)
+    for result in results:
+        info("Attachment %s of %s: %s %s" % (result['name'], email_event.unique_id, result['status'],
+                                             result['documentIds']))
+    return results
+
+
+async def _answer_question(request, user: User, email_event: EmailEvent):
+    with job_trace(request):
+        ingested = await _ingest_attachments(request, user, email_event)
+        if ingested and not request['args']['question'].strip():
+            await save_event(email_event)  # the email only carried documents
+            return
+        answers = await _get_answers(request)
+        if not answers:
+            await _request_assistance(user, email_event, None)
+        elif answers[0]['sourceType'] == 'saved_reply':
+            await _respond_with_answer(email_event, answers[0])
+        else:
+            await _request_assistance(user, email_event, answers)
+        await save_event(email_event)
+
+
+async def _correction_answers(request, email_event: EmailEvent):
+    """
+    Suggestions for a correction request without the answer Bob rejected. When Bob asks the original question again
+    the results found for it (sent to Alice, or still in the answer cache) are reused and the responder is only asked
+    for the candidates needed to replace the rejected one, using an offset past the results already known. Otherwise
+    the responder is asked for one result more than needed, so the rejected answer can be left out in a single call.
+    """
+    args = request['args']
+    original_question = bounded_question(email_event.question_email_extracted_body or '')
+    wanted = int(args['numberofitems'])
+    known = None
+    if not args['question'].strip() or normalize_question(args['question']) == normalize_question(original_question):
+        args['question'] = original_question
+        known = email_event.suggested_email_results
+        if known is None:
+            known = answer_cache.get(answer_cache.key(args['token'], original_question, args['numberofitems']))
+    rejected = email_event.final_email_saved_reply_id
+    asked = wanted
+    if known is None:  # ask for one more up front, the rejected answer is usually among the results
+        asked = wanted + 1 if rejected else wanted
+        args['numberofitems'] = str(asked)
+        known = await _get_answers(request) or []
+    candidates = [answer for answer in known if answer.get('sourceId') != rejected]
+    if len(candidates) < wanted and len(known) >= asked:  # fewer results than asked for means there are no more
+        seen = {(answer.get('sourceId'), answer.get('answerText')) for answer in candidates}
+        args['offset'] = str(len(known))
+        args['numberofitems'] = str(wanted - len(candidates))
+        for answer in await _get_answers(request) or []:
+            if answer.get('sourceId') != rejected and (answer.get('sourceId'), answer.get('answerText')) not in seen:
+                candidates.append(answer)
+    args['numberofitems'] = str(wanted)
+    return candidates[:wanted] or None
+
+
+async def _answer_correction(request, user: User, email_event: EmailEvent):
+    with job_trace(request):
+        await _request_assistance(user, email_event, await _correction_answers(request, email_event))
+        await save_event(email_event)
+
+
+async def _dispatch(job, *args):
+    """Answer on the job queue when EMAIL_ASYNC_ANSWERS is set, so the webhook can be acknowledged right away."""
+    if EMAIL_ASYNC_ANSWERS:
+        await answer_queue.submit(job, *args)
+    else:
+        await job(*args)
+
+
+async def _question_event(request, user: User) -> EmailEvent:
+    extracted_body = await _get_body(request['args'].get('body-plain', ''))
+    email_event = EmailEvent(user_id=user.user_id, question_email_package=compact_package(request['args']),
                              question_email_extracted_body=extracted_body,
                              question_email_sender=request['args']['from'],
                              question_email_timestamp=datetime.utcfromtimestamp(int(request['args']['timestamp'])))
-    email_event.save()
-    if user.forward_email == DEFAULT_EMAIL:
-        mailgun_send(request['args']['to'], request['args']['from'], request['args']['subject'],
-                     ERROR_EMAIL_UNCONFIGURED)
-        return {"success": False, "emailHandled": True}
-    if user.verified_email is None:
-        mailgun_send(request['args']['to'], request['args']['from'], request['args']['subject'],
-                     ERROR_EMAIL_UNVALIDATED)
+    request['trace'].unique_id = email_event.unique_id
+    return email_event
+
+
+@_endpoint_route('/email/question')
+@respond_with_json_async
+@mailgun
+async def email_question(request, user: User):
+    """In this case we received an email to token@thecape.ai"""
+    if user.forward_email == DEFAULT_EMAIL or user.verified_email is None:
+        user = refresh_user(user)  # the cached user may predate the forward email being set up or verified
+    if user.forward_email == DEFAULT_EMAIL or user.verified_email is None:
+        # Stored as received: the body of a store and notify message is not fetched just to reject it
+        email_event = await _question_event(request, user)
+        await save_event(email_event)
+        error = ERROR_EMAIL_UNCONFIGURED if user.forward_email == DEFAULT_EMAIL else ERROR_EMAIL_UNVALIDATED
+        await mailgun_send(request['args']['to'], request['args']['from'], request['args']['subject'], error,
+                           email_event.unique_id)
         return {"success": False, "emailHandled": True}
 
+    await fetch_message(request)
+    email_event = await _question_event(request, user)
+    extracted_body = email_event.question_email_extracted_body
     request['args']['token'] = user.token
-    request['args']['question'] = extracted_body
+    request['args']['question'] = bounded_question(extracted_body)
     request['args']['numberofitems'] = '3'
-    response = json.loads(responder_answer(request).body)
-    if response['success']:
-        answers = response['result']['items']
-        if len(answers) == 0:
-            _request_assistance(user, email_event, None)
-        elif answers[0]['sourceType'] == 'saved_reply':
-            _respond_with_answer(email_event, answers[0])
-        else:
-            _request_assistance(user, email_event, answers)
-    else:
-        _request_assistance(user, email_event, None)
+    # stored before the webhook is acknowledged and before any reply pointing at it is spooled
+    await save_event(email_event, durable=True)
+    await _dispatch(_answer_question, request, user, email_event)
 
     return {"success": True, "emailHandled": True}
 
 
 @_endpoint_route('/email/new-reply')
-@respond_with_json
+@respond_with_json_async
 @mailgun
-def email_new_reply(request, user: User, email_event: EmailEvent):
+async def email_new_reply(request, user: User, email_event: EmailEvent):
     """In this case Alice has corrected the email, we create a new saved reply and send Alice's mail."""
-    answerText = _get_body(request['args']['body-plain'])
-    request['args']['question'] = email_event.question_email_extracted_body
-    request['args']['answer'] = answerText
-    email_from = f'Cape AI <{email_event.unique_id}+c@{MAILGUN_DOMAIN}>'
+    email_from = f"Cape AI <{_reply_address(email_event, 'c')}>"
 
     # Verify that this email came from the verified_email address
     match = re.search("(?:<(.*)>|^([^<].*[^> ])$)", request['args']['from'])
@@ -272,37 +519,83 @@ def email_new_reply(request, user: User, email_event: EmailEvent):
         return {"success": False, "emailHandled": True}
 
     if sender != user.verified_email:
-        mailgun_send(email_from, sender, request['args']['subject'], ERROR_UNRECOGNISED_SENDER % sender)
+        user = refresh_user(user)
+    if sender != user.verified_email:
+        await mailgun_send(email_from, sender, request['args']['subject'], ERROR_UNRECOGNISED_SENDER % sender,
+                           email_event.unique_id)
         return {"success": False, "emailHandled": True}
 
+    await fetch_message(request)
+    answerText = await _get_body(request['args']['body-plain'])
+    request['args']['question'] = bounded_question(email_event.question_email_extracted_body)
+    request['args']['answer'] = answerText
     try:
-        reply_id = json.loads(create_saved_reply(request).body)['result']['replyId']
+        response = await answer_queue.run_blocking(create_saved_reply, request)  # may import the backend first
+        reply_id = json.loads(response.body)['result']['replyId']
+        answer_cache.invalidate_user(user.token)
         answer = {
             'sourceId': reply_id,
             'answerText': answerText
         }
-        _respond_with_answer(email_event, answer)
+        await _respond_with_answer(email_event, answer)
+        await save_event(email_event)
     except UserException as e:
-        mailgun_send(email_from, user.verified_email, request['args']['subject'], e)
+        await mailgun_send(email_from, user.verified_email, request['args']['subject'], str(e), email_event.unique_id)
 
     return {"success": True, "emailHandled": True}
 
 
 @_endpoint_route('/email/request-correction')
-@respond_with_json
+@respond_with_json_async
 @mailgun
-def email_request_correction(request, user: User, email_event: EmailEvent):
+async def email_request_correction(request, user: User, email_event: EmailEvent):
     """Bob didn't think the answer was correct, so we email Alice for a correction."""
-    extracted_body = _get_body(request['args']['body-plain'])
+    await fetch_message(request)
+    extracted_body = await _get_body(request['args']['body-plain'])
     request['args']['token'] = user.token
-    request['args']['question'] = extracted_body
+    request['args']['question'] = bounded_question(extracted_body)
     request['args']['numberofitems'] = '3'
-    response = json.loads(responder_answer(request).body)
-    if response['success']:
-        answers = response['result']['items']
-        _request_assistance(user, email_event, answers)
-    else:
-        _request_assistance(user, email_event, None)
+    await _dispatch(_answer_correction, request, user, email_event)
 
     return {"success": True, "emailHandled": True}
 
+
+def monitoring(wrapped):
+    """
+    Decorator for the monitoring endpoints, which expose queue depths, drop reasons and backend state: they are only
+    served to callers presenting EMAIL_MONITORING_KEY and not at all when it is unset.
+    """
+
+    @wraps(wrapped)
+    def decorated(request, *args, **kwargs):
+        if not EMAIL_MONITORING_KEY:
+            return text('Not found', status=404)
+        authorization = (getattr(request, 'headers', None) or {}).get('Authorization', '')
+        if authorization.startswith('Bearer '):
+            key = authorization[len('Bearer '):]
+        else:
+            key = (request.get('args') or {}).get('monitoringKey', '')
+        if not hmac.compare_digest(key.encode(), EMAIL_MONITORING_KEY.encode()):
+            return text('Forbidden', status=403)
+        return wrapped(request, *args, **kwargs)
+
+    return decorated
+
+
+@_endpoint_route('/email/stats')
+@monitoring
+@respond_with_json
+def email_stats(request):
+    """Queue depth and latency figures for monitoring."""
+    return {'answerQueue': answer_queue.stats(), 'answerBatcher': answer_batcher.stats(),
+            'answerCache': answer_cache.stats(), 'userCache': user_cache.stats(), 'eventCache': event_cache.stats(),
+            'idempotency': idempotency_store.stats(), 'filter': mail_filter.stats(),
+            'cpuPool': cpu_pool.stats(), 'eventWriter': event_writer.stats(),
+            'backend': email_backend.stats()}
+
+
+@_endpoint_route('/email/metrics')
+@monitoring
+def email_metrics(request):
+    """Stage timings and request counts in the Prometheus text format."""
+    return text(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,172 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import re
+import time
+from typing import Optional, Tuple
+
+from cape_email_plugin.cache import TTLCache
+from cape_email_plugin.email_settings import MAILGUN_DOMAIN, EMAIL_DROP_AUTO_REPLIES, EMAIL_TOKEN_RATE, \
+    EMAIL_TOKEN_BURST, EMAIL_SENDER_RATE, EMAIL_SENDER_BURST, EMAIL_RATE_LIMIT_BUCKETS, EMAIL_DROP_PRECEDENCE
+
+DROP = 'drop'
+DEFER = 'defer'
+
+ERROR_EMAIL_RATE_LIMITED = 'Too many emails for this Cape AI account, please try again later.'
+
+_AUTOREPLY_HEADERS = ('x-autoreply', 'x-autorespond', 'x-autoresponder')
+_BOUNCE_SENDERS = {'mailer-daemon', 'postmaster'}
+
+
+def _headers(args: dict) -> dict:
+    """Lower cased header names to values, from Mailgun's message-headers list and the top level fields."""
+    headers = {}
+    try:
+        for name, value in json.loads(args.get('message-headers') or '[]'):
+            headers.setdefault(name.lower(), value)
+    except (TypeError, ValueError):
+        pass
+    for name, value in args.items():
+        headers.setdefault(name.lower(), value)
+    return headers
+
+
+def sender_address(args: dict) -> str:
+    """Lower cased address the email came from."""
+    sender = args.get('sender') or args.get('from') or ''
+    match = re.search(r'<([^>]*)>', sender)
+    return (match.group(1) if match else sender).strip().lower()
+
+
+def automated_reason(args: dict) -> Optional[str]:
+    """Why the email looks machine generated (RFC 3834 headers, vendor auto-reply headers, bounces), if it does."""
+    headers = _headers(args)
+    auto_submitted = headers.get('auto-submitted', 'no').strip().lower()
+    if auto_submitted != 'no':
+        return f'Auto-Submitted: {auto_submitted}'
+    for name in _AUTOREPLY_HEADERS:
+        if name in headers:
+            return name
+    precedence = headers.get('precedence', '').strip().lower()
+    if precedence in EMAIL_DROP_PRECEDENCE:
+        return f'Precedence: {precedence}'
+    if 'x-failed-recipients' in headers or headers.get('return-path', '').strip() == '<>':
+        return 'bounce'
+    sender = sender_address(args)
+    if sender.split('@')[0] in _BOUNCE_SENDERS:
+        return 'bounce'
+    if sender.endswith('@' + MAILGUN_DOMAIN.lower()):
+        return 'sent by Cape'
+    return None
+
+
+def _mailgun_headers(args: dict) -> dict:
+    """
+    Lower cased names to values of the headers Mailgun added to the email. Mailgun prepends them above its own
+    Received header, every header from the first Received on was written by the sender or the hosts on the way.
+    """
+    headers = {}
+    try:
+        for name, value in json.loads(args.get('message-headers') or '[]'):
+            if name.lower() == 'received':
+                break
+            headers.setdefault(name.lower(), value)
+    except (TypeError, ValueError):
+        pass
+    return headers
+
+
+def sender_authenticated(args: dict) -> bool:
+    """
+    Whether Mailgun's SPF or DKIM check of the email passed, the From header alone is easily forged. The verdict is
+    only taken from the headers Mailgun added, a sender can write these headers too.
+    """
+    headers = _mailgun_headers(args)
+    return 'pass' in (headers.get('x-mailgun-spf', '').strip().lower(),
+                      headers.get('x-mailgun-dkim-check-result', '').strip().lower())
+
+
+class RateLimiter:
+    """
+    Token buckets refilled at rate per minute up to burst, one per key. Buckets are kept in an LRU bounded to
+    maxsize and expire once they would be full again, so a missing bucket is simply a full one.
+    """
+
+    def __init__(self, rate: float, burst: int, maxsize: int = EMAIL_RATE_LIMIT_BUCKETS):
+        self.rate = rate / 60
+        self.burst = burst
+        self._buckets = TTLCache(maxsize, burst / self.rate if self.rate > 0 else 0)
+        self.limited = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def allow(self, key: str) -> bool:
+        if not self.enabled:
+            return True
+        now = time.monotonic()
+        tokens, last = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.limited += 1
+            return False
+        self._buckets.set(key, (tokens - 1, now))
+        return True
+
+
+class MailFilter:
+    """
+    Cheap checks run on every webhook before any database access or responder call.
+    Auto-replies, bounces and senders flooding us are dropped, questions beyond a token's rate are deferred so
+    Mailgun delivers them again later. Replies to plus addresses (saved replies and corrections from the owner) over
+    the sender rate are deferred too rather than dropped, a burst of answers to a digest is legitimate.
+    """
+
+    def __init__(self, drop_automated: bool = EMAIL_DROP_AUTO_REPLIES,
+                 token_limiter: RateLimiter = None, sender_limiter: RateLimiter = None):
+        self.drop_automated = drop_automated
+        self.token_limiter = token_limiter or RateLimiter(EMAIL_TOKEN_RATE, EMAIL_TOKEN_BURST)
+        self.sender_limiter = sender_limiter or RateLimiter(EMAIL_SENDER_RATE, EMAIL_SENDER_BURST)
+        self.dropped = {}
+        self.deferred = 0
+
+    def check(self, args: dict, local_part: str) -> Tuple[Optional[str], Optional[str]]:
+        """Returns (DROP or DEFER, reason), or (None, None) to let the email through."""
+        if self.drop_automated:
+            reason = automated_reason(args)
+            if reason is not None:
+                return self._drop(reason)
+        if not self.sender_limiter.allow(sender_address(args)):
+            if '+' in local_part:
+                return self._defer('sender rate limit')
+            return self._drop('sender rate limit')
+        if '+' not in local_part and not self.token_limiter.allow(local_part):
+            return self._defer('token rate limit')
+        return None, None
+
+    def _defer(self, reason: str):
+        self.deferred += 1
+        return DEFER, reason
+
+    def _drop(self, reason: str):
+        self.dropped[reason] = self.dropped.get(reason, 0) + 1
+        return DROP, reason
+
+    def stats(self) -> dict:
+        return {'dropped': dict(self.dropped), 'deferred': self.deferred}
+
+
+mail_filter = MailFilter()
@@ -0,0 +1,193 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Retention and queries for the EmailEvent history.
+
+Events older than the retention period are compacted: the full row is appended to a gzip compressed JSON lines
+archive, then the stored package is reduced to the fields replies to the event still need (the body only as much of
+it as is ever quoted) and the suggestions lose their contexts. Compacted packages name the archive holding the
+original so support can find it. Queries by unique_id and by user_id over a timestamp range use the indexes
+created by ensure_indexes(), run it once per database:
+    cape-email-history indexes
+    cape-email-history compact --days 180 --archive-dir /var/lib/cape/email-archive
+    cape-email-history events --user-id alice --since 2018-05-01 --until 2018-06-01
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+from typing import Iterator, List
+
+from cape_email_plugin.email_package import PACKAGE_FIELDS
+from cape_email_plugin.email_settings import EMAIL_RETENTION_DAYS, EMAIL_ARCHIVE_DIR, EMAIL_QUOTE_MAX_CHARS
+from userdb.email_event import EmailEvent
+
+COMPACTED_KEY = 'compacted'
+# Everything stored on an EmailEvent, as archived
+EVENT_FIELDS = ('unique_id', 'user_id', 'question_email_package', 'question_email_extracted_body',
+                'question_email_sender', 'question_email_timestamp', 'suggested_email_results',
+                'suggested_email_sender', 'suggested_email_timestamp', 'final_email_saved_reply_id',
+                'final_email_sender', 'final_email_timestamp')
+# What render_suggestions needs of a suggestion once its context is gone
+_SUGGESTION_FIELDS = ('sourceType', 'sourceId', 'answerText')
+
+
+def ensure_indexes(model=EmailEvent):
+    """Create the indexes the lookups below rely on, if they do not exist yet."""
+    model.add_index(model.unique_id)
+    model.add_index(model.user_id, model.question_email_timestamp)
+    model._schema.create_indexes(safe=True)
+
+
+def event_by_id(unique_id: str, model=EmailEvent):
+    return model.select().where(model.unique_id == unique_id).first()
+
+
+def user_events(user_id: str, since: datetime = None, until: datetime = None, limit: int = None,
+                model=EmailEvent) -> Iterator:
+    """Events of a user received in [since, until), oldest first."""
+    query = model.select().where(model.user_id == user_id)
+    if since is not None:
+        query = query.where(model.question_email_timestamp >= since)
+    if until is not None:
+        query = query.where(model.question_email_timestamp < until)
+    query = query.order_by(model.question_email_timestamp)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.iterator()
+
+
+def event_record(email_event) -> dict:
+    """Every stored field of an event, JSON serialisable."""
+    record = {}
+    for field in EVENT_FIELDS:
+        value = getattr(email_event, field, None)
+        record[field] = value.isoformat() if isinstance(value, datetime) else value
+    return record
+
+
+def is_compacted(email_event) -> bool:
+    return COMPACTED_KEY in (email_event.question_email_package or {})
+
+
+def compact_event(email_event, archive_name: str, max_body_chars: int = EMAIL_QUOTE_MAX_CHARS):
+    """Strip an event down in place to what replies to it use, recording where the original was archived."""
+    package = email_event.question_email_package or {}
+    compacted = {field: package[field] for field in PACKAGE_FIELDS if field in package}
+    if 'body-plain' in compacted:
+        compacted['body-plain'] = compacted['body-plain'][:max_body_chars]
+    compacted[COMPACTED_KEY] = archive_name
+    email_event.question_email_package = compacted
+    if email_event.suggested_email_results:
+        email_event.suggested_email_results = [{field: answer[field] for field in _SUGGESTION_FIELDS if field in answer}
+                                               for answer in email_event.suggested_email_results]
+
+
+def _old_events(before: datetime, batch_size: int, model) -> Iterator[List]:
+    """Batches of the events received before a date, paging on (timestamp, unique_id) rather than offsets."""
+    last = None
+    while True:
+        query = model.select().where(model.question_email_timestamp < before)
+        if last is not None:
+            timestamp, unique_id = last
+            query = query.where((model.question_email_timestamp > timestamp) |
+                                ((model.question_email_timestamp == timestamp) & (model.unique_id > unique_id)))
+        batch = list(query.order_by(model.question_email_timestamp, model.unique_id).limit(batch_size))
+        if not batch:
+            return
+        yield batch
+        last = batch[-1].question_email_timestamp, batch[-1].unique_id
+
+
+def compact_history(days: int = EMAIL_RETENTION_DAYS, archive_dir: str = EMAIL_ARCHIVE_DIR, batch_size: int = 500,
+                    dry_run: bool = False, now: datetime = None, model=EmailEvent) -> dict:
+    """
+    Archive and compact the events received more than days ago, returns counts and the archive written.
+    Each batch is appended to the archive and flushed before the events are updated, in one transaction per batch,
+    so an interrupted run loses nothing and the next run picks up the events left uncompacted.
+    """
+    before = (now or datetime.utcnow()) - timedelta(days=days)
+    archive_name = f'email-events-{before:%Y%m%d}-{(now or datetime.utcnow()):%Y%m%d%H%M%S}.jsonl.gz'
+    archive_path = os.path.join(archive_dir, archive_name)
+    counts = {'scanned': 0, 'compacted': 0, 'before': before.isoformat(), 'archive': None}
+    archive = None
+    try:
+        for batch in _old_events(before, batch_size, model):
+            counts['scanned'] += len(batch)
+            batch = [email_event for email_event in batch if not is_compacted(email_event)]
+            if not batch or dry_run:
+                counts['compacted'] += len(batch)
+                continue
+            if archive is None:
+                os.makedirs(archive_dir, exist_ok=True)
+                archive = gzip.open(archive_path, 'at', encoding='utf-8')
+                counts['archive'] = archive_path
+            for email_event in batch:
+                archive.write(json.dumps(event_record(email_event), separators=(',', ':'), default=str) + '\n')
+            archive.flush()
+            with model._meta.database.atomic():
+                for email_event in batch:
+                    compact_event(email_event, archive_name)
+                    email_event.save()
+            counts['compacted'] += len(batch)
+    finally:
+        if archive is not None:
+            archive.close()
+    return counts
+
+
+def _date(text: str) -> datetime:
+    return datetime.strptime(text, '%Y-%m-%d')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    commands.add_parser('indexes', help='create the indexes used by the lookups')
+    compact = commands.add_parser('compact', help='archive and compact old events')
+    compact.add_argument('--days', type=int, default=EMAIL_RETENTION_DAYS, help='events older than this are compacted')
+    compact.add_argument('--archive-dir', default=EMAIL_ARCHIVE_DIR)
+    compact.add_argument('--batch-size', type=int, default=500)
+    compact.add_argument('--dry-run', action='store_true', help='only count the events that would be compacted')
+    events = commands.add_parser('events', help='print events as JSON lines')
+    events.add_argument('--unique-id')
+    events.add_argument('--user-id')
+    events.add_argument('--since', type=_date, help='YYYY-MM-DD, inclusive')
+    events.add_argument('--until', type=_date, help='YYYY-MM-DD, exclusive')
+    events.add_argument('--limit', type=int)
+    options = parser.parse_args(argv)
+    if options.command == 'indexes':
+        ensure_indexes()
+    elif options.command == 'compact':
+        json.dump(compact_history(options.days, options.archive_dir, options.batch_size, options.dry_run),
+                  sys.stdout, indent=2)
+        print()
+    elif options.unique_id:
+        email_event = event_by_id(options.unique_id)
+        if email_event is not None:
+            print(json.dumps(event_record(email_event), default=str))
+    elif options.user_id:
+        for email_event in user_events(options.user_id, options.since, options.until, options.limit):
+            print(json.dumps(event_record(email_event), default=str))
+    else:
+        parser.error('events needs --unique-id or --user-id')
+
+
+if __name__ == '__main__':
+    main()
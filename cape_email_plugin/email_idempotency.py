@@ -0,0 +1,73 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from logging import info
+
+from cape_email_plugin.cache import TTLCache
+from cape_email_plugin.email_settings import EMAIL_IDEMPOTENCY_SIZE, EMAIL_IDEMPOTENCY_TTL
+
+
+class IdempotencyStore:
+    """
+    Remembers the result of every webhook under its Message-Id and under its signature token/timestamp pair.
+
+    A webhook matching either key is a redelivery or a replayed signature: it gets the stored result, or waits for
+    the first delivery if that one is still running, without doing any work. Failed webhooks are forgotten so
+    Mailgun's retry is processed normally.
+    """
+
+    def __init__(self, maxsize: int = EMAIL_IDEMPOTENCY_SIZE, ttl: float = EMAIL_IDEMPOTENCY_TTL):
+        self._cache = TTLCache(maxsize, ttl)
+        self.duplicates = 0
+
+    @staticmethod
+    def keys(request, endpoint: str) -> list:
+        args = request['args']
+        keys = [('signature', args['token'], args['timestamp'])]
+        message_id = args.get('Message-Id') or args.get('message-id')
+        if message_id:
+            keys.append(('message', endpoint, message_id, args.get('recipient')))
+        return keys
+
+    async def run(self, keys: list, job):
+        for key in keys:
+            previous = self._cache.get(key)
+            if previous is not None:
+                self.duplicates += 1
+                info("Ignoring redelivered webhook %s" % (key,))
+                if isinstance(previous, asyncio.Future):
+                    return await asyncio.shield(previous)
+                return previous
+        future = asyncio.get_event_loop().create_future()
+        for key in keys:
+            self._cache.set(key, future)
+        try:
+            result = await job()
+        except BaseException as e:
+            for key in keys:
+                self._cache.pop(key)
+            future.set_exception(e)
+            future.exception()  # duplicates waiting on the first delivery re-raise it, nobody else needs to
+            raise
+        for key in keys:
+            self._cache.set(key, result)
+        future.set_result(result)
+        return result
+
+    def stats(self) -> dict:
+        return dict(self._cache.stats(), duplicates=self.duplicates)
+
+
+idempotency_store = IdempotencyStore()
@@ -0,0 +1,96 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Size caps applied to inbound webhooks before anything else reads them.
+
+Bodies are cut to EMAIL_MAX_BODY_CHARS and every other field to EMAIL_MAX_FIELD_CHARS as soon as the signature is
+verified (or the stored message fetched), so extraction, rendering, the stored EmailEvent and the emails sent back
+only ever see bounded text. What was cut is recorded in the payload under TRUNCATED_FIELD (a dict, unlike the string
+fields Mailgun posts, so a header of that name is discarded), which ends up with the stored package, in the request
+trace and in a Prometheus counter. Questions given to the responder are further
+bounded to EMAIL_MAX_QUESTION_CHARS.
+"""
+
+import json
+
+from cape_email_plugin.email_metrics import current_trace, truncated_chars_total
+from cape_email_plugin.email_settings import EMAIL_MAX_BODY_CHARS, EMAIL_MAX_FIELD_CHARS, EMAIL_MAX_QUESTION_CHARS
+
+TRUNCATED_FIELD = 'cape-truncated'
+BODY_FIELDS = {'body-plain', 'body-html', 'stripped-text', 'stripped-html', 'stripped-signature'}
+# Checked against the signature, cutting them would change their meaning
+_KEPT_FIELDS = {'token', 'timestamp', 'signature'}
+# JSON lists, cut by dropping their last entries so that they can still be parsed
+_LIST_FIELDS = {'message-headers', 'attachments'}
+
+
+def truncate(text: str, max_chars: int) -> str:
+    """The start of text within max_chars, cut at the end of a line unless that loses more than half of it."""
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind('\n', 0, max_chars + 1)
+    return text[:cut if cut >= max_chars // 2 else max_chars]
+
+
+def _truncate_list(value: str, max_chars: int) -> str:
+    """A JSON list (message-headers, attachments) without the entries past max_chars."""
+    try:
+        entries = json.loads(value)
+    except ValueError:
+        return truncate(value, max_chars)
+    if not isinstance(entries, list):
+        return truncate(value, max_chars)
+    kept, size = [], 2
+    for entry in entries:
+        size += len(json.dumps(entry)) + 2
+        if size > max_chars:
+            break
+        kept.append(entry)
+    return json.dumps(kept)
+
+
+def cap_fields(args: dict, max_body_chars: int = EMAIL_MAX_BODY_CHARS,
+               max_field_chars: int = EMAIL_MAX_FIELD_CHARS) -> dict:
+    """
+    Truncate the oversized string fields of a webhook payload in place.
+    Returns the original length of every field that was cut, also merged into args[TRUNCATED_FIELD].
+    """
+    if not isinstance(args.get(TRUNCATED_FIELD, {}), dict):  # posted by the sender as a header, not recorded by us
+        del args[TRUNCATED_FIELD]
+    cut = {}
+    for field, value in args.items():
+        if isinstance(value, str) and field not in _KEPT_FIELDS:
+            max_chars = max_body_chars if field in BODY_FIELDS else max_field_chars
+            if max_chars > 0 and len(value) > max_chars:
+                args[field] = _truncate_list(value, max_chars) if field in _LIST_FIELDS else \
+                    truncate(value, max_chars)
+                cut[field] = len(value)
+    if cut:
+        args.setdefault(TRUNCATED_FIELD, {}).update(cut)
+        trace = current_trace()
+        endpoint = trace.endpoint if trace is not None else 'background'
+        for field, length in cut.items():
+            truncated_chars_total.inc((endpoint, field), length - len(args[field]))
+        if trace is not None:
+            trace.truncated.update(cut)
+    return cut
+
+
+def bounded_question(text: str, max_chars: int = EMAIL_MAX_QUESTION_CHARS) -> str:
+    """The question as given to the responder, cut at a word boundary when longer than max_chars."""
+    if max_chars <= 0 or len(text) <= max_chars:
+        return text
+    cut = text.rfind(' ', 0, max_chars + 1)
+    return text[:cut if cut >= max_chars // 2 else max_chars].rstrip()
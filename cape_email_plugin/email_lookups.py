@@ -0,0 +1,135 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Optional
+
+from api_helpers.exceptions import UserException
+from api_helpers.text_responses import INVALID_TOKEN
+from cape_email_plugin.cache import TTLCache
+from cape_email_plugin.email_metrics import stage
+from cape_email_plugin.event_writer import EventWriter
+from cape_email_plugin.email_settings import EMAIL_USER_CACHE_SIZE, EMAIL_USER_CACHE_TTL, EMAIL_EVENT_CACHE_SIZE, \
+    EMAIL_EVENT_CACHE_TTL
+from userdb.email_event import EmailEvent
+from userdb.user import User
+
+user_cache = TTLCache(EMAIL_USER_CACHE_SIZE, EMAIL_USER_CACHE_TTL)
+event_cache = TTLCache(EMAIL_EVENT_CACHE_SIZE, EMAIL_EVENT_CACHE_TTL)
+
+
+def _cache_user(user: User):
+    user_cache.set(('token', user.token), user)
+    user_cache.set(('user_id', user.user_id), user)
+
+
+def get_user(field: str, value: str) -> Optional[User]:
+    """User.get through the user cache, unknown users are not cached so new accounts are seen straight away."""
+    user = user_cache.get((field, value))
+    if user is None:
+        user = User.get(field, value)
+        if user is not None:
+            _cache_user(user)
+    return user
+
+
+def refresh_user(user: User) -> User:
+    """Reload a user from the database, used before rejecting an email because of the user's email settings."""
+    invalidate_user(user)
+    return get_user('user_id', user.user_id) or user
+
+
+def invalidate_user(user: User):
+    user_cache.pop(('token', user.token))
+    user_cache.pop(('user_id', user.user_id))
+
+
+def get_event(unique_id: str) -> Optional[EmailEvent]:
+    email_event = event_cache.get(unique_id) or event_writer.pending(unique_id)
+    if email_event is None:
+        email_event = EmailEvent.get('unique_id', unique_id)
+        if email_event is not None:
+            event_cache.set(unique_id, email_event)
+    return email_event
+
+
+class LazyEvent:
+    """
+    Stands in for the EmailEvent of a signed reply address, which already gives its unique_id and user_id.
+    The event is read on first access to any other attribute, through get_event(), failing like an unknown reply
+    address if it does not exist.
+    """
+
+    def __init__(self, unique_id: str, user_id: str):
+        self.__dict__.update(unique_id=unique_id, user_id=user_id, _event=None)
+
+    def load(self) -> EmailEvent:
+        if self._event is None:
+            email_event = get_event(self.unique_id)
+            if email_event is None:
+                raise UserException(INVALID_TOKEN % self.unique_id)
+            self.__dict__['_event'] = email_event
+        return self._event
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.load(), name, value)
+
+
+def _save(email_event: EmailEvent):
+    """
+    Insert a new event, or update only the fields set since an existing one was read or last saved. The copies kept
+    in event_cache and event_writer would otherwise write every column back, undoing a compact_history run.
+    """
+    if email_event._pk is None:
+        email_event.save()
+    elif email_event.dirty_fields:
+        email_event.save(only=email_event.dirty_fields)
+
+
+def _write_events(email_events: list):
+    """
+    Write a batch of events in one transaction. Saving an event sets its primary key and clears its changed fields
+    even if the transaction is then rolled back, both are restored on failure so that the retry writes them again.
+    """
+    unsaved = [(email_event, email_event._pk, set(email_event._dirty)) for email_event in email_events]
+    try:
+        with stage('save'), EmailEvent._meta.database.atomic():
+            for email_event in email_events:
+                _save(email_event)
+    except BaseException:
+        for email_event, pk, dirty in unsaved:
+            email_event._pk = pk
+            email_event._dirty |= dirty
+        raise
+
+
+event_writer = EventWriter(_write_events)
+
+
+async def save_event(email_event: EmailEvent, durable: bool = False):
+    """
+    Write the event, through event_writer when it runs unless durable is set, and keep the cached copy in step
+    with it.
+    """
+    if isinstance(email_event, LazyEvent):
+        email_event = email_event.load()
+    if event_writer.running and not durable:
+        await event_writer.add(email_event)
+    else:
+        event_writer.discard(email_event.unique_id)
+        with stage('save'):
+            _save(email_event)
+    event_cache.set(email_event.unique_id, email_event)
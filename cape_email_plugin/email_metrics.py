@@ -0,0 +1,201 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-stage timings of the email webhooks.
+
+Every webhook runs inside a RequestTrace, code on the hot path wraps its expensive steps in stage(name). Each stage
+is observed in a Prometheus histogram labelled with the endpoint and the stage, and added to the trace, which is
+logged as one JSON line carrying the EmailEvent unique_id when the webhook or answer job completes.
+The current trace is tracked per asyncio task, so stages need no extra arguments.
+"""
+
+import asyncio
+import json
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from logging import info
+from weakref import WeakKeyDictionary
+
+from cape_email_plugin.email_settings import EMAIL_METRICS
+
+_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+_current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+_traces = WeakKeyDictionary()
+
+
+def _running_task():
+    try:
+        return _current_task()
+    except RuntimeError:  # no event loop in this thread
+        return None
+
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+
+    def __init__(self, name: str, documentation: str, label_names: tuple):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.label_names, labels)} {value}')
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name: str, documentation: str, label_names: tuple, buckets: tuple = _BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # labels -> [count per bucket (the last one is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, (counts, total) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    bucket = f'le="{bound}"'
+                    lines.append(f'{self.name}_bucket{_labels(self.label_names, labels, bucket)} {cumulative}')
+                lines.append(f'{self.name}_sum{_labels(self.label_names, labels)} {total}')
+                lines.append(f'{self.name}_count{_labels(self.label_names, labels)} {cumulative}')
+        return lines
+
+
+stage_seconds = Histogram('cape_email_stage_seconds', 'Time spent in each stage of the email webhooks.',
+                          ('endpoint', 'stage'))
+request_seconds = Histogram('cape_email_request_seconds', 'Total time spent handling email webhooks.',
+                            ('endpoint',))
+requests_total = Counter('cape_email_requests_total', 'Email webhooks handled, by outcome.',
+                         ('endpoint', 'outcome'))
+truncated_chars_total = Counter('cape_email_truncated_chars_total', 'Characters cut from oversized inbound fields.',
+                                ('endpoint', 'field'))
+
+
+class RequestTrace:
+    """
+    Stage timings of one webhook (or answer job), becomes the current trace of the asyncio task while entered.
+    Set outcome before leaving to label the request, exceptions are counted as 'error' unless an outcome was set.
+    """
+
+    def __init__(self, endpoint: str, unique_id: str = None):
+        self.endpoint = endpoint
+        self.unique_id = unique_id
+        self.outcome = 'ok'
+        self.stages = OrderedDict()
+        self.truncated = {}  # field -> original length, for fields cut by the ingress caps
+        self._task = None
+        self._previous = None
+        self._start = None
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def __enter__(self):
+        self._task = _running_task()
+        if self._task is not None:
+            self._previous = _traces.get(self._task)
+            _traces[self._task] = self
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self._start
+        if self._task is not None:
+            if self._previous is None:
+                _traces.pop(self._task, None)
+            else:
+                _traces[self._task] = self._previous
+        if exc_type is not None and self.outcome == 'ok':
+            self.outcome = 'error'
+        if EMAIL_METRICS:
+            request_seconds.observe((self.endpoint,), seconds)
+            requests_total.inc((self.endpoint, self.outcome))
+            record = {'event': 'email_webhook', 'endpoint': self.endpoint, 'unique_id': self.unique_id,
+                      'outcome': self.outcome, 'seconds': round(seconds, 6),
+                      'stages': {name: round(value, 6) for name, value in self.stages.items()}}
+            if self.truncated:
+                record['truncated'] = self.truncated
+            info(json.dumps(record))
+        return False
+
+
+def current_trace():
+    task = _running_task()
+    return _traces.get(task) if task is not None else None
+
+
+def job_trace(request, name: str = 'answer') -> RequestTrace:
+    """Trace for work done on behalf of a webhook, logged separately under the same unique_id."""
+    parent = request.get('trace')
+    if parent is None:
+        return RequestTrace(name)
+    return RequestTrace(f'{parent.endpoint}_{name}', parent.unique_id)
+
+
+@contextmanager
+def stage(name: str):
+    """Time a block, or every call of a (synchronous) function when used as a decorator."""
+    if not EMAIL_METRICS:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        trace = current_trace()
+        if trace is None:
+            stage_seconds.observe(('background', name), seconds)
+        else:
+            stage_seconds.observe((trace.endpoint, name), seconds)
+            trace.add(name, seconds)
+
+
+def render_metrics() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    return '\n'.join(stage_seconds.render() + request_seconds.render() + requests_total.render() +
+                     truncated_chars_total.render()) + '\n'
@@ -0,0 +1,49 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import json
+import zlib
+
+from cape_email_plugin.email_settings import EMAIL_PACKAGE_EXTRAS
+
+# Fields of the Mailgun payload read back from EmailEvent.question_email_package
+PACKAGE_FIELDS = ('subject', 'from', 'to', 'recipient', 'body-plain', 'Message-Id')
+# Webhook plumbing that has no value once the webhook is handled
+_IGNORED_FIELDS = {'token', 'timestamp', 'signature', 'question', 'numberofitems', 'answer'}
+_EXTRAS_KEY = 'extras'
+
+
+def compact_package(args: dict) -> dict:
+    """
+    Reduce a Mailgun payload to the fields the handlers use. Header fields duplicating one of them (Subject, From...)
+    are dropped and, unless EMAIL_PACKAGE_EXTRAS is 'none', the rest (body-html, message-headers...) is kept as a
+    single compressed string.
+    """
+    package = {field: args[field] for field in PACKAGE_FIELDS if field in args}
+    if EMAIL_PACKAGE_EXTRAS == 'compressed':
+        kept = {field.lower(): value for field, value in package.items()}
+        extras = {field: value for field, value in args.items()
+                  if field not in package and field not in _IGNORED_FIELDS and kept.get(field.lower()) != value}
+        if extras:
+            package[_EXTRAS_KEY] = base64.b64encode(zlib.compress(json.dumps(extras).encode(), 9)).decode()
+    return package
+
+
+def expand_package(package: dict) -> dict:
+    """The stored fields together with the decompressed extras."""
+    expanded = {field: value for field, value in package.items() if field != _EXTRAS_KEY}
+    if _EXTRAS_KEY in package:
+        expanded.update(json.loads(zlib.decompress(base64.b64decode(package[_EXTRAS_KEY])).decode()))
+    return expanded
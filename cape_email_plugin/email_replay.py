@@ -0,0 +1,265 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Replay archived Mailgun webhooks through the email handlers without sending any email.
+
+Archives hold one webhook payload (the fields Mailgun POSTs) per line, or a JSON array of payloads, optionally gzip
+compressed. Each payload is re-signed with the configured API key and routed like the Mailgun routes do, the handlers
+run against the configured database and responder with outbound mail captured instead of spooled. Unless --save is
+given nothing is written: EmailEvents, saved replies and attachment documents are kept in memory only.
+
+One gzip compressed JSON line is written per payload with the routing decision, the extracted question, the answer
+or suggestions found and the emails that would have been sent:
+    cape-email-replay archive-2018-05.jsonl.gz --workers 8 --output replay.jsonl.gz
+"""
+
+import argparse
+import asyncio
+import gzip
+import hashlib
+import hmac
+import json
+import sys
+import time
+from collections import Counter, deque
+from contextlib import contextmanager, ExitStack
+from multiprocessing import Pool
+from types import SimpleNamespace
+from typing import Iterator, List
+
+_ROUTES = {'': 'email_question', 'c': 'email_new_reply', 'e': 'email_request_correction'}
+
+
+class _Outbox:
+    """Takes the place of the spool, keeping the messages the handlers would have sent."""
+
+    def __init__(self):
+        self.sent = []
+
+    async def enqueue(self, data: dict, event_id: str = None):
+        self.sent.append({'to': data['to'], 'from': data['from'], 'subject': data['subject']})
+
+
+@contextmanager
+def replay_handlers(save: bool = False, answers: bool = True):
+    """
+    Patch email_events for replaying: outbound mail is captured, answers are computed before the handler returns,
+    rate limits and the CPU pool are off, redeliveries are recognised within each replaying process and unless save
+    is set no EmailEvent, saved reply or document is written.
+    Yields the outbox and the list the saved EmailEvents are appended to.
+    """
+    from cape_email_plugin import email_events
+    from cape_email_plugin.cpu_pool import CpuPool
+    from cape_email_plugin.email_filters import MailFilter, RateLimiter
+    from cape_email_plugin.email_idempotency import IdempotencyStore
+    outbox, saved = _Outbox(), []
+    real_save_event = email_events.save_event
+
+    async def save_event(email_event, durable=False):
+        saved.append(email_event)
+        if save:
+            await real_save_event(email_event, durable)
+
+    async def no_attachments(request, user, email_event):
+        return []
+
+    stubs = {'spool': outbox, 'save_event': save_event, 'EMAIL_ASYNC_ANSWERS': False,
+             'digest_queue': SimpleNamespace(enabled=False), 'cpu_pool': CpuPool(workers=0),
+             'idempotency_store': IdempotencyStore(),
+             'mail_filter': MailFilter(token_limiter=RateLimiter(0, 0), sender_limiter=RateLimiter(0, 0))}
+    if not save:
+        stubs['create_saved_reply'] = lambda request: SimpleNamespace(
+            body=json.dumps({'result': {'replyId': 'replay-' + request['args']['question'][:32]}}))
+        stubs['_ingest_attachments'] = no_attachments
+    if not answers:
+        stubs['_responder_items'] = lambda request: []
+    originals = {name: getattr(email_events, name) for name in stubs}
+    for name, stub in stubs.items():
+        setattr(email_events, name, stub)
+    try:
+        yield outbox, saved
+    finally:
+        for name, original in originals.items():
+            setattr(email_events, name, original)
+
+
+def route(recipient: str) -> str:
+    """Name of the handler the Mailgun routes deliver an email for recipient to, None if it is not routed."""
+    _, plus, suffix = recipient.split('@')[0].rpartition('+')
+    return _ROUTES.get(suffix[:1] if plus else '')
+
+
+def _resign(payload: dict) -> dict:
+    from cape_email_plugin.email_settings import MAILGUN_API_KEY
+    args = dict(payload)
+    args.setdefault('timestamp', str(int(time.time())))
+    args.setdefault('token', hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest())
+    args['signature'] = hmac.new(key=MAILGUN_API_KEY.encode(), msg=(args['timestamp'] + args['token']).encode(),
+                                 digestmod=hashlib.sha256).hexdigest()
+    return args
+
+
+async def replay_payload(index: int, payload: dict, outbox: _Outbox, saved: list) -> dict:
+    """Run one archived payload through its handler, returning what happened to it."""
+    from cape_email_plugin import email_events
+    recipient = payload.get('recipient', '')
+    record = {'i': index, 'recipient': recipient, 'messageId': payload.get('Message-Id'),
+              'endpoint': route(recipient)}
+    if record['endpoint'] is None:
+        return record
+    del outbox.sent[:], saved[:]
+    request = {'args': _resign(payload)}
+    response = await getattr(email_events, record['endpoint'])(request)
+    record['result'] = json.loads(response.body).get('result')
+    record['question'] = request['args'].get('question')
+    if saved:
+        email_event = saved[-1]
+        record['event'] = email_event.unique_id
+        record['extracted'] = email_event.question_email_extracted_body
+        record['answer'] = email_event.final_email_saved_reply_id
+        record['suggestions'] = [answer.get('sourceId') for answer in email_event.suggested_email_results or []]
+    record['sent'] = list(outbox.sent)
+    return record
+
+
+class _Replayer:
+    """Replays payloads in the current process, with the handlers patched until it is closed."""
+
+    def __init__(self, save: bool, answers: bool):
+        self._stack = ExitStack()
+        self.outbox, self.saved = self._stack.enter_context(replay_handlers(save, answers))
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def replay_lines(self, lines: List[tuple]) -> List[dict]:
+        records = []
+        for index, line in lines:
+            try:
+                records.append(self.loop.run_until_complete(
+                    replay_payload(index, json.loads(line), self.outbox, self.saved)))
+            except Exception as e:  # one bad payload must not stop a replay of months of email
+                records.append({'i': index, 'error': f'{type(e).__name__}: {e}'})
+        return records
+
+    def close(self):
+        self._stack.close()
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+
+_replayer = None  # of each worker process
+
+
+def _start_worker(save: bool, answers: bool):
+    global _replayer
+    _replayer = _Replayer(save, answers)
+
+
+def _replay_lines(lines: List[tuple]) -> List[dict]:
+    return _replayer.replay_lines(lines)
+
+
+def read_archive(path: str) -> Iterator[str]:
+    """The payloads of an archive as JSON strings, streamed unless the archive is a JSON array."""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as archive:
+        first = archive.read(1)
+        while first.isspace():
+            first = archive.read(1)
+        if first == '[':
+            for payload in json.loads(first + archive.read()):
+                yield json.dumps(payload)
+            return
+        for line in archive:
+            line = first + line
+            first = ''
+            if line.strip():
+                yield line
+
+
+def _chunks(paths: List[str], size: int) -> Iterator[List[tuple]]:
+    chunk = []
+    index = 0
+    for path in paths:
+        for line in read_archive(path):
+            chunk.append((index, line))
+            index += 1
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def replay(paths: List[str], output: str, workers: int = 4, chunk_size: int = 100, save: bool = False,
+           answers: bool = True, progress=sys.stderr) -> dict:
+    """Replay the archives into output, on worker processes when workers > 0, and return a summary."""
+    start = time.perf_counter()
+    counts, endpoints = Counter(), Counter()
+    with gzip.open(output, 'wt', encoding='utf-8') as out:
+        if workers > 0:
+            with Pool(workers, initializer=_start_worker, initargs=(save, answers)) as pool:
+                pending = deque()
+                for chunk in _chunks(paths, chunk_size):  # at most two chunks per worker in flight
+                    pending.append(pool.apply_async(_replay_lines, (chunk,)))
+                    while len(pending) >= 2 * workers:
+                        _write(pending.popleft().get(), out, counts, endpoints, start, progress)
+                while pending:
+                    _write(pending.popleft().get(), out, counts, endpoints, start, progress)
+        else:
+            replayer = _Replayer(save, answers)
+            try:
+                for chunk in _chunks(paths, chunk_size):
+                    _write(replayer.replay_lines(chunk), out, counts, endpoints, start, progress)
+            finally:
+                replayer.close()
+    seconds = time.perf_counter() - start
+    return {'messages': counts['messages'], 'errors': counts['errors'], 'seconds': round(seconds, 3),
+            'messagesPerSecond': round(counts['messages'] / seconds, 2) if seconds else 0.0,
+            'endpoints': dict(endpoints), 'output': output}
+
+
+def _write(records: List[dict], out, counts: Counter, endpoints: Counter, start: float, progress):
+    for record in records:
+        out.write(json.dumps(record, separators=(',', ':'), default=str) + '\n')
+        counts['messages'] += 1
+        counts['errors'] += 'error' in record
+        endpoints[record.get('endpoint') or 'unrouted'] += 1
+    if progress is not None:
+        rate = counts['messages'] / max(time.perf_counter() - start, 1e-9)
+        progress.write(f"\r{counts['messages']} messages, {rate:.1f}/s")
+        progress.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('archives', nargs='+', help='JSON lines or JSON array files of webhook payloads (.gz ok)')
+    parser.add_argument('--output', default='replay.jsonl.gz', help='gzip compressed JSON lines written')
+    parser.add_argument('--workers', type=int, default=4, help='worker processes, 0 to replay in this process')
+    parser.add_argument('--chunk-size', type=int, default=100, help='payloads handed to a worker at a time')
+    parser.add_argument('--save', action='store_true',
+                        help='write EmailEvents, saved replies and documents to the database (backfill)')
+    parser.add_argument('--no-answers', dest='answers', action='store_false',
+                        help='skip the responder, to re-evaluate body extraction and routing only')
+    options = parser.parse_args(argv)
+    summary = replay(options.archives, options.output, options.workers, options.chunk_size, options.save,
+                     options.answers)
+    sys.stderr.write('\n')
+    json.dump(summary, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
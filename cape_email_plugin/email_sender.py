@@ -0,0 +1,79 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from logging import warning
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cape_email_plugin.email_settings import MAILGUN_API_KEY, MAILGUN_DOMAIN, MAILGUN_API_URL, MAILGUN_POOL_SIZE, \
+    MAILGUN_MAX_CONCURRENCY, MAILGUN_CONNECT_TIMEOUT, MAILGUN_READ_TIMEOUT
+
+
+class MailgunSender:
+    """
+    Sends messages through the Mailgun HTTP API without blocking the event loop.
+
+    A single requests session keeps a pool of keep-alive connections to Mailgun, the blocking calls run on a
+    dedicated thread pool of the same size and a semaphore bounds the number of sends in flight.
+    """
+
+    def __init__(self, pool_size: int = MAILGUN_POOL_SIZE, max_concurrency: int = MAILGUN_MAX_CONCURRENCY,
+                 timeout: tuple = (MAILGUN_CONNECT_TIMEOUT, MAILGUN_READ_TIMEOUT)):
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.session = requests.Session()
+        self.session.auth = ('api', MAILGUN_API_KEY)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=pool_size)
+        self._semaphore = None
+
+    def post(self, url: str, data: dict) -> requests.Response:
+        """Blocking POST on the pooled session, only call this from a worker thread."""
+        return self.session.post(url, data=data, timeout=self.timeout)
+
+    def get(self, url: str) -> requests.Response:
+        """Blocking GET on the pooled session, only call this from a worker thread."""
+        return self.session.get(url, headers={'Accept': 'application/json'}, timeout=self.timeout)
+
+    async def _call(self, function, *args) -> requests.Response:
+        if self._semaphore is None:  # created lazily so it binds to the server's event loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            return await asyncio.get_event_loop().run_in_executor(self._executor, function, *args)
+
+    async def send(self, data: dict) -> requests.Response:
+        """Post a message to the Mailgun messages endpoint, raises for network errors and non 2xx responses."""
+        response = await self._call(self.post, f'{MAILGUN_API_URL}/{MAILGUN_DOMAIN}/messages', data)
+        if not response.ok:
+            warning("Mailgun refused message to %s: %s %s" % (data.get('to'), response.status_code, response.text))
+        response.raise_for_status()
+        return response
+
+    async def fetch(self, url: str) -> dict:
+        """A message kept by a Mailgun store route, with the same fields as a forwarded message."""
+        response = await self._call(self.get, url)
+        response.raise_for_status()
+        return response.json()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.session.close()
+
+
+sender = MailgunSender()
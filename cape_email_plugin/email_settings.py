@@ -20,3 +20,147 @@ email_event_endpoints = Blueprint('email_event_endpoints')
 MAILGUN_API_KEY = os.getenv('CAPE_MAILGUN_API_KEY', 'REPLACEME')
 MAILGUN_DOMAIN = os.getenv('CAPE_MAILGUN_DOMAIN', 'REPLACEME')
 DEFAULT_EMAIL = os.getenv('CAPE_DEFAULT_EMAIL', 'REPLACEME')
+# Base URL of the Mailgun API, point it at a local stand-in such as tests/fake_mailgun.py to run offline
+MAILGUN_API_URL = os.getenv('CAPE_MAILGUN_API_URL', 'https://api.mailgun.net/v3')
+
+# Outbound Mailgun client: size of the keep-alive connection pool, maximum number of concurrent sends
+# and (connect, read) timeouts in seconds
+MAILGUN_POOL_SIZE = int(os.getenv('CAPE_MAILGUN_POOL_SIZE', 10))
+MAILGUN_MAX_CONCURRENCY = int(os.getenv('CAPE_MAILGUN_MAX_CONCURRENCY', 10))
+MAILGUN_CONNECT_TIMEOUT = float(os.getenv('CAPE_MAILGUN_CONNECT_TIMEOUT', 3.05))
+MAILGUN_READ_TIMEOUT = float(os.getenv('CAPE_MAILGUN_READ_TIMEOUT', 10))
+
+# Outbound spool: SQLite file holding messages until Mailgun accepts them, number of delivery workers,
+# attempts before a message is moved to the dead letters and exponential backoff bounds in seconds
+MAILGUN_SPOOL_PATH = os.getenv('CAPE_MAILGUN_SPOOL_PATH', 'mailgun_spool.sqlite3')
+MAILGUN_SPOOL_WORKERS = int(os.getenv('CAPE_MAILGUN_SPOOL_WORKERS', 4))
+MAILGUN_MAX_ATTEMPTS = int(os.getenv('CAPE_MAILGUN_MAX_ATTEMPTS', 8))
+MAILGUN_RETRY_BASE_DELAY = float(os.getenv('CAPE_MAILGUN_RETRY_BASE_DELAY', 2))
+MAILGUN_RETRY_MAX_DELAY = float(os.getenv('CAPE_MAILGUN_RETRY_MAX_DELAY', 900))
+
+# Answer pipeline: when enabled webhooks are acknowledged once the EmailEvent is stored and the responder runs on
+# a bounded job queue drained by EMAIL_ANSWER_WORKERS workers
+EMAIL_ASYNC_ANSWERS = os.getenv('CAPE_EMAIL_ASYNC_ANSWERS', 'false').lower() == 'true'
+EMAIL_ANSWER_WORKERS = int(os.getenv('CAPE_EMAIL_ANSWER_WORKERS', 4))
+EMAIL_ANSWER_QUEUE_SIZE = int(os.getenv('CAPE_EMAIL_ANSWER_QUEUE_SIZE', 1000))
+
+# Comma separated languages whose greetings and sign-offs are stripped from incoming emails, empty for all of them
+EMAIL_BODY_LANGUAGES = [language for language in os.getenv('CAPE_EMAIL_BODY_LANGUAGES', '').split(',') if language]
+
+# Responder micro-batching: questions for the same token arriving within EMAIL_BATCH_WINDOW milliseconds are
+# answered together, up to EMAIL_BATCH_MAX_SIZE per batch (a window of 0 disables batching). Only questions that are
+# identical once normalized share a responder call, distinct ones are still answered one call each, while every
+# batched question waits for the window. Off by default, it only pays off when the same question reaches a token
+# many times at once (a question sent to a mailing list whose members all forward it, for example)
+EMAIL_BATCH_WINDOW = float(os.getenv('CAPE_EMAIL_BATCH_WINDOW', 0))
+EMAIL_BATCH_MAX_SIZE = int(os.getenv('CAPE_EMAIL_BATCH_MAX_SIZE', 16))
+
+# Responder results cache: number of entries kept (0 disables it) and seconds before an entry expires
+EMAIL_ANSWER_CACHE_SIZE = int(os.getenv('CAPE_EMAIL_ANSWER_CACHE_SIZE', 1024))
+EMAIL_ANSWER_CACHE_TTL = float(os.getenv('CAPE_EMAIL_ANSWER_CACHE_TTL', 300))
+
+# In-process caches for the User and EmailEvent lookups made by the webhooks, sizes of 0 disable them.
+# Keep the TTLs short on multi-node deployments, other nodes can update users behind our back.
+EMAIL_USER_CACHE_SIZE = int(os.getenv('CAPE_EMAIL_USER_CACHE_SIZE', 10000))
+EMAIL_USER_CACHE_TTL = float(os.getenv('CAPE_EMAIL_USER_CACHE_TTL', 30))
+EMAIL_EVENT_CACHE_SIZE = int(os.getenv('CAPE_EMAIL_EVENT_CACHE_SIZE', 10000))
+EMAIL_EVENT_CACHE_TTL = float(os.getenv('CAPE_EMAIL_EVENT_CACHE_TTL', 300))
+
+# Webhook idempotency: number of processed webhooks remembered and for how many seconds, redeliveries and replayed
+# signatures within that window are answered with the stored result
+EMAIL_IDEMPOTENCY_SIZE = int(os.getenv('CAPE_EMAIL_IDEMPOTENCY_SIZE', 100000))
+EMAIL_IDEMPOTENCY_TTL = float(os.getenv('CAPE_EMAIL_IDEMPOTENCY_TTL', 86400))
+
+# What is kept of the Mailgun payload besides the fields the handlers read: 'compressed' stores the remaining
+# fields zlib compressed, 'none' drops them
+EMAIL_PACKAGE_EXTRAS = os.getenv('CAPE_EMAIL_PACKAGE_EXTRAS', 'compressed')
+
+# Outbound size bounds: lines and characters of the original email quoted under a reply and characters of the
+# original email pre-filled in the "request a correction" link
+EMAIL_QUOTE_MAX_LINES = int(os.getenv('CAPE_EMAIL_QUOTE_MAX_LINES', 50))
+EMAIL_QUOTE_MAX_CHARS = int(os.getenv('CAPE_EMAIL_QUOTE_MAX_CHARS', 5000))
+EMAIL_CORRECTION_BODY_MAX_CHARS = int(os.getenv('CAPE_EMAIL_CORRECTION_BODY_MAX_CHARS', 1000))
+
+# Digest mode: when set, suggestion emails to the forward email address are grouped per user and sent every
+# EMAIL_DIGEST_INTERVAL seconds, using Mailgun batch sending for up to EMAIL_DIGEST_BATCH_SIZE users per call
+EMAIL_DIGEST_INTERVAL = float(os.getenv('CAPE_EMAIL_DIGEST_INTERVAL', 0))
+EMAIL_DIGEST_BATCH_SIZE = int(os.getenv('CAPE_EMAIL_DIGEST_BATCH_SIZE', 100))
+
+# Per-stage timings of the webhooks, exported at /email/metrics for Prometheus and logged as one JSON line per
+# webhook at info level
+EMAIL_METRICS = os.getenv('CAPE_EMAIL_METRICS', 'true').lower() == 'true'
+# Key required by /email/stats and /email/metrics, as an 'Authorization: Bearer <key>' header or a monitoringKey
+# parameter. Both endpoints answer 404 while it is empty.
+EMAIL_MONITORING_KEY = os.getenv('CAPE_EMAIL_MONITORING_KEY', '')
+
+# Inbound pre-filter: drop auto-replies and bounces, and token bucket limits in emails per minute (with their burst
+# sizes) per Cape token and per sender address, a rate of 0 disables the limit. Emails over the sender limit are
+# dropped unless they reply to a plus address, those and emails over the token limit are refused so that Mailgun
+# delivers them again later.
+EMAIL_DROP_AUTO_REPLIES = os.getenv('CAPE_EMAIL_DROP_AUTO_REPLIES', 'true').lower() == 'true'
+# Precedence header values treated as automated mail, 'list' is not included so questions forwarded by a mailing list
+# get through
+EMAIL_DROP_PRECEDENCE = {value.strip().lower() for value in
+                         os.getenv('CAPE_EMAIL_DROP_PRECEDENCE', 'bulk,junk,auto_reply').split(',') if value.strip()}
+EMAIL_TOKEN_RATE = float(os.getenv('CAPE_EMAIL_TOKEN_RATE', 60))
+EMAIL_TOKEN_BURST = int(os.getenv('CAPE_EMAIL_TOKEN_BURST', 120))
+EMAIL_SENDER_RATE = float(os.getenv('CAPE_EMAIL_SENDER_RATE', 6))
+EMAIL_SENDER_BURST = int(os.getenv('CAPE_EMAIL_SENDER_BURST', 20))
+EMAIL_RATE_LIMIT_BUCKETS = int(os.getenv('CAPE_EMAIL_RATE_LIMIT_BUCKETS', 100000))
+
+# Attachment ingestion: text attachments of emails sent to their token by the account owner (from the verified
+# forward email) are uploaded as documents. Limits on the number and size in bytes of attachments, characters per
+# uploaded document part and the directory of the temporary copies (empty for the system default).
+EMAIL_ATTACHMENTS = os.getenv('CAPE_EMAIL_ATTACHMENTS', 'true').lower() == 'true'
+EMAIL_ATTACHMENT_MAX_COUNT = int(os.getenv('CAPE_EMAIL_ATTACHMENT_MAX_COUNT', 5))
+EMAIL_ATTACHMENT_MAX_BYTES = int(os.getenv('CAPE_EMAIL_ATTACHMENT_MAX_BYTES', 10 * 1024 * 1024))
+EMAIL_ATTACHMENT_PART_CHARS = int(os.getenv('CAPE_EMAIL_ATTACHMENT_PART_CHARS', 1000000))
+EMAIL_ATTACHMENT_DIR = os.getenv('CAPE_EMAIL_ATTACHMENT_DIR') or None
+
+# Mailgun store and notify routes: notify webhooks only carry metadata and a message-url, the message is fetched
+# with the API key when a handler needs its body, and only from hosts ending with this suffix (empty to allow any)
+MAILGUN_STORAGE_HOST_SUFFIX = os.getenv('CAPE_MAILGUN_STORAGE_HOST_SUFFIX', 'mailgun.net')
+
+# CPU bound steps (body extraction and rendering) of emails with more than EMAIL_CPU_INLINE_CHARS characters run on
+# a pool of EMAIL_CPU_WORKERS processes (0 runs everything on the event loop), a step taking more than
+# EMAIL_CPU_TIMEOUT seconds falls back to the raw text
+EMAIL_CPU_WORKERS = int(os.getenv('CAPE_EMAIL_CPU_WORKERS', 2))
+EMAIL_CPU_TIMEOUT = float(os.getenv('CAPE_EMAIL_CPU_TIMEOUT', 5))
+EMAIL_CPU_INLINE_CHARS = int(os.getenv('CAPE_EMAIL_CPU_INLINE_CHARS', 20000))
+
+# Reply addresses: when enabled the addresses replies are sent to carry the event id, user id (when it fits) and
+# action signed with EMAIL_ADDRESS_KEY (derived from the Mailgun API key when empty), so reply webhooks are routed
+# without reading the EmailEvent. Both end with +c/+e like legacy addresses and both are always accepted.
+EMAIL_SIGNED_ADDRESSES = os.getenv('CAPE_EMAIL_SIGNED_ADDRESSES', 'false').lower() == 'true'
+EMAIL_ADDRESS_KEY = os.getenv('CAPE_EMAIL_ADDRESS_KEY', '')
+
+# Inbound size caps in characters: body fields (body-plain, body-html, stripped-text...) and any other field of the
+# webhook are truncated on arrival, and questions are cut further before reaching the responder (0 disables a cap)
+EMAIL_MAX_BODY_CHARS = int(os.getenv('CAPE_EMAIL_MAX_BODY_CHARS', 100000))
+EMAIL_MAX_FIELD_CHARS = int(os.getenv('CAPE_EMAIL_MAX_FIELD_CHARS', 20000))
+EMAIL_MAX_QUESTION_CHARS = int(os.getenv('CAPE_EMAIL_MAX_QUESTION_CHARS', 2000))
+
+# Write-behind of EmailEvent saves: when EMAIL_WRITE_BEHIND_INTERVAL is set events are written by a background task
+# every that many seconds (or once EMAIL_WRITE_BEHIND_BATCH_SIZE are waiting), in batches of that size, and webhooks
+# wait once EMAIL_WRITE_BEHIND_QUEUE_SIZE events are waiting. Writes still buffered are only visible to this node.
+# The events of a failed batch are written one by one, an event that failed EMAIL_WRITE_BEHIND_MAX_FAILURES times
+# (one attempt per interval) is logged and dropped so it cannot hold back every event behind it
+EMAIL_WRITE_BEHIND_INTERVAL = float(os.getenv('CAPE_EMAIL_WRITE_BEHIND_INTERVAL', 0))
+EMAIL_WRITE_BEHIND_BATCH_SIZE = int(os.getenv('CAPE_EMAIL_WRITE_BEHIND_BATCH_SIZE', 100))
+EMAIL_WRITE_BEHIND_QUEUE_SIZE = int(os.getenv('CAPE_EMAIL_WRITE_BEHIND_QUEUE_SIZE', 10000))
+EMAIL_WRITE_BEHIND_MAX_FAILURES = int(os.getenv('CAPE_EMAIL_WRITE_BEHIND_MAX_FAILURES', 5))
+
+# History retention: cape-email-history compact archives EmailEvents older than EMAIL_RETENTION_DAYS to gzip compressed
+# JSON lines in EMAIL_ARCHIVE_DIR and keeps only what replies to them need
+EMAIL_RETENTION_DAYS = int(os.getenv('CAPE_EMAIL_RETENTION_DAYS', 180))
+EMAIL_ARCHIVE_DIR = os.getenv('CAPE_EMAIL_ARCHIVE_DIR', 'email_archive')
+
+# Backends called for answers, saved replies and document uploads as 'module:function'. They are called on worker
+# threads and imported there on first use unless EMAIL_PRELOAD_BACKEND is set, in which case they are imported when
+# the server starts
+EMAIL_ANSWER_BACKEND = os.getenv('CAPE_EMAIL_ANSWER_BACKEND', 'webservices.app.app_core:_answer')
+EMAIL_SAVED_REPLY_BACKEND = os.getenv('CAPE_EMAIL_SAVED_REPLY_BACKEND',
+                                      'webservices.app.app_saved_reply_endpoints:_create_saved_reply')
+EMAIL_DOCUMENT_BACKEND = os.getenv('CAPE_EMAIL_DOCUMENT_BACKEND',
+                                   'webservices.app.app_document_endpoints:_upload_document')
+EMAIL_PRELOAD_BACKEND = os.getenv('CAPE_EMAIL_PRELOAD_BACKEND', 'false').lower() == 'true'
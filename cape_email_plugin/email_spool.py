@@ -0,0 +1,227 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from logging import debug, warning
+
+from cape_email_plugin.email_metrics import stage
+from cape_email_plugin.email_sender import sender
+from cape_email_plugin.email_settings import MAILGUN_SPOOL_PATH, MAILGUN_SPOOL_WORKERS, MAILGUN_MAX_ATTEMPTS, \
+    MAILGUN_RETRY_BASE_DELAY, MAILGUN_RETRY_MAX_DELAY
+
+PENDING = 'pending'
+SENDING = 'sending'
+SENT = 'sent'
+DEAD = 'dead'
+
+# A message claimed by a worker that crashed before recording the outcome is retried after this many seconds
+_SEND_LEASE = 300
+_IDLE_POLL = 1.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id TEXT,
+    data TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    last_error TEXT,
+    provider_id TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_due ON messages (status, next_attempt);
+CREATE INDEX IF NOT EXISTS messages_event ON messages (event_id);
+"""
+
+
+def _is_permanent(error: Exception) -> bool:
+    """Client errors other than throttling will fail the same way on every retry."""
+    response = getattr(error, 'response', None)
+    return response is not None and 400 <= response.status_code < 500 and response.status_code != 429
+
+
+class EmailSpool:
+    """
+    Crash-safe outbound queue stored in SQLite.
+
+    Messages are committed to disk by enqueue() and delivered by background workers, failed sends are retried with
+    exponential backoff and, once max_attempts is reached or Mailgun rejects the message, kept as dead letters.
+    Claims are made inside an immediate transaction so several server processes can share the same file. SQLite
+    calls made from the event loop run on a dedicated thread, so waiting for another process's lock never blocks it.
+    """
+
+    def __init__(self, path: str = MAILGUN_SPOOL_PATH, workers: int = MAILGUN_SPOOL_WORKERS,
+                 max_attempts: int = MAILGUN_MAX_ATTEMPTS, base_delay: float = MAILGUN_RETRY_BASE_DELAY,
+                 max_delay: float = MAILGUN_RETRY_MAX_DELAY):
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._connection = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._tasks = []
+        self._wakeup = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(_SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    async def _call(self, function, *args, **kwargs):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, partial(function, *args, **kwargs))
+
+    def _insert(self, data: dict, event_id: str) -> int:
+        now = time.time()
+        with self._lock:
+            return self.connection.execute(
+                'INSERT INTO messages (event_id, data, status, next_attempt, created, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?)', (event_id, json.dumps(data), PENDING, now, now, now)).lastrowid
+
+    async def enqueue(self, data: dict, event_id: str = None) -> int:
+        """Durably store a message for delivery and return its spool id."""
+        message_id = await self._call(self._insert, data, event_id)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return message_id
+
+    def _claim(self):
+        now = time.time()
+        with self._lock:
+            connection = self.connection
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                # sends whose lease expired are retried, unless they already used every attempt
+                connection.execute('UPDATE messages SET status = ?, last_error = ?, updated = ? WHERE status = ? AND '
+                                   'next_attempt <= ? AND attempts >= ?',
+                                   (DEAD, 'lease expired', now, SENDING, now, self.max_attempts))
+                row = connection.execute(
+                    'SELECT id, data, attempts FROM messages WHERE status IN (?, ?) AND next_attempt <= ? '
+                    'ORDER BY next_attempt LIMIT 1', (PENDING, SENDING, now)).fetchone()
+                if row is not None:
+                    connection.execute('UPDATE messages SET status = ?, attempts = attempts + 1, next_attempt = ?, '
+                                       'updated = ? WHERE id = ?', (SENDING, now + _SEND_LEASE, now, row['id']))
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        return row
+
+    def _seconds_until_due(self) -> float:
+        with self._lock:
+            next_attempt = self.connection.execute('SELECT MIN(next_attempt) FROM messages WHERE status IN (?, ?)',
+                                                   (PENDING, SENDING)).fetchone()[0]
+        if next_attempt is None:
+            return _IDLE_POLL
+        return min(max(next_attempt - time.time(), 0), _IDLE_POLL)
+
+    def _update(self, message_id: int, **fields):
+        fields['updated'] = time.time()
+        assignments = ', '.join(f'{field} = ?' for field in fields)
+        with self._lock:
+            self.connection.execute(f'UPDATE messages SET {assignments} WHERE id = ?',
+                                    (*fields.values(), message_id))
+
+    def _retry_delay(self, attempts: int) -> float:
+        return min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+
+    async def _deliver(self, row):
+        attempts = row['attempts'] + 1
+        try:
+            with stage('mailgun'):
+                response = await sender.send(json.loads(row['data']))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:  # the claim already counted the attempt, every failure is retried or given up
+            if _is_permanent(e) or attempts >= self.max_attempts:
+                warning("Giving up on spooled email %s after %d attempts: %s" % (row['id'], attempts, e))
+                await self._call(self._update, row['id'], status=DEAD, last_error=str(e))
+            else:
+                debug("Retrying spooled email %s: %s" % (row['id'], e))
+                await self._call(self._update, row['id'], status=PENDING, last_error=str(e),
+                                 next_attempt=time.time() + self._retry_delay(attempts))
+        else:
+            try:
+                provider_id = response.json().get('id')
+            except ValueError:
+                provider_id = None
+            await self._call(self._update, row['id'], status=SENT, provider_id=provider_id, last_error=None)
+
+    async def _work(self):
+        while True:
+            row = await self._call(self._claim)
+            if row is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), await self._call(self._seconds_until_due))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._deliver(row)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # the outcome could not be recorded, the lease will retry the message
+                warning("Could not record the delivery of spooled email %s: %s" % (row['id'], e))
+
+    def start(self, loop=None):
+        loop = loop or asyncio.get_event_loop()
+        self._wakeup = asyncio.Event()
+        self._tasks = [loop.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def delivery_status(self, event_id: str) -> list:
+        """Delivery state of every message sent on behalf of an EmailEvent, oldest first."""
+        with self._lock:
+            rows = self.connection.execute(
+                'SELECT id, status, attempts, last_error, provider_id, created, updated FROM messages '
+                'WHERE event_id = ? ORDER BY id', (event_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def dead_letters(self, limit: int = 100) -> list:
+        with self._lock:
+            rows = self.connection.execute(
+                'SELECT id, event_id, data, attempts, last_error, updated FROM messages WHERE status = ? '
+                'ORDER BY id DESC LIMIT ?', (DEAD, limit)).fetchall()
+        return [dict(row, data=json.loads(row['data'])) for row in rows]
+
+    def requeue_dead(self, message_id: int):
+        """Give a dead letter a fresh set of attempts."""
+        self._update(message_id, status=PENDING, attempts=0, next_attempt=time.time())
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+
+spool = EmailSpool()
@@ -0,0 +1,60 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from urllib.parse import urlparse
+
+from api_helpers.exceptions import UserException
+from cape_email_plugin.email_limits import cap_fields
+from cape_email_plugin.email_metrics import stage
+from cape_email_plugin.email_sender import MailgunSender, sender
+from cape_email_plugin.email_settings import MAILGUN_STORAGE_HOST_SUFFIX
+
+ERROR_INVALID_MESSAGE_URL = 'Refusing to fetch the stored message from %s.'
+
+# Set on the request once its message has been fetched from Mailgun's storage. Only then does args['attachments']
+# come from Mailgun, forward routes post the headers of the email as fields so a sender can set it to anything.
+STORED_MESSAGE = 'storedMessage'
+
+
+def is_notification(args: dict) -> bool:
+    """Whether the webhook comes from a store and notify route and the message is not fetched yet."""
+    return 'message-url' in args and 'body-plain' not in args
+
+
+def trusted_url(url: str, host_suffix: str = MAILGUN_STORAGE_HOST_SUFFIX) -> bool:
+    """Whether url is served by Mailgun, the only host the API key is sent to and attachments are fetched from."""
+    parsed = urlparse(url)
+    host = (parsed.hostname or '').lower()
+    return parsed.scheme in ('http', 'https') and (not host_suffix or host == host_suffix or
+                                                   host.endswith('.' + host_suffix))
+
+
+async def fetch_message(request, client: MailgunSender = sender, host_suffix: str = MAILGUN_STORAGE_HOST_SUFFIX):
+    """
+    Complete request['args'] with the stored message of a notify webhook, does nothing for forwarded messages.
+    Handlers call it only once they know they need the body, so mail rejected on its metadata is never downloaded.
+    """
+    args = request['args']
+    if not is_notification(args):
+        return
+    url = args['message-url']
+    if not trusted_url(url, host_suffix):  # the API key is sent along, only ever give it to Mailgun
+        raise UserException(ERROR_INVALID_MESSAGE_URL % url)
+    with stage('fetch'):
+        message = await client.fetch(url)
+    args.pop('attachments', None)
+    for field, value in message.items():
+        args.setdefault(field, value)
+    cap_fields(args)
+    request[STORED_MESSAGE] = True
@@ -0,0 +1,150 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Outbound email bodies. Every render function returns a (text, html) pair built in one pass from the same pieces,
+the templates are parsed once at import time and the quoted history is bounded whatever the size of the input.
+"""
+
+import html
+from datetime import datetime
+from string import Template
+from typing import Optional, Tuple
+
+from api_helpers.text_responses import ERROR_NO_SUGGESTIONS
+from webservices.app.app_settings import UI_URL
+from cape_email_plugin.email_settings import EMAIL_QUOTE_MAX_LINES, EMAIL_QUOTE_MAX_CHARS, \
+    EMAIL_CORRECTION_BODY_MAX_CHARS
+
+_CAPE_URL = 'https://alpha.thecape.ai'
+_TRUNCATED = '[...]'
+
+_ANSWER_TEXT = Template('Hello$firstname,\n\n$answer\n\n--\nSent by Cape AI ($cape_url)\n\n'
+                        'If this answer does not answer your question, write to $correction_address.\n\n')
+_ANSWER_HTML = Template('Hello$firstname,<br /><br />$answer<br /><br />'
+                        '--<br />Sent by <a href="$cape_url">Cape</a> AI<br /><br />'
+                        '<small>If this answer does not answer your question, click '
+                        '<a href="mailto:$correction_to?subject=$correction_subject&body=$correction_body">here</a>.'
+                        '</small><br /><br />')
+
+_SUGGESTIONS_TEXT = Template('Hello$firstname,\n\n==Cape AI Suggestions==\n\n$suggestions'
+                             '==End Suggestions==\n\n--\nSent by Cape AI ($cape_url)\n\n')
+_SUGGESTIONS_HTML = Template('Hello$firstname,<br /><br />==Cape AI Suggestions==<br /><br />$suggestions'
+                             '==End Suggestions==<br /><br />--<br/>Sent by <a href="$cape_url">Cape</a> AI<br /><br />')
+_DOCUMENT_TEXT = Template('$context\n\nAccording to document: $source_id ($url)\n\n')
+_DOCUMENT_HTML = Template('$context<br /><br />According to document: <a href="$url">$source_id</a><br /><br />')
+_SAVED_REPLY_TEXT = Template('$context\n\nAccording to saved reply ($url)\n\n')
+_SAVED_REPLY_HTML = Template('$context<br /><br />According to <a href="$url">saved reply</a><br /><br />')
+
+_QUOTE_TEXT = Template('\n$date $sender wrote:\n\n$quoted')
+_QUOTE_HTML = Template('<br />$date $sender wrote:<br />$quoted')
+
+
+def _bounded_lines(text: str, max_lines: int = EMAIL_QUOTE_MAX_LINES, max_chars: int = EMAIL_QUOTE_MAX_CHARS):
+    """The first lines of text within both limits, and whether anything was left out."""
+    text = text.replace('\r\n', '\n')
+    truncated = len(text) > max_chars
+    lines = text[:max_chars].split('\n', max_lines)
+    if len(lines) > max_lines:
+        lines.pop()
+        truncated = True
+    return lines, truncated
+
+
+def render_quote(original_text: str, original_timestamp: datetime, sender: str) -> Tuple[str, str]:
+    """The original email quoted line by line under a reply."""
+    lines, truncated = _bounded_lines(original_text)
+    if truncated:
+        lines.append(_TRUNCATED)
+    quoted_lines = [f'> {line}' for line in lines]
+    date = original_timestamp.strftime('On %a, %b %d, %Y at %H:%M %p')
+    return (_QUOTE_TEXT.substitute(date=date, sender=sender, quoted='\n'.join(quoted_lines)),
+            _QUOTE_HTML.substitute(date=date, sender=sender, quoted='<br />'.join(quoted_lines)))
+
+
+def render_answer(firstname: str, answer_text: str, correction_address: str, original_subject: str,
+                  original_text: str) -> Tuple[str, str]:
+    """A saved reply answering the question, with a mailto link pre-filled to request a correction."""
+    correction_body = original_text[:EMAIL_CORRECTION_BODY_MAX_CHARS]
+    if len(original_text) > EMAIL_CORRECTION_BODY_MAX_CHARS:
+        correction_body += _TRUNCATED
+    return (_ANSWER_TEXT.substitute(firstname=firstname, answer=answer_text, cape_url=_CAPE_URL,
+                                    correction_address=correction_address),
+            _ANSWER_HTML.substitute(firstname=firstname, answer=answer_text.replace('\n', '\r\n'),
+                                    cape_url=_CAPE_URL,
+                                    correction_to=html.escape(f'"Cape AI" <{correction_address}>'),
+                                    correction_subject=html.escape(original_subject),
+                                    correction_body=html.escape(correction_body).replace('\r\n', '%0D%0A')))
+
+
+def render_suggestions(firstname: str, answers: Optional[list]) -> Tuple[str, str]:
+    """Machine reading suggestions for the forward email address, with the answer highlighted in its context."""
+    text_parts, html_parts = [], []
+    if answers is None:
+        text_parts.append(ERROR_NO_SUGGESTIONS + '\n\n')
+        html_parts.append(ERROR_NO_SUGGESTIONS + '<br /><br />')
+    else:
+        for answer in answers:
+            if 'answerContext' in answer:
+                context = answer['answerContext']
+                local_start_offset = answer['answerTextStartOffset'] - answer['answerContextStartOffset']
+                local_end_offset = answer['answerTextEndOffset'] - answer['answerContextStartOffset']
+                html_context = f'{context[:local_start_offset]}<b>{context[local_start_offset:local_end_offset]}' \
+                               f'</b>{context[local_end_offset:]}'
+            else:
+                context = html_context = answer['answerText']
+            if answer['sourceType'] == 'document':
+                url = f'{UI_URL}/dashboard.html#/documents/{answer["sourceId"]}'
+                text_parts.append(_DOCUMENT_TEXT.substitute(context=context, source_id=answer['sourceId'], url=url))
+                html_parts.append(_DOCUMENT_HTML.substitute(context=html_context, source_id=answer['sourceId'],
+                                                            url=url))
+            elif answer['sourceType'] == 'saved_reply':
+                url = f'{UI_URL}/dashboard.html#/saved-replies/{answer["sourceId"]}'
+                text_parts.append(_SAVED_REPLY_TEXT.substitute(context=context, url=url))
+                html_parts.append(_SAVED_REPLY_HTML.substitute(context=html_context, url=url))
+    return (_SUGGESTIONS_TEXT.substitute(firstname=firstname, suggestions=''.join(text_parts), cape_url=_CAPE_URL),
+            _SUGGESTIONS_HTML.substitute(firstname=firstname, suggestions=''.join(html_parts), cape_url=_CAPE_URL))
+
+
+_DIGEST_TEXT = Template('Hello,\n\n$count questions are waiting for your answer.\n\n$items'
+                        '--\nSent by Cape AI ($cape_url)\n\n')
+_DIGEST_HTML = Template('Hello,<br /><br />$count questions are waiting for your answer.<br /><br />$items'
+                        '--<br/>Sent by <a href="$cape_url">Cape</a> AI<br /><br />')
+_DIGEST_ITEM_TEXT = Template('== $number. $subject ==\n\n$body\n\nTo answer, reply to $reply_address with the '
+                             'subject "Re: $subject".\n\n')
+_DIGEST_ITEM_HTML = Template('<h3>$number. $subject</h3>$body<br /><br />'
+                             '<a href="mailto:$reply_to?subject=$reply_subject">Answer this question</a>'
+                             '<br /><hr /><br />')
+
+
+def render_digest(items: list) -> Tuple[str, str]:
+    """
+    Several suggestion emails in one message, items are dicts with the subject, text and html of each suggestion
+    email and the reply_address answers to that question must be sent to.
+    """
+    text_parts, html_parts = [], []
+    for number, item in enumerate(items, 1):
+        text_parts.append(_DIGEST_ITEM_TEXT.substitute(number=number, subject=item['subject'], body=item['text'],
+                                                       reply_address=item['reply_address']))
+        html_parts.append(_DIGEST_ITEM_HTML.substitute(number=number, subject=html.escape(item['subject']),
+                                                       body=item['html'],
+                                                       reply_to=html.escape(item['reply_address']),
+                                                       reply_subject=html.escape(f"Re: {item['subject']}")))
+    return (_DIGEST_TEXT.substitute(count=len(items), items=''.join(text_parts), cape_url=_CAPE_URL),
+            _DIGEST_HTML.substitute(count=len(items), items=''.join(html_parts), cape_url=_CAPE_URL))
+
+
+def render_plain(text: str) -> Tuple[str, str]:
+    """Text sent as is, used when a template could not be rendered in time."""
+    return text, html.escape(text).replace('\n', '<br />')
@@ -0,0 +1,153 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from logging import error, warning
+
+from cape_email_plugin.email_settings import EMAIL_WRITE_BEHIND_INTERVAL, EMAIL_WRITE_BEHIND_BATCH_SIZE, \
+    EMAIL_WRITE_BEHIND_QUEUE_SIZE, EMAIL_WRITE_BEHIND_MAX_FAILURES
+
+
+class EventWriter:
+    """
+    Write-behind buffer for EmailEvent saves, so webhooks do not wait on the database.
+
+    Events are buffered by unique_id, saving an event again before it is written only keeps its latest state.
+    A background task hands the buffer to write_batch (called on a thread) in batches of batch_size, every interval
+    seconds or as soon as a batch is full, and once more on stop. When maxsize events are waiting add() blocks until
+    a batch is written, so a slow database slows the webhooks down instead of growing the buffer without bound.
+    When a batch fails its events are written one by one, so one bad event does not hold back the others, and those
+    that still fail are put back and retried on the next interval. An event that failed max_failures times is dropped.
+    """
+
+    def __init__(self, write_batch, interval: float = EMAIL_WRITE_BEHIND_INTERVAL,
+                 batch_size: int = EMAIL_WRITE_BEHIND_BATCH_SIZE, maxsize: int = EMAIL_WRITE_BEHIND_QUEUE_SIZE,
+                 max_failures: int = EMAIL_WRITE_BEHIND_MAX_FAILURES):
+        self.write_batch = write_batch
+        self.interval = interval
+        self.batch_size = batch_size
+        self.maxsize = maxsize
+        self.max_failures = max_failures
+        self._pending = OrderedDict()
+        self._writing = {}
+        self._failures = {}
+        self._executor = ThreadPoolExecutor(max_workers=1)  # one batch at a time keeps writes in order
+        self._task = None
+        self._wake = None
+        self._space = None
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+        self.dropped = 0
+        self.waits = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def pending(self, unique_id: str):
+        """The buffered event with this id, if it is not written yet."""
+        return self._pending.get(unique_id) or self._writing.get(unique_id)
+
+    def discard(self, unique_id: str):
+        self._pending.pop(unique_id, None)
+
+    async def add(self, email_event):
+        while len(self._pending) >= self.maxsize and email_event.unique_id not in self._pending:
+            self.waits += 1
+            self._wake.set()
+            self._space.clear()
+            await self._space.wait()
+        self._pending[email_event.unique_id] = email_event
+        if len(self._pending) >= self.batch_size:
+            self._wake.set()
+
+    async def flush(self) -> bool:
+        """Write every buffered event, returns False if some could not be written (they are put back in the buffer)."""
+        loop = asyncio.get_event_loop()
+        while self._pending:
+            batch = [self._pending.popitem(last=False)[1] for _ in range(min(self.batch_size, len(self._pending)))]
+            self._writing = {email_event.unique_id: email_event for email_event in batch}
+            try:
+                await loop.run_in_executor(self._executor, self.write_batch, batch)
+            except Exception as e:
+                warning("Failed to write %d email events, writing them one by one: %s" % (len(batch), e))
+                failed = [email_event for email_event in batch if not await self._write_alone(email_event)]
+                for email_event in reversed(failed):  # unless saved again meanwhile, which is more recent
+                    if email_event.unique_id not in self._pending:
+                        self._pending[email_event.unique_id] = email_event
+                        self._pending.move_to_end(email_event.unique_id, last=False)
+                if failed:
+                    return False
+            else:
+                self._written(batch)
+                self.batches += 1
+            finally:
+                self._writing = {}
+                self._space.set()
+        return True
+
+    async def _write_alone(self, email_event) -> bool:
+        """Write one event of a failed batch, returns False if it has to be retried."""
+        try:
+            await asyncio.get_event_loop().run_in_executor(self._executor, self.write_batch, [email_event])
+        except Exception as e:
+            self.failed += 1
+            failures = self._failures.pop(email_event.unique_id, 0) + 1
+            if failures < self.max_failures:
+                self._failures[email_event.unique_id] = failures
+                return False
+            self.dropped += 1
+            error("Dropping email event %s after %d failed writes: %s" % (email_event.unique_id, failures, e))
+        else:
+            self._written([email_event])
+        return True
+
+    def _written(self, batch: list):
+        self.written += len(batch)
+        for email_event in batch:
+            self._failures.pop(email_event.unique_id, None)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    def start(self, loop=None):
+        if self.enabled:
+            self._wake = asyncio.Event()
+            self._space = asyncio.Event()
+            self._task = (loop or asyncio.get_event_loop()).create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            if not await self.flush():
+                warning("Dropping %d unwritten email events on shutdown" % len(self._pending))
+
+    def stats(self) -> dict:
+        return {'pending': len(self._pending), 'maxsize': self.maxsize, 'written': self.written,
+                'batches': self.batches, 'failed': self.failed, 'dropped': self.dropped, 'waits': self.waits}
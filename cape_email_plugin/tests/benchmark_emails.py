@@ -0,0 +1,279 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Latency benchmarks for body extraction, reply rendering and the email_question handler.
+
+The corpus is synthetic and seeded so every run measures the same messages, names and addresses are made up.
+The handler runs with the responder, the database and the spool stubbed out, so only the plugin's own work is timed.
+Results are printed (or written with --output) as JSON, keep them next to the version they were taken on:
+    python -m cape_email_plugin.tests.benchmark_emails --size 200 --iterations 5 --output bench.json
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import platform
+import random
+import sys
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+from types import SimpleNamespace
+from uuid import uuid4
+
+from cape_email_plugin.version import VERSION
+
+CATEGORIES = ('short', 'quoted_thread', 'huge_signature', 'html_only', 'non_english')
+
+_NAMES = ('Alex', 'Sam', 'Robin', 'Charlie', 'Jordan', 'Morgan', 'Taylor', 'Casey')
+_QUESTIONS = ('What is the refund policy for annual plans?', 'How do I reset my password?',
+              'Can I change the billing address on my invoice?', 'Where can I download the latest report?',
+              'Is there a discount for non-profit organisations?', 'How long does shipping take to Canada?',
+              'Who do I contact about a broken delivery?', 'Does the API support pagination?')
+_FILLER = ('Thanks for getting back to me so quickly last time.', 'We are evaluating the product for our team.',
+           'I looked at the documentation but could not find it.', 'This is quite urgent for our launch.')
+_GREETINGS = {'en': ('Hi', 'Hello', 'Dear'), 'fr': ('Bonjour',), 'es': ('Hola',), 'it': ('Ciao',),
+              'de': ('Guten Tag', 'Hallo')}
+_SIGN_OFFS = {'en': ('Regards', 'Best', 'Thanks', 'Cheers'), 'fr': ('Cordialement',), 'es': ('Saludos',),
+              'it': ('Ciao',), 'de': ('Viele Grüße',)}
+
+_BENCH_TOKEN = 'benchmarktoken'
+
+
+def _short(rng: random.Random, name: str, question: str) -> str:
+    return f"{rng.choice(_GREETINGS['en'])} Cape,\n{question}\n{rng.choice(_SIGN_OFFS['en'])},\n{name}"
+
+
+def _quoted_thread(rng: random.Random, name: str, question: str) -> str:
+    lines = ['Hi,', question, 'Thanks,', name, '']
+    for depth in range(1, rng.randint(5, 20) + 1):
+        prefix = '>' * depth + ' '
+        lines.append(prefix[1:] + f'On Mon, Jan {depth:02d}, 2018 at 10:{depth:02d} AM {rng.choice(_NAMES)} '
+                                  f'<user{depth}@example.com> wrote:')
+        lines.extend(prefix + rng.choice(_FILLER) for _ in range(rng.randint(3, 12)))
+    return '\n'.join(lines)
+
+
+def _huge_signature(rng: random.Random, name: str, question: str) -> str:
+    signature = [f'{name} | Account Manager | Example Corp', '+44 20 0000 0000 | www.example.com']
+    disclaimer = 'This email and any attachments are confidential and intended solely for the addressee. ' \
+                 'If you have received it in error please notify the sender.'
+    signature.extend(disclaimer for _ in range(rng.randint(50, 200)))
+    return f'Hello,\n{question}\n{rng.choice(_FILLER)}\nBest,\n--\n' + '\n'.join(signature)
+
+
+def _html_only(rng: random.Random, name: str, question: str) -> str:
+    """Clients that send no text part leave the markup in body-plain."""
+    return (f'<html><body><div dir="ltr"><p>Hi,</p><p>{question}</p><p>{rng.choice(_FILLER)}</p>'
+            f'<p>Regards,<br/>{name}</p>' + '<div><br></div>' * rng.randint(5, 50) + '</div></body></html>')
+
+
+def _non_english(rng: random.Random, name: str, question: str) -> str:
+    language = rng.choice(('fr', 'es', 'it', 'de'))
+    return f'{rng.choice(_GREETINGS[language])} Cape,\n{question}\n{rng.choice(_SIGN_OFFS[language])},\n{name}'
+
+
+_GENERATORS = {'short': _short, 'quoted_thread': _quoted_thread, 'huge_signature': _huge_signature,
+               'html_only': _html_only, 'non_english': _non_english}
+
+
+def make_corpus(size: int = 100, seed: int = 0) -> list:
+    """Synthetic Mailgun question payloads, the categories are interleaved so any prefix is a balanced sample."""
+    rng = random.Random(seed)
+    corpus = []
+    for index in range(size):
+        category = CATEGORIES[index % len(CATEGORIES)]
+        name = rng.choice(_NAMES)
+        body = _GENERATORS[category](rng, name, rng.choice(_QUESTIONS))
+        corpus.append({'category': category, 'from': f'{name} <{name.lower()}{index}@example.com>',
+                       'subject': f'Question {index}', 'body-plain': body})
+    return corpus
+
+
+def _percentile(ordered: list, fraction: float) -> float:
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def summarize(durations: list) -> dict:
+    """Throughput in calls per second and latencies in milliseconds."""
+    ordered = sorted(durations)
+    total = sum(ordered)
+    return {'count': len(ordered), 'throughput': len(ordered) / total if total else 0.0,
+            'mean': 1000 * total / len(ordered), 'p50': 1000 * _percentile(ordered, 0.50),
+            'p95': 1000 * _percentile(ordered, 0.95), 'p99': 1000 * _percentile(ordered, 0.99),
+            'max': 1000 * ordered[-1]}
+
+
+def _by_category(corpus: list, durations: list) -> dict:
+    groups = {}
+    for message, duration in zip(corpus * (len(durations) // len(corpus)), durations):
+        groups.setdefault(message['category'], []).append(duration)
+    return {category: summarize(values) for category, values in groups.items()}
+
+
+def bench_body_extraction(corpus: list, iterations: int) -> list:
+    from cape_email_plugin.email_body import body_extractor
+    durations = []
+    for _ in range(iterations):
+        for message in corpus:
+            start = time.perf_counter()
+            body_extractor.extract(message['body-plain'])
+            durations.append(time.perf_counter() - start)
+    return durations
+
+
+def _fake_answers(question: str) -> list:
+    """Canned responder output, half saved replies and half document suggestions depending on the question."""
+    if zlib.crc32(question.encode()) % 2:
+        return [{'sourceType': 'saved_reply', 'sourceId': 'reply-1', 'answerText': 'Please see our help centre.'}]
+    context = f'Our documentation explains this: {question} is covered in section 3.'
+    return [{'sourceType': 'document', 'sourceId': f'document-{number}', 'answerText': question,
+             'answerContext': context, 'answerContextStartOffset': 0, 'answerTextStartOffset': 34,
+             'answerTextEndOffset': 34 + len(question)} for number in range(3)]
+
+
+def bench_rendering(corpus: list, iterations: int) -> list:
+    from cape_email_plugin.email_templates import render_quote, render_answer, render_suggestions
+    timestamp = datetime(2018, 1, 1, 10, 0)
+    durations = []
+    for _ in range(iterations):
+        for message in corpus:
+            answers = _fake_answers(message['subject'])
+            start = time.perf_counter()
+            if answers[0]['sourceType'] == 'saved_reply':
+                render_answer(' Alex', answers[0]['answerText'], 'event+e@example.com', message['subject'],
+                              message['body-plain'])
+            else:
+                render_suggestions(' Alex', answers)
+            render_quote(message['body-plain'], timestamp, message['from'])
+            durations.append(time.perf_counter() - start)
+    return durations
+
+
+class _SpoolStub:
+
+    def __init__(self):
+        self.messages = 0
+
+    async def enqueue(self, data: dict, event_id: str = None):
+        self.messages += 1
+
+
+async def _skip_save(email_event, durable: bool = False):
+    pass
+
+
+@contextmanager
+def stubbed_handlers():
+    """
+    Patch email_events so the handlers run without a responder, a database or outbound mail, and without the
+    rate limits the benchmark would otherwise trip.
+    """
+    from cape_email_plugin import email_events
+    from cape_email_plugin.answer_cache import AnswerCache
+    from cape_email_plugin.email_filters import MailFilter, RateLimiter
+    from cape_email_plugin.email_settings import DEFAULT_EMAIL
+    user = SimpleNamespace(user_id='benchmark', token=_BENCH_TOKEN, forward_email='owner@example.com',
+                           verified_email='owner@example.com')
+    assert user.forward_email != DEFAULT_EMAIL
+    stubs = {'get_user': lambda field, value: user if value == _BENCH_TOKEN else None,
+             'refresh_user': lambda user: user,
+             'save_event': _skip_save,
+             '_responder_items': lambda request: _fake_answers(request['args']['question']),
+             'spool': _SpoolStub(),
+             'mail_filter': MailFilter(token_limiter=RateLimiter(0, 0), sender_limiter=RateLimiter(0, 0)),
+             'answer_cache': AnswerCache(maxsize=0)}  # every question goes through the (stubbed) responder
+    originals = {name: getattr(email_events, name) for name in stubs}
+    for name, stub in stubs.items():
+        setattr(email_events, name, stub)
+    try:
+        yield email_events
+    finally:
+        for name, original in originals.items():
+            setattr(email_events, name, original)
+
+
+def _signed_request(message: dict) -> dict:
+    from cape_email_plugin.email_settings import MAILGUN_API_KEY, MAILGUN_DOMAIN
+    timestamp, token = str(int(time.time())), uuid4().hex
+    signature = hmac.new(key=MAILGUN_API_KEY.encode(), msg=(timestamp + token).encode(),
+                         digestmod=hashlib.sha256).hexdigest()
+    args = {'recipient': f'{_BENCH_TOKEN}@{MAILGUN_DOMAIN}', 'to': f'{_BENCH_TOKEN}@{MAILGUN_DOMAIN}',
+            'from': message['from'], 'subject': message['subject'], 'body-plain': message['body-plain'],
+            'Message-Id': f'<{token}@example.com>', 'timestamp': timestamp, 'token': token, 'signature': signature}
+    return {'args': args}
+
+
+def bench_handler(corpus: list, iterations: int) -> list:
+    """Full email_question calls, from signature verification to the reply being spooled."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    async def run():
+        durations = []
+        with stubbed_handlers() as email_events:
+            for _ in range(iterations):
+                for message in corpus:
+                    request = _signed_request(message)
+                    start = time.perf_counter()
+                    await email_events.email_question(request)
+                    durations.append(time.perf_counter() - start)
+        return durations
+
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+STAGES = {'body_extraction': bench_body_extraction, 'rendering': bench_rendering, 'handler': bench_handler}
+
+
+def run_benchmarks(size: int = 100, iterations: int = 3, seed: int = 0, stages=tuple(STAGES),
+                   warmup: int = 1) -> dict:
+    corpus = make_corpus(size, seed)
+    results = {}
+    for stage in stages:
+        if warmup:
+            STAGES[stage](corpus, warmup)
+        durations = STAGES[stage](corpus, iterations)
+        results[stage] = dict(summarize(durations), categories=_by_category(corpus, durations))
+    return {'version': VERSION.strip(), 'python': platform.python_version(), 'platform': platform.platform(),
+            'timestamp': datetime.utcnow().isoformat(), 'corpus': {'size': size, 'seed': seed},
+            'iterations': iterations, 'results': results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--size', type=int, default=100, help='number of messages in the corpus')
+    parser.add_argument('--iterations', type=int, default=3, help='timed passes over the corpus')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES))
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    options = parser.parse_args(argv)
+    report = run_benchmarks(options.size, options.iterations, options.seed, options.stages)
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Startup time and memory of a process importing the email handlers, with the backends imported lazily or up front.
+
+Each run is a fresh interpreter that imports cape_email_plugin.email_events, in 'preload' mode it then imports the
+answer, saved reply and document backends as the plugin used to at import time. The import time and the peak
+resident memory of the process are reported, together with the number of modules loaded:
+    python -m cape_email_plugin.tests.benchmark_startup --runs 5 --output startup.json
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+from datetime import datetime
+from statistics import median
+
+from cape_email_plugin.version import VERSION
+
+MODES = ('lazy', 'preload')
+
+_PROBE = '''
+import json, resource, sys, time
+start = time.perf_counter()
+import cape_email_plugin.email_events
+from cape_email_plugin import email_backend
+if sys.argv[1] == 'preload':
+    email_backend.preload()
+seconds = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({'seconds': seconds, 'maxRssKb': rss // 1024 if sys.platform == 'darwin' else rss,
+                  'modules': len(sys.modules)}))
+'''
+
+
+def measure(mode: str) -> dict:
+    output = subprocess.run([sys.executable, '-c', _PROBE, mode], stdout=subprocess.PIPE, check=True)
+    return json.loads(output.stdout.decode().strip().splitlines()[-1])
+
+
+def run_benchmarks(runs: int = 5, modes=MODES) -> dict:
+    results = {}
+    for mode in modes:
+        samples = [measure(mode) for _ in range(runs)]
+        results[mode] = {'importMs': 1000 * median(sample['seconds'] for sample in samples),
+                         'maxRssKb': median(sample['maxRssKb'] for sample in samples),
+                         'modules': samples[-1]['modules']}
+    return {'version': VERSION.strip(), 'python': platform.python_version(), 'platform': platform.platform(),
+            'timestamp': datetime.utcnow().isoformat(), 'runs': runs, 'results': results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5, help='interpreters started per mode, medians are reported')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    options = parser.parse_args(argv)
+    report = run_benchmarks(options.runs, options.modes)
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+In-process stand-in for the parts of Mailgun the plugin uses.
+
+It implements the messages endpoint, the stored events and their storage URLs, and forwards every message sent to
+the receiving domain as a signed webhook to the plugin, routed like the production Mailgun routes:
+    token@domain -> /email/question, id+c@domain -> /email/new-reply, id+e@domain -> /email/request-correction
+With notify=True the webhooks imitate store and notify routes: they only carry metadata and a message-url.
+Start the server under test with CAPE_MAILGUN_API_URL set to FakeMailgun.api_url (and
+CAPE_MAILGUN_STORAGE_HOST_SUFFIX set to its host for notify mode).
+"""
+
+import base64
+import hashlib
+import hmac
+import html
+import json
+import re
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from logging import warning
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+from uuid import uuid4
+
+import requests
+
+_WEBHOOK_ROUTES = {'c': '/email/new-reply', 'e': '/email/request-correction'}
+
+
+def _html_to_text(email_html: str) -> str:
+    text = re.sub(r'<br\s*/?>', '\n', email_html)
+    return html.unescape(re.sub(r'<[^>]+>', '', text))
+
+
+def _address(email: str) -> str:
+    match = re.search(r'<([^>]*)>', email)
+    return (match.group(1) if match else email).strip()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeMailgun:
+    """
+    Records every message sent through it. Messages to receive_domain are also posted to webhook_url, which is the
+    plugin's API root (for instance http://localhost:5050/api). Use send() to play the part of an email client.
+    """
+
+    def __init__(self, api_key: str, receive_domain: str, webhook_url: str, host: str = 'localhost', port: int = 0,
+                 notify: bool = False):
+        self.api_key = api_key
+        self.receive_domain = receive_domain.lower()
+        self.webhook_url = webhook_url
+        self.host = host
+        self.notify = notify
+        self.stored = {}
+        self._events = []
+        self._condition = threading.Condition()
+        self._server = _ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self._server.server_address[1]}'
+
+    @property
+    def api_url(self) -> str:
+        return f'{self.url}/v3'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def send(self, email_from: str, email_to: str, email_subject: str, email_html: str = None,
+             email_text: str = None, deliver_webhook: bool = True) -> dict:
+        """Accept a message as Mailgun would, returns the stored message."""
+        email_text = email_text if email_text is not None else _html_to_text(email_html or '')
+        sender = _address(email_from)
+        message = {'from': email_from, 'From': email_from, 'Sender': sender, 'sender': sender,
+                   'To': email_to, 'recipients': email_to, 'subject': email_subject, 'Subject': email_subject,
+                   'body-plain': email_text, 'stripped-text': email_text, 'body-html': email_html or email_text,
+                   'Message-Id': f'<{uuid4().hex}@{self.receive_domain}>', 'attachments': []}
+        key = uuid4().hex
+        with self._condition:
+            self.stored[key] = message
+            self._events.append((_address(email_to).lower(), key))
+            self._condition.notify_all()
+        if deliver_webhook and _address(email_to).lower().endswith('@' + self.receive_domain):
+            threading.Thread(target=self._post_webhook, args=(message, _address(email_to)), daemon=True).start()
+        return message
+
+    def messages(self, email_to: str) -> list:
+        """Messages sent to an address, oldest first."""
+        with self._condition:
+            return [self.stored[key] for to, key in self._events if to == email_to.lower()]
+
+    def wait_for(self, email_to: str, count: int = 1, timeout: float = 10) -> dict:
+        """Block until at least count messages were sent to email_to and return the last one."""
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                messages = [self.stored[key] for to, key in self._events if to == email_to.lower()]
+                if len(messages) >= count:
+                    return messages[-1]
+                if not self._condition.wait(deadline - time.time()):
+                    raise TimeoutError(f'No message #{count} for {email_to} after {timeout}s')
+
+    def storage_url(self, key: str, domain: str = None) -> str:
+        return f'{self.url}/v3/domains/{domain or self.receive_domain}/messages/{key}'
+
+    def webhook_payload(self, message: dict, recipient: str, notify: bool = None) -> dict:
+        """Signed form of a forward route, or of a store and notify route (the default in notify mode)."""
+        notify = self.notify if notify is None else notify
+        timestamp = str(int(time.time()))
+        token = uuid4().hex
+        signature = hmac.new(key=self.api_key.encode(), msg=(timestamp + token).encode(),
+                             digestmod=hashlib.sha256).hexdigest()
+        if not notify:
+            return dict(message, recipient=recipient, to=message['To'], timestamp=timestamp, token=token,
+                        signature=signature)
+        with self._condition:
+            key = next(key for key, stored in self.stored.items() if stored is message)
+        headers = [['From', message['From']], ['To', message['To']], ['Subject', message['Subject']]]
+        return {'recipient': recipient, 'sender': message['sender'], 'from': message['from'], 'to': message['To'],
+                'subject': message['subject'], 'Message-Id': message['Message-Id'],
+                'message-headers': json.dumps(headers), 'message-url': self.storage_url(key),
+                'timestamp': timestamp, 'token': token, 'signature': signature}
+
+    def _post_webhook(self, message: dict, recipient: str):
+        local_part = recipient.split('@')[0]
+        _, plus, suffix = local_part.rpartition('+')
+        route = _WEBHOOK_ROUTES.get(suffix[:1]) if plus else '/email/question'
+        if route is None:
+            return
+        payload = self.webhook_payload(message, recipient)
+        payload.pop('attachments', None)
+        try:
+            requests.post(self.webhook_url + route, data=payload, timeout=60)
+        except requests.RequestException as e:
+            warning("Fake Mailgun could not deliver webhook to %s: %s" % (route, e))
+
+    def _messages_endpoint(self, form: dict):
+        recipients = form.get('to', [])
+        recipient_variables = json.loads(form.get('recipient-variables', ['{}'])[0])
+        for recipient in recipients:
+            variables = recipient_variables.get(recipient, {})
+
+            def substitute(value):
+                if value is None:
+                    return None
+                return re.sub(r'%recipient\.(\w+)%', lambda match: str(variables.get(match.group(1), '')), value)
+
+            self.send(form['from'][0], recipient, substitute(form['subject'][0]),
+                      substitute(form.get('html', [None])[0]), substitute(form.get('text', [None])[0]))
+        return {'id': f'<{uuid4().hex}@{self.receive_domain}>', 'message': 'Queued. Thank you.'}
+
+    def _events_endpoint(self, domain: str, query: dict):
+        email_to = query.get('to', [''])[0].lower()
+        limit = int(query.get('limit', ['300'])[0])
+        with self._condition:
+            keys = [key for to, key in self._events if not email_to or to == email_to]
+        if query.get('ascending', ['yes'])[0] == 'no':
+            keys.reverse()
+        return {'items': [{'event': 'stored',
+                           'storage': {'key': key, 'url': self.storage_url(key, domain)}}
+                          for key in keys[:limit]]}
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def _authorized(self) -> bool:
+                expected = 'Basic ' + base64.b64encode(f'api:{fake.api_key}'.encode()).decode()
+                if self.headers.get('Authorization') == expected:
+                    return True
+                self._respond(401, {'message': 'Forbidden'})
+                return False
+
+            def _respond(self, status: int, body: dict):
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_POST(self):
+                path = urlparse(self.path).path
+                if not self._authorized():
+                    return
+                if re.fullmatch(r'/v3/[^/]+/messages', path):
+                    length = int(self.headers.get('Content-Length', 0))
+                    form = parse_qs(self.rfile.read(length).decode(), keep_blank_values=True)
+                    self._respond(200, fake._messages_endpoint(form))
+                else:
+                    self._respond(404, {'message': 'Not found'})
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                if not self._authorized():
+                    return
+                events = re.fullmatch(r'/v3/([^/]+)/events', parsed.path)
+                storage = re.fullmatch(r'/v3/domains/[^/]+/messages/(\w+)', parsed.path)
+                if events:
+                    self._respond(200, fake._events_endpoint(events.group(1), parse_qs(parsed.query)))
+                elif storage and storage.group(1) in fake.stored:
+                    self._respond(200, fake.stored[storage.group(1)])
+                else:
+                    self._respond(404, {'message': 'Not found'})
+
+        return Handler
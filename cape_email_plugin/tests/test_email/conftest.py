@@ -14,7 +14,9 @@
 
 from cape.client import CapeClient, CapeException
 import pytest
-from cape_email_plugin.tests.tests_settings import URL
+from cape_email_plugin.email_settings import MAILGUN_API_KEY
+from cape_email_plugin.tests.fake_mailgun import FakeMailgun
+from cape_email_plugin.tests.tests_settings import URL, TEST_RECEIVE_EMAIL_DOMAIN, FAKE_MAILGUN_PORT
 from cape_webservices import webservices_settings
 
 API_URL = URL + '/api'
@@ -60,3 +62,10 @@ def email_cape_client():
     client = _init_user(LOGIN, PASSWORD, {})
     yield client
     client.logout()
+
+
+@pytest.fixture(scope="function", params=['forward', 'notify'])
+def fake_mailgun(request):
+    with FakeMailgun(MAILGUN_API_KEY, TEST_RECEIVE_EMAIL_DOMAIN, API_URL, port=FAKE_MAILGUN_PORT,
+                     notify=request.param == 'notify') as fake:
+        yield fake
@@ -0,0 +1,59 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import uuid
+
+import pytest
+
+from cape_email_plugin.email_addresses import reply_local_part, parse_local_part, ReplyAddress
+
+_KEY = b'test key'
+
+
+def test_signed_addresses_round_trip():
+    event_id = uuid.uuid4().hex
+    local_part = reply_local_part(event_id, 'alice', 'c', signed=True, key=_KEY)
+    assert len(local_part) <= 64 and local_part.endswith('+c')  # matched by the same routes as legacy addresses
+    assert local_part == local_part.lower()
+    assert parse_local_part(local_part, _KEY) == ReplyAddress(event_id, 'alice', 'c', True)
+    assert parse_local_part(local_part.upper(), _KEY) == ReplyAddress(event_id, 'alice', 'c', True)
+
+
+def test_legacy_and_token_addresses_are_still_parsed():
+    event_id = uuid.uuid4().hex
+    assert reply_local_part(event_id, 'alice', 'e', signed=False) == f'{event_id}+e'
+    assert parse_local_part(f'{event_id}+e') == ReplyAddress(event_id, None, 'e', False)
+    assert parse_local_part('0123456789abcdef') is None
+
+
+def test_long_user_ids_are_left_out_of_signed_addresses():
+    event_id = uuid.uuid4().hex
+    user_id = 'alice.longname@example.com'
+    local_part = reply_local_part(event_id, user_id, 'e', signed=True, key=_KEY)
+    assert len(local_part) <= 64 and local_part.endswith('+e')
+    assert parse_local_part(local_part, _KEY) == ReplyAddress(event_id, None, 'e', True)
+    assert len(reply_local_part(event_id, 'a' * 11, 'c', signed=True, key=_KEY).split('.')) == 4
+
+
+def test_forged_addresses_are_refused():
+    event_id = uuid.uuid4().hex
+    local_part = reply_local_part(event_id, 'alice', 'c', signed=True, key=_KEY)
+    other_user = reply_local_part(event_id, 'bob', 'c', signed=True, key=_KEY)
+    version, event, _, signature = local_part.split('.')
+    forged = '.'.join((version, event, other_user.split('.')[2], signature))
+    for address in (forged, local_part.replace('+c', '+e'), '2' + local_part[1:], 'x+z', '+c'):
+        with pytest.raises(ValueError):
+            parse_local_part(address, _KEY)
+    with pytest.raises(ValueError):
+        parse_local_part(local_part, b'another key')
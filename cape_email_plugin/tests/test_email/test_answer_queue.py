@@ -0,0 +1,122 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+
+import pytest
+
+from cape_email_plugin.answer_queue import AnswerQueue
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+def test_jobs_are_run_and_failures_counted():
+    queue = AnswerQueue(workers=2, maxsize=10)
+    done = []
+
+    async def answer(number):
+        if number == 3:
+            raise ValueError('responder failed')
+        done.append(number)
+
+    async def webhooks():
+        queue.start()
+        for number in range(5):
+            await queue.submit(answer, number)
+        await queue.stop()
+
+    _run(webhooks())
+    assert sorted(done) == [0, 1, 2, 4]
+    stats = queue.stats()
+    assert (stats['processed'], stats['failed'], stats['depth']) == (4, 1, 0)
+
+
+def test_submit_waits_while_the_queue_is_full():
+    queue = AnswerQueue(workers=1, maxsize=1)
+
+    async def webhooks():
+        release = asyncio.Event()
+
+        async def answer():
+            await release.wait()
+
+        queue.start()
+        await queue.submit(answer)  # taken by the worker
+        await asyncio.sleep(0)
+        await queue.submit(answer)  # fills the queue
+        overflow = asyncio.ensure_future(queue.submit(answer))
+        await asyncio.sleep(0.05)
+        assert not overflow.done() and queue.stats()['depth'] == 1
+        release.set()
+        await asyncio.wait_for(overflow, 1)
+        await queue.stop()
+        return queue.stats()['processed']
+
+    assert _run(webhooks()) == 3
+
+
+def test_submit_before_start_fails():
+    async def answer():
+        pass
+
+    with pytest.raises(RuntimeError):
+        _run(AnswerQueue(workers=1, maxsize=1).submit(answer))
+
+
+def test_blocking_calls_run_on_the_thread_pool():
+    queue = AnswerQueue(workers=1, maxsize=1)
+    loop_thread = threading.get_ident()
+    assert _run(queue.run_blocking(threading.get_ident)) != loop_thread
+    assert _run(queue.run_blocking(pow, 2, 10)) == 1024
+
+
+def test_stop_drains_queued_and_running_jobs_then_drops_the_rest():
+    done = []
+
+    async def answer(number, seconds):
+        await asyncio.sleep(seconds)
+        done.append(number)
+
+    async def shutdown(timeout):
+        queue = AnswerQueue(workers=1, maxsize=10)
+        queue.start()
+        await queue.submit(answer, 1, 0.01)
+        await queue.submit(answer, 2, 0.01)
+        await queue.submit(answer, 3, 10)
+        await asyncio.sleep(0)  # the first job is running, the queue holds the others
+        await queue.stop(timeout)
+
+    _run(shutdown(timeout=0.5))
+    assert done == [1, 2]  # the third job did not finish within the timeout and was cancelled
+
+    done.clear()
+
+    async def running_only():
+        queue = AnswerQueue(workers=1, maxsize=10)
+        queue.start()
+        await queue.submit(answer, 1, 0.05)
+        await asyncio.sleep(0.01)  # running, nothing left in the queue
+        await queue.stop()
+
+    _run(running_only())
+    assert done == [1]
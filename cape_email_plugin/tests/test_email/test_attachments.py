@@ -0,0 +1,83 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+from collections import namedtuple
+from types import SimpleNamespace
+
+from cape_email_plugin import email_attachments
+from cape_email_plugin.email_attachments import attachments, is_text, text_parts, UPLOADED, FAILED
+from cape_email_plugin.email_store import STORED_MESSAGE
+
+File = namedtuple('File', ['type', 'body', 'name'])
+
+
+class _Request(dict):
+
+    def __init__(self, args, files=None):
+        super().__init__(args=args)
+        self.files = files or {}
+
+
+def test_only_text_attachments_are_ingested():
+    assert is_text('notes.txt', 'text/plain; charset="latin-1"')
+    assert is_text('faq.md', 'application/octet-stream')
+    assert not is_text('report.pdf', 'application/pdf')
+    assert not is_text('page.html', 'text/html')
+
+
+def test_text_is_split_in_bounded_parts_at_line_ends():
+    text = ''.join(f'line {number} é\n' for number in range(10000))
+    parts = list(text_parts(io.BytesIO(text.encode('utf-8')), 'utf-8', part_chars=1000))
+    assert ''.join(parts) == text
+    assert all(len(part) <= 1000 and part.endswith('\n') for part in parts)
+    assert list(text_parts(io.BytesIO('café'.encode('latin-1')), 'latin-1', 10)) == ['café']
+
+
+def test_files_and_stored_attachments_are_listed():
+    stored = json.dumps([{'url': 'https://storage/1', 'name': 'faq.txt', 'size': 3, 'content-type': 'text/plain'}])
+    request = _Request({'attachments': stored}, {'attachment-1': [File('text/plain', b'hello', 'hello.txt')]})
+    request[STORED_MESSAGE] = True
+    found = attachments(request)
+    assert [(item['name'], item['size']) for item in found] == [('hello.txt', 5), ('faq.txt', 3)]
+    assert found[1]['url'] == 'https://storage/1'
+
+
+def test_attachment_urls_of_forwarded_messages_are_ignored():
+    stored = json.dumps([{'url': 'http://169.254.169.254/', 'name': 'faq.txt', 'content-type': 'text/plain'}])
+    assert attachments(_Request({'attachments': stored})) == []
+
+
+def test_only_mailgun_storage_urls_are_fetched(monkeypatch):
+    fetched = []
+
+    class _Response:
+        def raise_for_status(self):
+            pass
+
+        def iter_content(self, size):
+            return [b'hello']
+
+    monkeypatch.setattr(email_attachments.sender.session, 'get',
+                        lambda url, **kwargs: fetched.append(url) or _Response())
+    monkeypatch.setattr(email_attachments, 'upload_document', lambda request: SimpleNamespace(
+        body=json.dumps({'result': {'documentId': request['args']['documentId']}})))
+    urls = ['https://se.api.mailgun.net/v3/domains/x/messages/1/attachments/0', 'http://169.254.169.254/latest/']
+    request = _Request({'attachments': json.dumps([{'url': url, 'name': 'faq.txt', 'size': 5,
+                                                    'content-type': 'text/plain'} for url in urls])})
+    request[STORED_MESSAGE] = True
+    results = email_attachments.ingest_attachments(request, 'email-x')
+    assert [result['status'] for result in results] == [UPLOADED, FAILED]
+    assert fetched == urls[:1]
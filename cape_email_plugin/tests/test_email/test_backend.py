@@ -0,0 +1,34 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+
+import pytest
+
+from cape_email_plugin.email_backend import LazyFunction
+
+
+def test_backend_is_imported_on_first_call():
+    sys.modules.pop('colorsys', None)
+    backend = LazyFunction('colorsys:rgb_to_hsv')
+    assert not backend.loaded and 'colorsys' not in sys.modules
+    assert backend(1.0, 0.0, 0.0) == (0.0, 1.0, 1.0)
+    assert backend.loaded and backend.stats()['loadSeconds'] is not None
+
+
+def test_missing_backend_fails_when_called():
+    backend = LazyFunction('cape_email_plugin.email_settings:no_such_function')
+    with pytest.raises(AttributeError):
+        backend()
+    assert not backend.loaded
@@ -0,0 +1,48 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+import time
+
+from cape_email_plugin.answer_batcher import AnswerBatcher
+
+
+def test_identical_questions_are_merged_and_distinct_ones_run_in_parallel():
+    calls, threads = [], set()
+
+    def answer_function(request):
+        calls.append(request['args']['question'])
+        threads.add(threading.get_ident())
+        time.sleep(0.2)
+        return request['args']['question'].upper()
+
+    batcher = AnswerBatcher(answer_function, window=50, max_size=10)
+    questions = ['What colour is the sky?', 'what colour is  the sky?', 'How tall is the tower?']
+
+    async def burst():
+        return await asyncio.gather(*(batcher.answer({'args': {'token': 'token', 'question': question}})
+                                      for question in questions))
+
+    loop = asyncio.new_event_loop()
+    try:
+        start = time.perf_counter()
+        results = loop.run_until_complete(burst())
+        seconds = time.perf_counter() - start
+    finally:
+        loop.close()
+    assert len(calls) == 2 and results[0] == results[1] == 'WHAT COLOUR IS THE SKY?'
+    assert results[2] == 'HOW TALL IS THE TOWER?'
+    assert len(threads) == 2 and seconds < 0.4
+    assert batcher.stats()['batches'] == 1
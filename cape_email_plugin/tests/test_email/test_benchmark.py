@@ -0,0 +1,31 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+from cape_email_plugin.tests.benchmark_emails import make_corpus, run_benchmarks, CATEGORIES
+
+
+def test_corpus_is_reproducible():
+    assert make_corpus(20, seed=3) == make_corpus(20, seed=3)
+    assert {message['category'] for message in make_corpus(len(CATEGORIES))} == set(CATEGORIES)
+
+
+def test_benchmark_report_is_json():
+    report = json.loads(json.dumps(run_benchmarks(size=10, iterations=1, stages=('body_extraction', 'rendering'))))
+    for stage in ('body_extraction', 'rendering'):
+        result = report['results'][stage]
+        assert result['count'] == 10
+        assert result['p50'] <= result['p95'] <= result['p99'] <= result['max']
+        assert set(result['categories']) == set(CATEGORIES)
@@ -0,0 +1,95 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import re
+
+import pytest
+import quotequail
+
+from cape_email_plugin.email_body import BodyExtractor, body_extractor
+
+_GREETINGS = {"hola", "hi", "dear", "hey", "hello", "morning", "afternoon", "evening", "bonjour"}
+_BYES = {"thank", "bye", "regards", "cheers", "sincerely", "ciao", "best", "bgif", "soon", "cordially", "yours", "sent",
+         "--", "goodbye"}
+NON_WORD_CHARS = re.compile(r'[^0-9a-zA-Z\s]')
+
+
+def _simple_heuristic(line: str, lookup_set: set = _GREETINGS, first_words: int = 3) -> bool:
+    line = re.sub(NON_WORD_CHARS, "", line)
+    words = line.split()[:first_words]
+    return bool(lookup_set.intersection(word.lower() for word in words))
+
+
+def _reference_get_body(text: str):
+    """The per line implementation the extractor replaced, its output is the reference."""
+    unwrapped_text = quotequail.unwrap(text)
+    if unwrapped_text is None:
+        stripped_text = text
+    elif 'text_top' in unwrapped_text:
+        stripped_text = unwrapped_text['text_top']
+    elif 'text_bottom' in unwrapped_text:
+        stripped_text = unwrapped_text['text_bottom']
+    lines = [line.strip() for line in stripped_text.replace('\r\n', '\n').split('\n') if line.strip()]
+    if len(lines) > 1 and _simple_heuristic(lines[0]):
+        lines.pop(0)
+    for idx in range(1, len(lines) - 1):
+        if _simple_heuristic(lines[idx], _BYES):
+            lines = lines[:idx]
+            break
+    return "\n".join(lines)
+
+
+_CORPUS = [
+    "What colour is the sky ?",
+    "Hello 1234,\nWhat colour is the sky ?\nRegards,\nBob",
+    "Hi Alice!\r\n\r\nWhat are your opening hours?\r\nThanks a lot\r\nBob",
+    "Dear Sir or Madam,\nI would like to know the price.\nBest,\nBob\nSent from my iPhone",
+    "Hello\nBye",
+    "Hola,\n¿Cuál es el horario?\nCiao,\nBob",
+    "Bonjour,\nQuelle heure est-il ?\nCordially yours\n--\nBob",
+    "Good morning team,\nIs the office open?\n-- \nBob",
+    "héllo there,\nIs it open?\nKind regárds\nBob",
+    "Hello,\nThe sky is blue.\n\nOn Mon, Feb 19, 2018 at 10:00 AM Bob <bob@example.com> wrote:\n> What colour is the sky?\n"
+    "> Regards,\n> Bob",
+    "What about this?\n\n-----Original Message-----\nFrom: Bob\nSent: Monday\nSubject: Question\n\nHello,\nOld stuff",
+    "Line one\nLine two\nLine three without any sign off",
+]
+
+
+@pytest.mark.parametrize('text', _CORPUS)
+def test_extract_matches_reference(text):
+    assert body_extractor.extract(text) == _reference_get_body(text)
+
+
+def test_extract_matches_reference_on_random_messages():
+    vocabulary = list(_GREETINGS | _BYES) + ['Hello,', 'HI!', 'h-i', 'Thanks', 'thank-you', 'Best,', '-', '...',
+                                             'héllo', 'sky', 'colour', 'what', 'is', '?', 'Kind', 'bye.', '"dear"']
+    generator = random.Random(0)
+    for _ in range(2000):
+        lines = [generator.choice([' ', '  ', '\t']).join(generator.choice(vocabulary)
+                                                          for _ in range(generator.randint(0, 5)))
+                 for _ in range(generator.randint(0, 7))]
+        text = generator.choice(['\n', '\r\n']).join(lines)
+        assert body_extractor.extract(text) == _reference_get_body(text)
+
+
+def test_extract_many():
+    assert body_extractor.extract_many(_CORPUS) == [_reference_get_body(text) for text in _CORPUS]
+
+
+def test_languages():
+    text = "Hola,\nWhat colour is the sky ?\nRegards,\nBob"
+    assert BodyExtractor(['es']).extract(text) == "What colour is the sky ?\nRegards,\nBob"
+    assert BodyExtractor(['en']).extract(text) == "Hola,\nWhat colour is the sky ?"
@@ -0,0 +1,72 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+from cape_email_plugin.cache import TTLCache
+from cape_email_plugin.answer_cache import AnswerCache
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats()['hits'] == 3 and cache.stats()['misses'] == 1
+
+
+def test_ttl_cache_expires_entries():
+    cache = TTLCache(maxsize=10, ttl=0.01)
+    cache.set('a', 1)
+    time.sleep(0.02)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_answer_cache_normalizes_and_invalidates_per_user():
+    cache = AnswerCache(maxsize=10, ttl=60)
+    cache.set(cache.key('token', 'What are your  opening hours?', '3'), ['answer'])
+    assert cache.get(cache.key('token', 'what are your opening hours?', '3')) == ['answer']
+    assert cache.get(cache.key('other-token', 'what are your opening hours?', '3')) is None
+    assert cache.get(cache.key('token', 'what are your opening hours?', '1', '3')) is None
+    stale_key = cache.key('token', 'Where are you?', '3')
+    cache.invalidate_user('token')
+    cache.set(stale_key, ['stale'])
+    assert cache.get(cache.key('token', 'What are your opening hours?', '3')) is None
+    assert cache.get(cache.key('token', 'Where are you?', '3')) is None
+
+
+def test_answer_cache_generations_are_bounded_and_never_reused():
+    cache = AnswerCache(maxsize=2, ttl=60)
+    for number in range(100):
+        cache.invalidate_user(f'token{number}')
+    assert len(cache._generations) == 2
+    cache.set(cache.key('token', 'Where are you?', '3'), ['old'])
+    cache.invalidate_user('token')
+    cache.set(cache.key('token', 'Where are you?', '3'), ['new'])
+    cache.invalidate_user('token')
+    assert cache.get(cache.key('token', 'Where are you?', '3')) is None
+
+
+def test_answer_cache_entries_stay_invalid_once_their_generation_is_evicted():
+    cache = AnswerCache(maxsize=2, ttl=60)
+    cache.set(cache.key('token', 'Where are you?', '3'), ['deleted reply'])
+    cache.invalidate_user('token')
+    cache.key('other1', 'Where are you?', '3')
+    cache.key('other2', 'Where are you?', '3')
+    assert cache._generations.get('token') is None
+    assert cache.get(cache.key('token', 'Where are you?', '3')) is None
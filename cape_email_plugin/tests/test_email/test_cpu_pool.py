@@ -0,0 +1,92 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import os
+import time
+
+from cape_email_plugin.cpu_pool import CpuPool
+from cape_email_plugin.email_body import extract_body, body_extractor
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def _pid(text: str) -> int:
+    return os.getpid()
+
+
+def _slow(text: str) -> str:
+    time.sleep(10)
+    return text
+
+
+def _pause(text: str) -> str:
+    time.sleep(0.8)
+    return text
+
+
+def _fallback(text: str) -> str:
+    return 'fallback'
+
+
+def test_small_calls_run_inline_and_large_ones_in_the_pool():
+    pool = CpuPool(workers=1, timeout=30, inline_chars=100)
+    try:
+        assert _run(pool.run(_fallback, _pid, 'short')) == os.getpid()
+        assert _run(pool.run(_fallback, _pid, 'x' * 100)) != os.getpid()
+        text = 'Hi,\n' + 'What colour is the sky?\n' * 50 + 'Thanks'
+        assert _run(pool.run(_fallback, extract_body, text)) == body_extractor.extract(text)
+        assert pool.stats()['inline'] == 1 and pool.stats()['offloaded'] == 2
+    finally:
+        pool.stop()
+
+
+def test_slow_calls_fall_back_and_the_pool_recovers():
+    pool = CpuPool(workers=1, timeout=0.5, inline_chars=1)
+    try:
+        started = time.perf_counter()
+        assert _run(pool.run(_fallback, _slow, 'text')) == 'fallback'
+        assert time.perf_counter() - started < 5
+        assert pool.stats()['timeouts'] == 1
+        assert _run(pool.run(_fallback, _pid, 'text')) != os.getpid()
+    finally:
+        pool.stop()
+
+
+def test_a_timed_out_call_only_replaces_its_own_process():
+    pool = CpuPool(workers=2, timeout=1, inline_chars=1)
+
+    async def burst():
+        pool.start()
+        slow = asyncio.ensure_future(pool.run(_fallback, _slow, 'text'))
+        await asyncio.sleep(0.5)
+        paused = asyncio.ensure_future(pool.run(_fallback, _pause, 'text'))  # still running when slow times out
+        await asyncio.sleep(0.1)
+        waiting = asyncio.ensure_future(pool.run(_fallback, _pid, 'text'))  # both processes are busy
+        return await asyncio.gather(slow, paused, waiting)
+
+    try:
+        slow, paused, waited = _run(burst())
+        assert slow == 'fallback' and paused == 'text'
+        assert waited != os.getpid()
+        assert pool.stats()['timeouts'] == 1 and pool.stats()['failed'] == 0
+        assert len(pool._executors) == 2
+    finally:
+        pool.stop()
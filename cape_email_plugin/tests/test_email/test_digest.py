@@ -0,0 +1,38 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+from cape_email_plugin import email_digest
+from cape_email_plugin.email_digest import DigestQueue
+
+
+def test_items_are_only_deleted_once_spooled(tmp_path, monkeypatch):
+    queue = DigestQueue(path=str(tmp_path / 'spool.sqlite3'), interval=60)
+    loop = asyncio.new_event_loop()
+    try:
+        for number in range(3):
+            loop.run_until_complete(queue.add(f'alice{number % 2}@example.com', f'event{number}',
+                                              f'event{number}+c@example.com', 'Sky', 'text', 'html'))
+        digests = queue.take()
+        assert [len(items) for items in digests.values()] == [2, 1]
+        assert queue.take() == {}  # claimed, another process does not send them too
+        loop.run_until_complete(queue.remove([item['id'] for item in digests['alice0@example.com']]))
+    finally:
+        loop.close()
+    monkeypatch.setattr(email_digest, '_CLAIM_LEASE', 0)
+    assert queue.take() == {}  # the lease taken above still holds
+    monkeypatch.setattr(email_digest.time, 'time', lambda: 1e12)
+    retaken = queue.take()  # the sender stopped before spooling alice1's digest
+    assert list(retaken) == ['alice1@example.com'] and retaken['alice1@example.com'][0]['event_id'] == 'event1'
@@ -0,0 +1,118 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from peewee import SqliteDatabase, Model, CharField, IntegrityError
+
+from cape_email_plugin import email_lookups
+from cape_email_plugin.event_writer import EventWriter
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_saves_are_batched_coalesced_and_flushed_on_stop():
+    batches = []
+    writer = EventWriter(lambda batch: batches.append([event.unique_id for event in batch]), interval=60,
+                         batch_size=2, maxsize=10)
+
+    async def webhooks():
+        writer.start()
+        first = SimpleNamespace(unique_id='first')
+        await writer.add(first)
+        await writer.add(first)  # saved twice before being written, written once
+        assert writer.pending('first') is first and batches == []
+        await writer.add(SimpleNamespace(unique_id='second'))  # a full batch wakes the writer up
+        await asyncio.sleep(0.1)
+        await writer.add(SimpleNamespace(unique_id='third'))
+        await writer.stop()
+
+    _run(webhooks())
+    assert batches == [['first', 'second'], ['third']]
+    assert writer.pending('third') is None and writer.stats()['written'] == 3
+
+
+def test_full_buffer_waits_and_failed_batches_are_retried():
+    batches, failures = [], [1, 1, 1]  # the database is down for the first batch and its events written alone
+
+    def write_batch(batch):
+        if failures:
+            failures.pop()
+            raise IOError('database unavailable')
+        batches.append([event.unique_id for event in batch])
+
+    writer = EventWriter(write_batch, interval=0.05, batch_size=10, maxsize=2)
+
+    async def webhooks():
+        writer.start()
+        for number in range(4):
+            await writer.add(SimpleNamespace(unique_id=str(number)))
+        await writer.stop()
+
+    _run(webhooks())
+    assert sum(batches, []) == ['0', '1', '2', '3']
+    assert writer.stats()['waits'] >= 1 and writer.stats()['failed'] == 2
+
+
+def test_an_event_that_cannot_be_written_does_not_hold_back_the_others():
+    written = []
+
+    def write_batch(batch):
+        if any(event.unique_id == 'bad' for event in batch):
+            raise ValueError('constraint violated')
+        written.extend(event.unique_id for event in batch)
+
+    writer = EventWriter(write_batch, interval=60, batch_size=10, maxsize=10, max_failures=2)
+
+    async def webhooks():
+        writer.start()
+        for unique_id in ('first', 'bad', 'second'):
+            await writer.add(SimpleNamespace(unique_id=unique_id))
+        assert not await writer.flush()
+        assert written == ['first', 'second'] and writer.pending('bad') is not None
+        await writer.add(SimpleNamespace(unique_id='third'))
+        assert await writer.flush()
+        await writer.stop()
+
+    _run(webhooks())
+    assert written == ['first', 'second', 'third']
+    assert writer.stats()['dropped'] == 1 and writer.stats()['failed'] == 2 and writer._failures == {}
+
+
+def test_new_events_of_a_failed_batch_are_inserted_on_retry(monkeypatch):
+    database = SqliteDatabase(':memory:')
+
+    class Event(Model):
+        unique_id = CharField(unique=True)
+        question_email_sender = CharField()
+
+    Event.bind(database)
+    database.create_tables([Event])
+    monkeypatch.setattr(email_lookups, 'EmailEvent', Event)
+    batch = [Event(unique_id='first', question_email_sender='bob@example.com'), Event(unique_id='second')]
+    with pytest.raises(IntegrityError):  # the second event is missing a column, the batch is rolled back
+        email_lookups._write_events(batch)
+    assert Event.select().count() == 0
+    batch[1].question_email_sender = 'ann@example.com'
+    email_lookups._write_events(batch)
+    assert sorted(event.unique_id for event in Event.select()) == ['first', 'second']
+    database.close()
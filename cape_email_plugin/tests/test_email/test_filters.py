@@ -0,0 +1,64 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+from cape_email_plugin.email_filters import MailFilter, RateLimiter, automated_reason, sender_authenticated, DROP, \
+    DEFER
+
+
+def _email(sender='Bob <bob@example.com>', **headers):
+    return {'from': sender, 'subject': 'Question', 'message-headers': json.dumps(list(headers.items()))}
+
+
+def test_automated_emails_are_recognised():
+    assert automated_reason(_email()) is None
+    assert automated_reason(_email(**{'Auto-Submitted': 'no'})) is None
+    assert automated_reason(_email(**{'Auto-Submitted': 'auto-replied'})) == 'Auto-Submitted: auto-replied'
+    assert automated_reason(_email(**{'X-Autoreply': 'yes'})) == 'x-autoreply'
+    assert automated_reason(_email(Precedence='Bulk')) == 'Precedence: bulk'
+    assert automated_reason(_email(Precedence='list')) is None  # questions forwarded by a mailing list
+    assert automated_reason(_email(sender='MAILER-DAEMON@example.com')) == 'bounce'
+    assert automated_reason(dict(_email(), **{'Return-Path': '<>'})) == 'bounce'
+
+
+def test_rate_limiter_allows_bursts_then_refills():
+    limiter = RateLimiter(rate=60, burst=2)
+    assert limiter.allow('a') and limiter.allow('a')
+    assert not limiter.allow('a')
+    assert limiter.allow('b')
+    assert RateLimiter(rate=0, burst=0).allow('a')
+
+
+def test_filter_drops_floods_and_defers_busy_tokens():
+    mail_filter = MailFilter(token_limiter=RateLimiter(60, 1), sender_limiter=RateLimiter(60, 2))
+    assert mail_filter.check(_email(**{'X-Autorespond': 'yes'}), 'token') == (DROP, 'x-autorespond')
+    assert mail_filter.check(_email(), 'token') == (None, None)
+    assert mail_filter.check(_email(sender='ann@example.com'), 'token') == (DEFER, 'token rate limit')
+    assert mail_filter.check(_email(), 'event+c') == (None, None)
+    assert mail_filter.check(_email(), 'event+c') == (DEFER, 'sender rate limit')  # the owner answering a digest
+    assert mail_filter.check(_email(), 'token') == (DROP, 'sender rate limit')
+    assert mail_filter.stats() == {'dropped': {'x-autorespond': 1, 'sender rate limit': 1}, 'deferred': 2}
+
+
+def test_senders_are_authenticated_by_mailgun_checks_not_by_their_own_headers():
+    assert not sender_authenticated(_email())
+    assert sender_authenticated(_email(**{'X-Mailgun-Spf': 'Pass'}))
+    assert sender_authenticated(_email(**{'X-Mailgun-Dkim-Check-Result': 'Pass'}))
+    forged = {'from': 'alice@example.com', 'X-Mailgun-Spf': 'Pass',
+              'message-headers': json.dumps([['X-Mailgun-Spf', 'Fail'], ['X-Mailgun-Spf', 'Pass']])}
+    assert not sender_authenticated(forged)
+    written_by_sender = [['X-Mailgun-Spf', 'Neutral'], ['Received', 'by mxa.mailgun.org'],
+                         ['Received', 'by mail.example.com'], ['X-Mailgun-Dkim-Check-Result', 'Pass']]
+    assert not sender_authenticated({'message-headers': json.dumps(written_by_sender)})
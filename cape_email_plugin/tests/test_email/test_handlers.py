@@ -0,0 +1,122 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+from types import SimpleNamespace
+
+from api_helpers.text_responses import MAILGUN_INVALID_SIGNATURE
+
+from cape_email_plugin import email_events
+from cape_email_plugin.email_filters import MailFilter, RateLimiter, ERROR_EMAIL_RATE_LIMITED
+from cape_email_plugin.email_digest import DIGEST_LOCAL_PART
+from cape_email_plugin.email_replay import _Outbox, _resign, replay_handlers
+from cape_email_plugin.email_settings import MAILGUN_DOMAIN
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_handler_errors_are_serialized_like_the_synchronous_endpoints():
+    request = {'args': {'recipient': f'token@{MAILGUN_DOMAIN}', 'from': 'bob@example.com', 'subject': 'Sky',
+                        'body-plain': 'What colour is the sky?', 'timestamp': '1518798384', 'token': 'forged',
+                        'signature': 'forged'}}
+    response = _run(email_events.email_question(request))
+    body = json.loads(response.body)
+    assert body['success'] is False and MAILGUN_INVALID_SIGNATURE in json.dumps(body['result'])
+
+
+def test_monitoring_endpoints_need_the_monitoring_key(monkeypatch):
+    monkeypatch.setattr(email_events, 'EMAIL_MONITORING_KEY', '')
+    assert email_events.email_metrics({'args': {}}).status == 404
+    monkeypatch.setattr(email_events, 'EMAIL_MONITORING_KEY', 'secret')
+    assert email_events.email_metrics({'args': {'monitoringKey': 'guess'}}).status == 403
+    assert email_events.email_stats({'args': {}}).status == 403
+    assert email_events.email_metrics({'args': {'monitoringKey': 'secret'}}).status == 200
+    assert json.loads(email_events.email_stats({'args': {'monitoringKey': 'secret'}}).body)['success']
+
+
+def test_replies_to_a_digest_are_answered_with_instructions(monkeypatch):
+    outbox = _Outbox()
+    monkeypatch.setattr(email_events, 'spool', outbox)
+    args = {'recipient': f'{DIGEST_LOCAL_PART}@{MAILGUN_DOMAIN}', 'to': f'{DIGEST_LOCAL_PART}@{MAILGUN_DOMAIN}',
+            'from': 'alice@example.com', 'subject': 'Re: Cape AI: 2 questions waiting for an answer',
+            'body-plain': 'Blue', 'Message-Id': '<digest-reply@example.com>'}
+    response = _run(email_events.email_question({'args': _resign(args)}))
+    assert json.loads(response.body)['result'] == {'success': False, 'emailHandled': True}
+    assert outbox.sent == [{'to': 'alice@example.com', 'from': args['to'], 'subject': args['subject']}]
+
+
+def test_a_correction_without_known_results_costs_one_responder_call(monkeypatch):
+    calls = []
+
+    async def get_answers(request):
+        calls.append(dict(request['args']))
+        return [{'sourceId': f'reply{number}', 'answerText': f'answer {number}'}
+                for number in range(int(request['args']['numberofitems']))]
+
+    monkeypatch.setattr(email_events, '_get_answers', get_answers)
+    email_event = SimpleNamespace(question_email_extracted_body='What colour is the sky?',
+                                  suggested_email_results=None, final_email_saved_reply_id='reply1')
+    request = {'args': {'token': 'correction-token', 'question': '', 'numberofitems': '3'}}
+    answers = _run(email_events._correction_answers(request, email_event))
+    assert len(calls) == 1 and calls[0]['numberofitems'] == '4'
+    assert [answer['sourceId'] for answer in answers] == ['reply0', 'reply2', 'reply3']
+
+
+def test_questions_are_stored_before_their_reply_is_spooled(monkeypatch):
+    user = SimpleNamespace(user_id='user', token='token', forward_email='owner@example.com',
+                           verified_email='owner@example.com')
+    steps = []
+
+    async def save_event(email_event, durable=False):
+        steps.append(('save', durable))
+
+    class _Spool:
+        async def enqueue(self, data, event_id=None):
+            steps.append(('send', data['to']))
+
+    args = {'recipient': f'token@{MAILGUN_DOMAIN}', 'to': f'token@{MAILGUN_DOMAIN}', 'from': 'Bob <bob@example.com>',
+            'subject': 'Sky', 'body-plain': 'What colour is the sky?', 'Message-Id': '<question@example.com>'}
+    with replay_handlers(answers=False):
+        monkeypatch.setattr(email_events, 'get_user', lambda field, value: user)
+        monkeypatch.setattr(email_events, 'save_event', save_event)
+        monkeypatch.setattr(email_events, 'spool', _Spool())
+        _run(email_events.email_question({'args': _resign(args)}))
+    assert steps[:2] == [('save', True), ('send', 'owner@example.com')]
+
+
+def test_questions_over_the_token_limit_are_deferred_not_dropped(monkeypatch):
+    user = SimpleNamespace(user_id='user', token='token', forward_email='owner@example.com',
+                           verified_email='owner@example.com')
+
+    def question(number):
+        args = {'recipient': f'token@{MAILGUN_DOMAIN}', 'to': f'token@{MAILGUN_DOMAIN}',
+                'from': f'Bob {number} <bob{number}@example.com>', 'subject': 'Sky',
+                'body-plain': f'What colour is the sky number {number}?', 'Message-Id': f'<{number}@example.com>'}
+        return json.loads(_run(email_events.email_question({'args': _resign(args)})).body)
+
+    with replay_handlers(answers=False):
+        monkeypatch.setattr(email_events, 'get_user', lambda field, value: user)
+        monkeypatch.setattr(email_events, 'mail_filter', MailFilter(token_limiter=RateLimiter(60, 1),
+                                                                    sender_limiter=RateLimiter(0, 0)))
+        assert question(1)['result'] == {'success': True, 'emailHandled': True}
+        deferred = question(2)
+    assert deferred['success'] is False and ERROR_EMAIL_RATE_LIMITED in json.dumps(deferred['result'])
+    assert 'dropped' not in json.dumps(deferred)
@@ -0,0 +1,104 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from peewee import SqliteDatabase, Model, CharField, DateTimeField, TextField, IntegrityError
+
+from cape_email_plugin import email_lookups
+from cape_email_plugin.email_history import ensure_indexes, event_by_id, user_events, compact_history, is_compacted
+
+_NOW = datetime(2018, 6, 1)
+
+
+class _JSONField(TextField):
+    def db_value(self, value):
+        return None if value is None else json.dumps(value)
+
+    def python_value(self, value):
+        return None if value is None else json.loads(value)
+
+
+class _Event(Model):
+    """The EmailEvent columns the history helpers use."""
+    unique_id = CharField()
+    user_id = CharField()
+    question_email_package = _JSONField(null=True)
+    question_email_extracted_body = TextField(null=True)
+    question_email_timestamp = DateTimeField()
+    suggested_email_results = _JSONField(null=True)
+    final_email_saved_reply_id = CharField(null=True)
+
+
+@pytest.fixture
+def events():
+    database = SqliteDatabase(':memory:')
+    _Event.bind(database)
+    database.create_tables([_Event])
+    for day in range(10):
+        _Event.create(unique_id=f'event{day}', user_id='alice' if day % 2 else 'bob',
+                      question_email_package={'subject': 'Sky', 'from': 'Bob <bob@example.com>',
+                                              'body-plain': 'What colour is the sky?\n' + 'x' * 10000,
+                                              'extras': 'compressed headers'},
+                      question_email_extracted_body='What colour is the sky?',
+                      question_email_timestamp=_NOW - timedelta(days=200 - day * 10),
+                      suggested_email_results=[{'sourceType': 'saved_reply', 'sourceId': 'reply', 'answerText': 'Blue',
+                                                'answerContext': 'The sky is blue ' * 100}])
+    ensure_indexes(_Event)
+    yield _Event
+    database.close()
+
+
+def test_indexed_lookups(events):
+    indexes = {tuple(column for column in index[2]) for index in events._meta.database.get_indexes('_event')}
+    assert ('unique_id',) in indexes and ('user_id', 'question_email_timestamp') in indexes
+    assert event_by_id('event3', events).user_id == 'alice'
+    assert event_by_id('missing', events) is None
+    found = user_events('alice', since=_NOW - timedelta(days=170), until=_NOW - timedelta(days=150), model=events)
+    assert [email_event.unique_id for email_event in found] == ['event3']
+    assert len(list(user_events('bob', limit=2, model=events))) == 2
+
+
+def test_old_events_are_archived_then_compacted(events, tmp_path):
+    counts = compact_history(days=150, archive_dir=str(tmp_path), batch_size=2, dry_run=True, now=_NOW, model=events)
+    assert counts['compacted'] == 5 and counts['archive'] is None
+    counts = compact_history(days=150, archive_dir=str(tmp_path), batch_size=2, now=_NOW, model=events)
+    assert counts['scanned'] == 5 and counts['compacted'] == 5
+    with gzip.open(counts['archive'], 'rt') as archive:
+        records = [json.loads(line) for line in archive]
+    assert [record['unique_id'] for record in records] == [f'event{day}' for day in range(5)]
+    assert records[0]['question_email_package']['extras'] == 'compressed headers'
+    old, recent = event_by_id('event0', events), event_by_id('event5', events)
+    assert is_compacted(old) and not is_compacted(recent)
+    assert 'extras' not in old.question_email_package and old.question_email_package['subject'] == 'Sky'
+    assert len(old.question_email_package['body-plain']) < len(recent.question_email_package['body-plain'])
+    assert old.suggested_email_results == [{'sourceType': 'saved_reply', 'sourceId': 'reply', 'answerText': 'Blue'}]
+    again = compact_history(days=150, archive_dir=str(tmp_path), batch_size=2, now=_NOW, model=events)
+    assert again['scanned'] == 5 and again['compacted'] == 0 and again['archive'] is None
+
+
+def test_a_cached_copy_saved_after_compaction_keeps_it_compacted(events, tmp_path, monkeypatch):
+    monkeypatch.setattr(email_lookups, 'EmailEvent', events)
+    cached = event_by_id('event0', events)  # held by a running server while the history is compacted
+    compact_history(days=150, archive_dir=str(tmp_path), now=_NOW, model=events)
+    cached.final_email_saved_reply_id = 'reply2'
+    with pytest.raises(IntegrityError):  # written in the same batch as an event that fails
+        email_lookups._write_events([cached, events(unique_id='broken')])
+    email_lookups._write_events([cached])
+    stored = event_by_id('event0', events)
+    assert stored.final_email_saved_reply_id == 'reply2'
+    assert is_compacted(stored) and len(stored.question_email_package['body-plain']) < 10000
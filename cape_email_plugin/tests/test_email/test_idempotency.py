@@ -0,0 +1,130 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+
+import pytest
+
+from cape_email_plugin.email_idempotency import IdempotencyStore
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+def _request(token='token', timestamp='1518798384', **args):
+    return {'args': dict(args, token=token, timestamp=timestamp, signature='signature')}
+
+
+def _message_key(request):
+    return IdempotencyStore.keys(request, 'email_question')[1]
+
+
+def test_keys_come_from_the_signature_and_the_message_id():
+    assert IdempotencyStore.keys(_request(), 'email_question') == [('signature', 'token', '1518798384')]
+    request = _request(**{'Message-Id': '<1@example.com>', 'recipient': 'token@example.com'})
+    assert IdempotencyStore.keys(request, 'email_question') == [
+        ('signature', 'token', '1518798384'), ('message', 'email_question', '<1@example.com>', 'token@example.com')]
+    lower_case = _request(**{'message-id': '<1@example.com>', 'recipient': 'token@example.com'})
+    assert _message_key(lower_case) == _message_key(request)
+    other_recipient = _request(**{'Message-Id': '<1@example.com>', 'recipient': 'other@example.com'})
+    assert _message_key(other_recipient) != _message_key(request)
+
+
+def test_concurrent_redeliveries_share_the_first_result():
+    store = IdempotencyStore(maxsize=10, ttl=60)
+    calls = []
+
+    async def deliveries():
+        release = asyncio.Event()
+
+        async def handle():
+            calls.append(1)
+            await release.wait()
+            return {'success': True}
+
+        keys = IdempotencyStore.keys(_request(), 'email_question')
+        first = asyncio.ensure_future(store.run(keys, handle))
+        await asyncio.sleep(0)
+        redelivery = asyncio.ensure_future(store.run(keys, handle))
+        await asyncio.sleep(0)
+        assert not redelivery.done()
+        release.set()
+        results = await asyncio.gather(first, redelivery)
+        results.append(await store.run(keys, handle))  # once finished the stored result is returned
+        return results
+
+    assert _run(deliveries()) == [{'success': True}] * 3
+    assert len(calls) == 1 and store.stats()['duplicates'] == 2
+
+
+def test_a_message_id_matches_whatever_the_signature():
+    store = IdempotencyStore(maxsize=10, ttl=60)
+    message = {'Message-Id': '<1@example.com>', 'recipient': 'token@example.com'}
+
+    async def handle():
+        return {'token': 'first'}
+
+    async def deliveries():
+        await store.run(IdempotencyStore.keys(_request('first', **message), 'email_question'), handle)
+        return await store.run(IdempotencyStore.keys(_request('second', **message), 'email_question'), None)
+
+    assert _run(deliveries()) == {'token': 'first'}
+
+
+def test_failed_deliveries_are_forgotten():
+    store = IdempotencyStore(maxsize=10, ttl=60)
+    attempts = []
+
+    async def handle():
+        attempts.append(1)
+        await asyncio.sleep(0.01)
+        if len(attempts) == 1:
+            raise ValueError('database unavailable')
+        return {'success': True}
+
+    async def deliveries():
+        keys = IdempotencyStore.keys(_request(), 'email_question')
+        first = asyncio.ensure_future(store.run(keys, handle))
+        await asyncio.sleep(0)
+        duplicate = asyncio.ensure_future(store.run(keys, handle))
+        for delivery in (first, duplicate):  # the duplicate waiting on the first delivery fails with it
+            with pytest.raises(ValueError):
+                await delivery
+        return await store.run(keys, handle)  # Mailgun's retry is processed
+
+    assert _run(deliveries()) == {'success': True}
+    assert len(attempts) == 2
+
+
+def test_results_expire_after_the_ttl():
+    store = IdempotencyStore(maxsize=10, ttl=0.01)
+    calls = []
+
+    async def handle():
+        calls.append(1)
+        return {'success': True}
+
+    keys = IdempotencyStore.keys(_request(), 'email_question')
+    _run(store.run(keys, handle))
+    time.sleep(0.02)
+    _run(store.run(keys, handle))
+    assert len(calls) == 2 and store.stats()['duplicates'] == 0
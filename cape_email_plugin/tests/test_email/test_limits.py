@@ -0,0 +1,61 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+
+from cape_email_plugin.email_filters import automated_reason
+from cape_email_plugin.email_limits import cap_fields, bounded_question, truncate, TRUNCATED_FIELD
+from cape_email_plugin.email_metrics import RequestTrace
+
+
+def test_oversized_fields_are_cut_and_accounted_for():
+    body = 'What colour is the sky?\n' * 1000
+    headers = json.dumps([['Auto-Submitted', 'auto-replied']] + [['Received', 'x' * 100]] * 100)
+    attachments = json.dumps([{'url': f'https://storage/{number}', 'name': 'faq.txt'} for number in range(100)])
+    args = {'body-plain': body, 'subject': 'S' * 500, 'from': 'bob@example.com', 'message-headers': headers,
+            'attachments': attachments, 'signature': 'f' * 64, 'timestamp': '1518798384', 'token': 't' * 50,
+            TRUNCATED_FIELD: 'x'}  # a header of the email, posted as a field
+
+    async def webhook():
+        with RequestTrace('test_endpoint') as trace:
+            return trace, cap_fields(args, max_body_chars=1000, max_field_chars=300)
+
+    loop = asyncio.new_event_loop()
+    try:
+        trace, cut = loop.run_until_complete(webhook())
+    finally:
+        loop.close()
+    assert cut == {'body-plain': len(body), 'subject': 500, 'message-headers': len(headers),
+                   'attachments': len(attachments)}
+    assert len(args['body-plain']) <= 1000 and args['body-plain'].endswith('sky?')
+    assert args['subject'] == 'S' * 300
+    assert len(args['message-headers']) <= 300
+    assert len(args['attachments']) <= 300 and json.loads(args['attachments'])[0]['url'] == 'https://storage/0'
+    assert automated_reason(args) == 'Auto-Submitted: auto-replied'
+    assert args['signature'] == 'f' * 64
+    assert args[TRUNCATED_FIELD] == cut
+    assert trace.truncated == cut
+    assert cap_fields(args, max_body_chars=1000, max_field_chars=300) == {}
+
+
+def test_questions_are_bounded_at_word_boundaries():
+    assert bounded_question('short question', 100) == 'short question'
+    assert bounded_question('what colour is the sky', 15) == 'what colour is'
+    assert truncate('x' * 50, 10) == 'x' * 10
+
+
+def test_a_sender_supplied_truncation_record_is_discarded():
+    args = {'body-plain': 'What colour is the sky?', TRUNCATED_FIELD: '{"body-plain": 1}'}
+    assert cap_fields(args) == {} and TRUNCATED_FIELD not in args
@@ -0,0 +1,49 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+from cape_email_plugin.email_metrics import Histogram, RequestTrace, job_trace, stage, render_metrics
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram('test_seconds', 'Test.', ('stage',), buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(('a',), value)
+    lines = histogram.render()
+    assert 'test_seconds_bucket{stage="a",le="0.1"} 2' in lines
+    assert 'test_seconds_bucket{stage="a",le="1"} 3' in lines
+    assert 'test_seconds_bucket{stage="a",le="+Inf"} 4' in lines
+    assert 'test_seconds_count{stage="a"} 4' in lines
+
+
+def test_stages_are_recorded_on_the_trace_of_their_task():
+    async def webhook():
+        with RequestTrace('test_endpoint', 'event-1') as trace:
+            request = {'trace': trace}
+            with stage('extract'):
+                await asyncio.sleep(0)
+            with job_trace(request) as job:
+                with stage('answer'):
+                    pass
+        return trace, job
+
+    loop = asyncio.new_event_loop()
+    try:
+        trace, job = loop.run_until_complete(webhook())
+    finally:
+        loop.close()
+    assert list(trace.stages) == ['extract']
+    assert list(job.stages) == ['answer'] and job.unique_id == 'event-1'
+    assert 'cape_email_stage_seconds_count{endpoint="test_endpoint_answer",stage="answer"} 1' in render_metrics()
@@ -0,0 +1,48 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+from cape_email_plugin import email_package
+from cape_email_plugin.email_package import compact_package, expand_package, PACKAGE_FIELDS
+
+_ARGS = {'subject': 'Sky', 'Subject': 'Sky', 'from': 'Bob <bob@example.com>', 'From': 'Bob <bob@example.com>',
+         'to': 'token@example.com', 'recipient': 'token@example.com', 'body-plain': 'What colour is the sky?',
+         'Message-Id': '<1@example.com>', 'body-html': '<p>What colour is the sky?</p>' * 50,
+         'message-headers': json.dumps([['Subject', 'Sky'], ['Received', 'by mxa.mailgun.org']]),
+         'token': 'token', 'timestamp': '1518798384', 'signature': 'signature', 'question': 'sky?',
+         'numberofitems': '3'}
+
+
+def test_packages_keep_the_handler_fields_and_compress_the_rest(monkeypatch):
+    monkeypatch.setattr(email_package, 'EMAIL_PACKAGE_EXTRAS', 'compressed')
+    package = compact_package(_ARGS)
+    assert set(package) == set(PACKAGE_FIELDS) | {'extras'}
+    assert len(json.dumps(package)) < len(json.dumps(_ARGS)) / 2
+    expanded = expand_package(package)
+    assert expanded == {field: value for field, value in _ARGS.items()
+                        if field not in ('Subject', 'From', 'token', 'timestamp', 'signature', 'question',
+                                         'numberofitems')}
+
+
+def test_packages_without_extras(monkeypatch):
+    monkeypatch.setattr(email_package, 'EMAIL_PACKAGE_EXTRAS', 'none')
+    package = compact_package(_ARGS)
+    assert package == {field: _ARGS[field] for field in PACKAGE_FIELDS}
+    assert expand_package(package) == package
+    assert compact_package({'subject': 'Sky'}) == {'subject': 'Sky'}
+
+
+def test_old_packages_expand_to_themselves():
+    assert expand_package(dict(_ARGS)) == _ARGS
@@ -0,0 +1,60 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import json
+from types import SimpleNamespace
+
+from cape_email_plugin import email_events
+from cape_email_plugin.email_replay import replay, route
+from cape_email_plugin.email_settings import MAILGUN_DOMAIN
+
+_USER = SimpleNamespace(user_id='replay', token='replaytoken', forward_email='owner@example.com',
+                        verified_email='owner@example.com')
+
+
+def _archive(path):
+    payloads = [{'recipient': f'replaytoken@{MAILGUN_DOMAIN}', 'to': f'replaytoken@{MAILGUN_DOMAIN}',
+                 'from': f'Bob {n} <bob{n}@example.com>', 'subject': 'Sky', 'timestamp': '1518798384',
+                 'token': f'token{n}', 'Message-Id': f'<{n}@example.com>',
+                 'body-plain': f'Hi,\nWhat colour is the sky number {n}?\nRegards,\nBob'} for n in range(5)]
+    payloads.append({'recipient': f'event+d@{MAILGUN_DOMAIN}', 'from': 'bob@example.com'})
+    with gzip.open(path, 'wt') as archive:
+        for payload in payloads:
+            archive.write(json.dumps(payload) + '\n')
+
+
+def test_routes_follow_the_mailgun_routes():
+    assert route('token@example.com') == 'email_question'
+    assert route('event+c@example.com') == 'email_new_reply'
+    assert route('1.event.user.signature+e@example.com') == 'email_request_correction'
+    assert route('event+d@example.com') is None
+
+
+def test_replay_writes_one_record_per_payload(tmp_path, monkeypatch):
+    monkeypatch.setattr(email_events, 'get_user', lambda field, value: _USER if value == 'replaytoken' else None)
+    monkeypatch.setattr(email_events, 'refresh_user', lambda user: user)
+    _archive(str(tmp_path / 'archive.jsonl.gz'))
+    for workers in (0, 2):
+        output = str(tmp_path / f'replay-{workers}.jsonl.gz')
+        summary = replay([str(tmp_path / 'archive.jsonl.gz')], output, workers=workers, chunk_size=2, answers=False,
+                         progress=None)
+        assert summary['messages'] == 6 and summary['errors'] == 0
+        assert summary['endpoints'] == {'email_question': 5, 'unrouted': 1}
+        with gzip.open(output, 'rt') as replayed:
+            records = [json.loads(line) for line in replayed]
+        assert [record['i'] for record in records] == list(range(6))
+        assert records[3]['extracted'] == 'What colour is the sky number 3?'
+        assert records[3]['sent'][0]['to'] == 'owner@example.com'  # no answers, so Alice is asked for help
+        assert records[5]['endpoint'] is None
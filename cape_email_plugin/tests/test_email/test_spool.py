@@ -0,0 +1,136 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+from types import SimpleNamespace
+
+import requests
+
+from cape_email_plugin import email_spool
+from cape_email_plugin.email_spool import EmailSpool, PENDING, SENDING, SENT, DEAD
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class _Sender:
+    """Fails with each error of errors in turn, then accepts every message."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.sent = []
+
+    async def send(self, data):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append(data)
+        return SimpleNamespace(json=lambda: {'id': f'<{len(self.sent)}@mailgun>'})
+
+
+def _spool(tmp_path, monkeypatch, sender, **kwargs):
+    monkeypatch.setattr(email_spool, 'sender', sender)
+    return EmailSpool(path=str(tmp_path / 'spool.sqlite3'), workers=1, **kwargs)
+
+
+def _deliver_due(spool):
+    """Claim and deliver one due message like a worker does, returns whether there was one."""
+    async def deliver():
+        row = await spool._call(spool._claim)
+        if row is not None:
+            await spool._deliver(row)
+        return row is not None
+    return _run(deliver())
+
+
+def _status(spool, event_id='event'):
+    return spool.delivery_status(event_id)[0]
+
+
+def test_enqueued_messages_are_delivered_by_the_workers(tmp_path, monkeypatch):
+    sender = _Sender()
+    spool = _spool(tmp_path, monkeypatch, sender)
+
+    async def deliver():
+        spool.start()
+        await spool.enqueue({'to': 'bob@example.com'}, 'event')
+        for _ in range(100):
+            if sender.sent:
+                break
+            await asyncio.sleep(0.01)
+        await spool.stop()
+    _run(deliver())
+    assert sender.sent == [{'to': 'bob@example.com'}]
+    status = _status(spool)
+    assert (status['status'], status['attempts'], status['provider_id']) == (SENT, 1, '<1@mailgun>')
+
+
+def test_failed_sends_are_retried_with_backoff(tmp_path, monkeypatch):
+    spool = _spool(tmp_path, monkeypatch, _Sender(requests.ConnectionError('down'), requests.Timeout('slow')),
+                   base_delay=10, max_delay=15)
+    _run(spool.enqueue({'to': 'bob@example.com'}, 'event'))
+    start = time.time()
+    assert _deliver_due(spool)
+    assert not _deliver_due(spool)  # not due before the backoff
+    next_attempt = spool.connection.execute('SELECT next_attempt FROM messages').fetchone()[0]
+    assert start + 10 <= next_attempt <= time.time() + 10
+    assert (_status(spool)['status'], _status(spool)['last_error']) == (PENDING, 'down')
+    assert spool._retry_delay(2) == 15  # doubled, then capped at max_delay
+    monkeypatch.setattr(email_spool.time, 'time', lambda: start + 100)
+    assert _deliver_due(spool) and not _deliver_due(spool)
+    assert (_status(spool)['status'], _status(spool)['last_error']) == (PENDING, 'slow')
+    monkeypatch.setattr(email_spool.time, 'time', lambda: start + 200)
+    assert _deliver_due(spool)
+    assert (_status(spool)['status'], _status(spool)['attempts']) == (SENT, 3)
+
+
+def test_rejected_messages_are_dead_letters_at_once(tmp_path, monkeypatch):
+    rejected = requests.HTTPError('bad address', response=SimpleNamespace(status_code=400))
+    spool = _spool(tmp_path, monkeypatch, _Sender(rejected))
+    _run(spool.enqueue({'to': 'nobody'}, 'event'))
+    assert _deliver_due(spool)
+    assert (_status(spool)['status'], _status(spool)['attempts']) == (DEAD, 1)
+    assert spool.dead_letters()[0]['data'] == {'to': 'nobody'}
+    spool.requeue_dead(_status(spool)['id'])
+    assert _deliver_due(spool) and _status(spool)['status'] == SENT
+
+
+def test_unexpected_errors_count_as_attempts_until_given_up(tmp_path, monkeypatch):
+    spool = _spool(tmp_path, monkeypatch, _Sender(ValueError('bad payload'), KeyError('to')), max_attempts=2,
+                   base_delay=0)
+    _run(spool.enqueue({'to': 'bob@example.com'}, 'event'))
+    assert _deliver_due(spool)
+    assert (_status(spool)['status'], _status(spool)['attempts']) == (PENDING, 1)
+    assert _deliver_due(spool)
+    assert (_status(spool)['status'], _status(spool)['attempts']) == (DEAD, 2)
+    assert not _deliver_due(spool)
+
+
+def test_sends_of_a_crashed_worker_are_retried_once_their_lease_expires(tmp_path, monkeypatch):
+    spool = _spool(tmp_path, monkeypatch, _Sender(), max_attempts=2)
+    _run(spool.enqueue({'to': 'bob@example.com'}, 'event'))
+    now = time.time()
+    assert spool._claim() is not None  # the worker dies before recording the outcome
+    assert spool._claim() is None and _status(spool)['status'] == SENDING
+    monkeypatch.setattr(email_spool.time, 'time', lambda: now + email_spool._SEND_LEASE + 1)
+    assert spool._claim() is not None  # and dies again, using the last attempt
+    monkeypatch.setattr(email_spool.time, 'time', lambda: now + 2 * email_spool._SEND_LEASE + 2)
+    assert spool._claim() is None
+    assert (_status(spool)['status'], _status(spool)['attempts'], _status(spool)['last_error']) == \
+        (DEAD, 2, 'lease expired')
@@ -0,0 +1,55 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+import pytest
+
+from api_helpers.exceptions import UserException
+from cape_email_plugin.email_sender import MailgunSender
+from cape_email_plugin.email_settings import MAILGUN_API_KEY
+from cape_email_plugin.email_store import fetch_message, is_notification, STORED_MESSAGE
+from cape_email_plugin.tests.fake_mailgun import FakeMailgun
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_notify_webhooks_fetch_the_stored_message():
+    client = MailgunSender(pool_size=1, max_concurrency=1)
+    with FakeMailgun(MAILGUN_API_KEY, 'receive.example.com', 'http://localhost:1/api', notify=True) as fake:
+        message = fake.send('Bob <bob@example.com>', 'token@receive.example.com', 'Sky',
+                            email_text='Hi,\nWhat colour is the sky?', deliver_webhook=False)
+        request = {'args': fake.webhook_payload(message, 'token@receive.example.com')}
+        assert is_notification(request['args'])
+        _run(fetch_message(request, client, host_suffix='localhost'))
+        assert request['args']['body-plain'] == 'Hi,\nWhat colour is the sky?'
+        assert request['args']['from'] == 'Bob <bob@example.com>'
+        assert not is_notification(request['args']) and request[STORED_MESSAGE]
+        forwarded = {'args': fake.webhook_payload(message, 'token@receive.example.com', notify=False)}
+        assert not is_notification(forwarded['args'])
+        _run(fetch_message(forwarded, client, host_suffix='localhost'))
+        assert STORED_MESSAGE not in forwarded
+    client.close()
+
+
+def test_message_urls_outside_mailgun_are_refused():
+    request = {'args': {'message-url': 'https://attacker.example.com/v3/domains/x/messages/y'}}
+    with pytest.raises(UserException):
+        _run(fetch_message(request, host_suffix='mailgun.net'))
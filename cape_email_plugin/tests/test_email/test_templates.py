@@ -0,0 +1,130 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import html
+from datetime import datetime
+
+from api_helpers.text_responses import ERROR_NO_SUGGESTIONS
+
+from cape_email_plugin.email_settings import EMAIL_QUOTE_MAX_LINES, EMAIL_QUOTE_MAX_CHARS, \
+    EMAIL_CORRECTION_BODY_MAX_CHARS
+from cape_email_plugin.email_templates import render_quote, render_answer, render_suggestions, render_digest, \
+    render_plain, UI_URL
+
+_TIMESTAMP = datetime(2018, 2, 16, 16, 26)
+_QUESTION = 'Hi,\r\nWhat colour is the sky?\r\nIs it <blue> & "bright"?\r\nThanks,\r\nBob'
+_ANSWERS = [
+    {'sourceType': 'document', 'sourceId': 'sky-facts', 'answerText': 'blue',
+     'answerContext': 'The sky is blue on a sunny day.', 'answerContextStartOffset': 100,
+     'answerTextStartOffset': 111, 'answerTextEndOffset': 115},
+    {'sourceType': 'saved_reply', 'sourceId': 'reply1', 'answerText': 'It is blue.'},
+]
+
+
+# The string building the templates replaced, as it was before them, kept to check the html is unchanged
+def _baseline_quote(email_to, original_text, original_timestamp):
+    email_text = original_timestamp.strftime(f"<br />On %a, %b %d, %Y at %H:%M %p {email_to} wrote:<br />")
+    email_text += "<br />".join(f"> {line}" for line in original_text.replace('\r\n', '\n').split('\n'))
+    return email_text
+
+
+def _baseline_answer(firstname, answer_text, correction_address, original_subject, original_text):
+    answer_text = answer_text.replace("\n", "\r\n")
+    signature_text = '--<br />Sent by <a href="https://alpha.thecape.ai">Cape</a> AI<br /><br />'
+    email_to_correct = html.escape(f'"Cape AI" <{correction_address}>')
+    email_subject_correct = html.escape(original_subject)
+    email_body_correct = html.escape(original_text)
+    email_body_correct = email_body_correct.replace('\r\n', '%0D%0A')
+    signature_text += f'<small>If this answer does not answer your question, click <a href="mailto:' \
+                      f'{email_to_correct}?subject={email_subject_correct}&body={email_body_correct}">here</a>.</small>'
+    return f'Hello{firstname},<br /><br />{answer_text}<br /><br />{signature_text}<br /><br />'
+
+
+def _baseline_suggestions(firstname, answers):
+    answer_text = f'Hello{firstname},<br /><br />==Cape AI Suggestions==<br /><br />'
+    if answers is None:
+        answer_text += ERROR_NO_SUGGESTIONS + "<br /><br />"
+    else:
+        for answer in answers:
+            if 'answerContext' in answer:
+                context = answer["answerContext"]
+                local_start_offset = answer['answerTextStartOffset'] - answer['answerContextStartOffset']
+                local_end_offset = answer['answerTextEndOffset'] - answer['answerContextStartOffset']
+                context = f'{context[:local_start_offset]}<b>{context[local_start_offset:local_end_offset]}</b>' \
+                          f'{context[local_end_offset:]}'
+            else:
+                context = answer['answerText']
+            if answer['sourceType'] == 'document':
+                answer_text += f'{context}<br /><br />According to document: ' \
+                               f'<a href="{UI_URL}/dashboard.html#/documents/{answer["sourceId"]}">' \
+                               f'{answer["sourceId"]}</a><br /><br />'
+            elif answer['sourceType'] == 'saved_reply':
+                answer_text += f'{context}<br /><br />According to ' \
+                               f'<a href="{UI_URL}/dashboard.html#/saved-replies/{answer["sourceId"]}">saved reply' \
+                               f'</a><br /><br />'
+    answer_text += f'==End Suggestions==<br /><br />'
+    answer_text += '--<br/>Sent by <a href="https://alpha.thecape.ai">Cape</a> AI<br /><br />'
+    return answer_text
+
+
+def test_html_matches_the_previous_rendering():
+    assert render_quote(_QUESTION, _TIMESTAMP, 'alice@example.com')[1] == \
+        _baseline_quote('alice@example.com', _QUESTION, _TIMESTAMP)
+    answer = ('Our sky is blue.\nMostly.', 'event+e@example.com', 'Sky <colour>', _QUESTION)
+    assert render_answer(' Bob', *answer)[1] == _baseline_answer(' Bob', *answer)
+    assert render_answer('', *answer)[1] == _baseline_answer('', *answer)
+    for answers in (None, [], _ANSWERS):
+        assert render_suggestions(' Bob', answers)[1] == _baseline_suggestions(' Bob', answers)
+
+
+def test_text_parts_carry_the_same_content_without_markup():
+    text, _ = render_answer(' Bob', 'Our sky is blue.', 'event+e@example.com', 'Sky', _QUESTION)
+    assert text.startswith('Hello Bob,\n\nOur sky is blue.\n\n') and 'write to event+e@example.com' in text
+    text, _ = render_suggestions('', _ANSWERS)
+    assert 'The sky is blue on a sunny day.' in text and 'According to document: sky-facts' in text
+    assert 'According to saved reply' in text and '<' not in text
+    assert ERROR_NO_SUGGESTIONS in render_suggestions('', None)[0]
+    text, _ = render_quote(_QUESTION, _TIMESTAMP, 'alice@example.com')
+    assert text == '\nOn Fri, Feb 16, 2018 at 16:26 PM alice@example.com wrote:\n\n> Hi,\n> What colour is the sky?\n' \
+                   '> Is it <blue> & "bright"?\n> Thanks,\n> Bob'
+
+
+def test_quotes_and_correction_links_are_bounded():
+    many_lines = '\n'.join(f'line {number}' for number in range(10 * EMAIL_QUOTE_MAX_LINES))
+    text, html_quote = render_quote(many_lines, _TIMESTAMP, 'alice@example.com')
+    assert text.count('\n> ') == EMAIL_QUOTE_MAX_LINES + 1 and text.endswith('> [...]')
+    assert html_quote.endswith('> [...]') and '> line 0<br />' in html_quote
+    one_line = 'z' * (3 * EMAIL_QUOTE_MAX_CHARS)
+    text, _ = render_quote(one_line, _TIMESTAMP, 'alice@example.com')
+    assert text.count('z') == EMAIL_QUOTE_MAX_CHARS and text.endswith('\n> [...]')
+    assert render_quote('short', _TIMESTAMP, 'alice@example.com')[0].endswith('> short')
+    long_question = 'Q' * (2 * EMAIL_CORRECTION_BODY_MAX_CHARS)
+    _, answer_html = render_answer('', 'blue', 'event+e@example.com', 'Sky', long_question)
+    assert answer_html.count('Q') == EMAIL_CORRECTION_BODY_MAX_CHARS and 'Q[...]">here</a>' in answer_html
+
+
+def test_digests_list_every_question_with_its_reply_address():
+    items = [{'subject': 'Sky <colour>', 'text': 'Suggestions 1', 'html': 'Suggestions <b>1</b>',
+              'reply_address': 'event1+c@example.com'},
+             {'subject': 'Sea', 'text': 'Suggestions 2', 'html': 'Suggestions <b>2</b>',
+              'reply_address': 'event2+c@example.com'}]
+    text, digest_html = render_digest(items)
+    assert text.startswith('Hello,\n\n2 questions are waiting for your answer.\n\n== 1. Sky <colour> ==')
+    assert 'reply to event2+c@example.com with the subject "Re: Sea"' in text
+    assert '<h3>1. Sky &lt;colour&gt;</h3>Suggestions <b>1</b>' in digest_html
+    assert 'mailto:event1+c@example.com?subject=Re: Sky &lt;colour&gt;' in digest_html
+
+
+def test_plain_bodies_are_escaped():
+    assert render_plain('a <b>\nc') == ('a <b>\nc', 'a &lt;b&gt;<br />c')
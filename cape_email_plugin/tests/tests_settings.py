@@ -18,3 +18,5 @@ URL = 'http://localhost:5050'
 
 TEST_SEND_EMAIL_DOMAIN = os.getenv('CAPE_TEST_SEND_EMAIL_DOMAIN', 'REPLACEME')
 TEST_RECEIVE_EMAIL_DOMAIN = os.getenv('CAPE_TEST_RECEIVE_EMAIL_DOMAIN', 'REPLACEME')
+# Port of the local fake Mailgun, start the server under test with CAPE_MAILGUN_API_URL=http://localhost:<port>/v3
+FAKE_MAILGUN_PORT = int(os.getenv('CAPE_TEST_FAKE_MAILGUN_PORT', 5051))
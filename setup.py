@@ -59,4 +59,8 @@ setup(
     package_data={
         '': ['*.*'],
     },
+    entry_points={
+        'console_scripts': ['cape-email-replay=cape_email_plugin.email_replay:main',
+                            'cape-email-history=cape_email_plugin.email_history:main'],
+    },
 )